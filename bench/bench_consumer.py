@@ -0,0 +1,226 @@
+'''Throughput benchmark for WidgetConsumer.consume_requests, run against moto.
+
+Seeds a request bucket or queue with requests built from the json/ templates, then times how long
+the consumer takes to write all of them to the widget store. Every combination of request source,
+widget store, batch size, and worker count is run and the results are written as JSON. Pass a
+baseline file to fail when a combination gets slower than it used to be.
+
+Run from the root of the repo: `python3 -m bench.bench_consumer --requests 500`
+'''
+
+from argparse import ArgumentParser
+from boto3 import client, resource
+from itertools import product
+from json import dump, dumps, load, loads
+from logging import getLogger, WARNING
+from moto import mock_aws
+from os import makedirs
+from pathlib import Path
+from sys import exit
+from threading import Thread
+from time import sleep
+from timeit import default_timer
+
+from source.widget_consumer import REQUESTS_PROCESSED, WidgetConsumer
+
+TEMPLATE_FOLDER = Path(__file__).parent.parent / 'json'
+REGION = 'us-east-1'
+REQUEST_BUCKET = 'bench-requests'
+WIDGET_BUCKET = 'bench-widgets'
+WIDGET_TABLE = 'bench-widgets'
+
+def load_templates() -> list[dict]:
+    '''Loads the create and update request templates. Deletes are left out since the order
+    requests are processed in is not fixed once there are workers.
+    '''
+    return [loads(load(open(TEMPLATE_FOLDER / name))['body'])
+            for name in ('create.json', 'update.json')]
+
+def build_requests(count:int) -> list[dict]:
+    '''Builds count requests, cycling through the templates with a new widget for each.'''
+    templates = load_templates()
+    requests:list[dict] = []
+    for index in range(count):
+        request = dict(templates[index % len(templates)])
+        request['requestId'] = f'bench-request-{index}'
+        request['widgetId'] = f'bench-widget-{index}'
+        requests.append(request)
+    return requests
+
+def create_resources(source:str, store:str) -> list[str]:
+    '''Creates the mocked AWS resources for a run and returns the consumer arguments for them.'''
+    s3 = client('s3', region_name=REGION)
+    arguments:list[str] = ['--region', REGION]
+    if source == 's3':
+        s3.create_bucket(Bucket=REQUEST_BUCKET)
+        arguments += ['--request-bucket', REQUEST_BUCKET]
+    else:
+        queue_url:str = client('sqs', region_name=REGION).create_queue(QueueName='bench')['QueueUrl']
+        arguments += ['--request-queue', queue_url, '--queue-wait-timeout', '1']
+
+    if store == 's3':
+        s3.create_bucket(Bucket=WIDGET_BUCKET)
+        arguments += ['--widget-bucket', WIDGET_BUCKET]
+    else:
+        resource('dynamodb', region_name=REGION).create_table(
+            AttributeDefinitions=[{ 'AttributeName': 'id', 'AttributeType': 'S' }],
+            TableName=WIDGET_TABLE,
+            KeySchema=[{ 'AttributeName': 'id', 'KeyType': 'HASH' }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        arguments += ['--dynamodb-widget-table', WIDGET_TABLE]
+    return arguments
+
+def seed_requests(source:str, arguments:list[str], requests:list[dict]) -> None:
+    '''Puts the requests in the request bucket or queue.'''
+    if source == 's3':
+        s3 = client('s3', region_name=REGION)
+        for request in requests:
+            s3.put_object(Body=dumps(request), Bucket=REQUEST_BUCKET, Key=request['requestId'])
+        return
+
+    sqs = client('sqs', region_name=REGION)
+    queue_url:str = arguments[arguments.index('--request-queue') + 1]
+    for start in range(0, len(requests), 10):
+        sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{ 'Id': str(index), 'MessageBody': dumps(request) }
+                     for index, request in enumerate(requests[start:start + 10])]
+        )
+
+def count_processed(app:WidgetConsumer) -> int:
+    '''Returns how many requests the consumer has written to the widget store.'''
+    return int(sum(value for (name, labels), value in list(app.metrics.counters.items())
+                   if name == REQUESTS_PROCESSED and ('result', 'success') in labels))
+
+def run_benchmark(source:str, store:str, batch_size:int, workers:int, count:int,
+                  timeout:float) -> dict:
+    '''Times a single combination and returns its result.'''
+    with mock_aws():
+        arguments = create_resources(source, store)
+        arguments += ['--workers', str(workers), '--ack-batch-size', str(min(batch_size, 10))]
+        if store == 'dynamodb' and batch_size > 1:
+            arguments += ['--dynamodb-batch-size', str(min(batch_size, 25))]
+        seed_requests(source, arguments, build_requests(count))
+
+        app = WidgetConsumer()
+        getLogger().setLevel(WARNING) # Logging every request would be most of what we measure
+        args = app.get_consumer_parser().parse_args(arguments)
+        app.verify_arguments(args)
+        app.save_arguments(args)
+
+        consumer = Thread(target=app.consume_requests, name='bench-consumer')
+        start = default_timer()
+        consumer.start()
+        while count_processed(app) < count and default_timer() - start < timeout:
+            sleep(0.005)
+        elapsed:float = default_timer() - start
+        app.stop()
+        consumer.join()
+
+    processed:int = count_processed(app)
+    return {
+        'source': source,
+        'store': store,
+        'batch_size': batch_size,
+        'workers': workers,
+        'requests': count,
+        'processed': processed,
+        'seconds': round(elapsed, 4),
+        'requests_per_second': round(processed / elapsed, 2)
+    }
+
+def result_key(result:dict) -> str:
+    '''Names a combination so results can be matched up with the baseline.'''
+    return (f'{result['source']}-request/{result['store']}-store/batch-{result['batch_size']}/' +
+            f'workers-{result['workers']}')
+
+def find_regressions(results:list[dict], baseline:list[dict], tolerance:float) -> list[str]:
+    '''Returns a line for every combination that is more than tolerance slower than baseline.'''
+    baseline_by_key:dict[str, dict] = { result_key(result): result for result in baseline }
+    regressions:list[str] = []
+    for result in results:
+        previous:dict = baseline_by_key.get(result_key(result))
+        if previous is None:
+            continue
+        floor:float = previous['requests_per_second'] * (1 - tolerance)
+        if result['requests_per_second'] < floor:
+            regressions.append(f'{result_key(result)}: {result['requests_per_second']} req/s, ' +
+                               f'baseline {previous['requests_per_second']} req/s')
+    return regressions
+
+def get_bench_parser() -> ArgumentParser:
+    '''Returns the parser for the benchmark'''
+    parser = ArgumentParser(description='Benchmark WidgetConsumer throughput against moto.')
+    parser.add_argument('-n', '--requests',
+                        action='store',
+                        type=int,
+                        default=200,
+                        help='Requests to seed for each run (default: %(default)s)')
+    parser.add_argument('-s', '--sources',
+                        nargs='+',
+                        choices=['s3', 'sqs'],
+                        default=['s3', 'sqs'],
+                        help='Request sources to benchmark (default: %(default)s)')
+    parser.add_argument('-st', '--stores',
+                        nargs='+',
+                        choices=['s3', 'dynamodb'],
+                        default=['s3', 'dynamodb'],
+                        help='Widget stores to benchmark (default: %(default)s)')
+    parser.add_argument('-b', '--batch-sizes',
+                        nargs='+',
+                        type=int,
+                        default=[1, 10],
+                        help='Ack/store batch sizes to benchmark (default: %(default)s)')
+    parser.add_argument('-w', '--workers',
+                        nargs='+',
+                        type=int,
+                        default=[0, 4],
+                        help='Worker counts to benchmark (default: %(default)s)')
+    parser.add_argument('-t', '--timeout',
+                        action='store',
+                        type=float,
+                        default=120,
+                        help='Longest time (in seconds) to wait for a single run ' +
+                            '(default: %(default)s)')
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        type=str,
+                        default='bench/results.json',
+                        help='Where to write the results (default: %(default)s)')
+    parser.add_argument('-bl', '--baseline',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help='Results file to compare against (default: %(default)s)')
+    parser.add_argument('-tol', '--tolerance',
+                        action='store',
+                        type=float,
+                        default=0.2,
+                        help='Fraction slower than baseline that counts as a regression ' +
+                            '(default: %(default)s)')
+    return parser
+
+if __name__ == '__main__':
+    args = get_bench_parser().parse_args()
+    makedirs('log', exist_ok=True) # The consumer logs to log/consumer.log
+
+    results:list[dict] = []
+    for source, store, batch_size, workers in product(args.sources, args.stores,
+                                                      args.batch_sizes, args.workers):
+        result = run_benchmark(source, store, batch_size, workers, args.requests, args.timeout)
+        print(f'{result_key(result)}: {result['requests_per_second']} req/s ' +
+              f'({result['processed']}/{result['requests']} in {result['seconds']}s)')
+        results.append(result)
+
+    with open(args.output, 'w') as output:
+        dump(results, output, indent=4)
+    print(f'Results written to {args.output}')
+
+    if args.baseline is not None:
+        regressions = find_regressions(results, load(open(args.baseline)), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            exit(1)
+        print('No regressions against baseline.')
@@ -0,0 +1,112 @@
+'''Cold start and per-invocation latency of the request handler lambda, run against moto.
+
+Import time and the time to create the SQS client are measured in fresh interpreters, the way a
+new lambda instance would pay for them. Invocations are then timed in this process: the first
+one after clearing the handler's cached client and config (a cold invocation) and then every
+warm one after it. Results are written as JSON.
+
+Run from the root of the repo: `python3 -m bench.bench_request_handler --invocations 500`
+'''
+
+from argparse import ArgumentParser
+from boto3 import client
+from json import dump, dumps
+from logging import getLogger, WARNING
+from moto import mock_aws
+from os import environ
+from statistics import median, quantiles
+from subprocess import run
+from sys import executable
+from timeit import default_timer
+
+from source import widget_request_handler
+
+REGION = 'us-east-1'
+# Runs in a fresh interpreter and prints the seconds spent importing and creating the client
+COLD_START_SCRIPT = '''
+from timeit import default_timer
+start = default_timer()
+import widget_request_handler
+imported = default_timer()
+widget_request_handler.get_sqs_client()
+print(imported - start, default_timer() - imported)
+'''
+
+class LambdaContext():
+    '''The part of the lambda context the handler uses.'''
+    def __init__(self, aws_request_id:str) -> None:
+        self.aws_request_id:str = aws_request_id
+
+def measure_cold_starts(runs:int) -> dict:
+    '''Returns the median import and client creation time (in ms) over fresh interpreters.'''
+    imports:list[float] = []
+    clients:list[float] = []
+    for _ in range(runs):
+        output = run([executable, '-c', COLD_START_SCRIPT], cwd='source', capture_output=True,
+                     text=True, check=True,
+                     env={ **environ, 'REGION': REGION, 'QUEUE_URL': 'unused' }).stdout
+        import_seconds, client_seconds = (float(value) for value in output.split())
+        imports.append(import_seconds)
+        clients.append(client_seconds)
+    return {
+        'import_ms': round(median(imports) * 1000, 3),
+        'client_ms': round(median(clients) * 1000, 3)
+    }
+
+def measure_invocations(invocations:int) -> dict:
+    '''Times a cold invocation and then warm ones (in ms) against a mocked queue.'''
+    with mock_aws():
+        environ['REGION'] = REGION
+        environ['QUEUE_URL'] = client('sqs', region_name=REGION).create_queue(
+            QueueName='bench')['QueueUrl']
+        widget_request_handler._config = None
+        widget_request_handler._sqs = None
+        event:dict = { 'body': dumps({ 'type': 'create', 'owner': 'bench' }) }
+
+        latencies:list[float] = []
+        for index in range(invocations + 1):
+            start = default_timer()
+            widget_request_handler.handler(event, LambdaContext(f'bench-{index}'))
+            latencies.append((default_timer() - start) * 1000)
+
+    cold, warm = latencies[0], latencies[1:]
+    percentiles:list[float] = quantiles(warm, n=100)
+    return {
+        'cold_invocation_ms': round(cold, 3),
+        'warm_p50_ms': round(percentiles[49], 3),
+        'warm_p99_ms': round(percentiles[98], 3),
+        'invocations': invocations
+    }
+
+def get_bench_parser() -> ArgumentParser:
+    '''Returns the parser for the benchmark'''
+    parser = ArgumentParser(description='Benchmark request handler latency against moto.')
+    parser.add_argument('-n', '--invocations',
+                        action='store',
+                        type=int,
+                        default=200,
+                        help='Warm invocations to time (default: %(default)s)')
+    parser.add_argument('-c', '--cold-starts',
+                        action='store',
+                        type=int,
+                        default=5,
+                        help='Fresh interpreters to time imports in (default: %(default)s)')
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        type=str,
+                        default='bench/request_handler_results.json',
+                        help='Where to write the results (default: %(default)s)')
+    return parser
+
+if __name__ == '__main__':
+    args = get_bench_parser().parse_args()
+    getLogger().setLevel(WARNING) # Logging every request would be most of what we measure
+
+    result:dict = { **measure_cold_starts(args.cold_starts),
+                    **measure_invocations(args.invocations) }
+    for name, value in result.items():
+        print(f'{name}: {value}')
+
+    with open(args.output, 'w') as output:
+        dump(result, output, indent=4)
+    print(f'Results written to {args.output}')
@@ -0,0 +1,56 @@
+'''Batches up items (acks, writes, ...) so they can be sent to AWS in groups instead of one call
+per item.
+'''
+
+from threading import Lock, Timer
+from typing import Callable
+
+class RequestBatcher():
+    '''Collects items and hands them to a flush function in groups. A group is flushed once it
+    holds max_size items or once its oldest item has waited max_wait seconds, whichever comes
+    first.
+    '''
+    def __init__(self, flush_function: Callable[[list], None], max_size: int,
+                 max_wait: float) -> None:
+        self.flush_function = flush_function
+        self.max_size:int = max_size
+        self.max_wait:float = max_wait
+        self._items:list = []
+        self._lock = Lock()
+        self._timer:Timer = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def add(self, item) -> None:
+        '''Adds an item to the current group, flushing it if it is full.'''
+        batch:list = None
+        with self._lock:
+            self._items.append(item)
+            if len(self._items) >= self.max_size:
+                batch = self._take_batch()
+            elif self._timer is None:
+                self._timer = Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        # Flush outside of the lock so other threads can keep adding while we talk to AWS
+        if batch:
+            self.flush_function(batch)
+
+    def flush(self) -> None:
+        '''Flushes whatever is in the current group, if anything.'''
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self.flush_function(batch)
+
+    def _take_batch(self) -> list:
+        '''Empties the current group and returns it. Must be called while holding the lock.'''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._items
+        self._items = []
+        return batch
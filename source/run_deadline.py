@@ -0,0 +1,39 @@
+'''Keeps a time-boxed run (--max-runtime) from starting work it can't finish before its deadline.'''
+
+from time import monotonic
+
+# Weight of the newest batch in the expected batch time. High enough to catch up quickly when
+# batches slow down near the end of a run.
+BATCH_TIME_SMOOTHING = 0.3
+
+class RunDeadline():
+    '''The end of a run, and how long a batch of work (fetching requests and processing them) is
+    expected to take, as a moving average of the batches recorded so far.
+    '''
+    def __init__(self, seconds:float) -> None:
+        self.deadline:float = monotonic() + seconds
+        self.expected_batch:float = None
+
+    def remaining(self) -> float:
+        '''Returns how long (in seconds) until the deadline, never less than 0.'''
+        return max(self.deadline - monotonic(), 0)
+
+    def expired(self) -> bool:
+        return monotonic() >= self.deadline
+
+    def record_batch(self, seconds:float) -> None:
+        '''Adds how long a batch took to the expected batch time.'''
+        if self.expected_batch is None:
+            self.expected_batch = seconds
+        else:
+            self.expected_batch += BATCH_TIME_SMOOTHING * (seconds - self.expected_batch)
+
+    def fetch_budget(self) -> float:
+        '''Returns how long (in seconds) fetching the next batch can take and still leave time to
+        process it. Negative once there is no time for another batch.
+        '''
+        return self.remaining() - (self.expected_batch or 0)
+
+    def should_fetch(self) -> bool:
+        '''Returns whether there is time left to fetch and process another batch.'''
+        return not self.expired() and self.fetch_budget() > 0
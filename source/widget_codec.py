@@ -0,0 +1,20 @@
+'''Parses request bodies and encodes widgets as JSON, using orjson when it is installed.'''
+
+from json import dumps as json_dumps, loads as json_loads
+
+try:
+    import orjson
+except ImportError: # Only needed for faster JSON
+    orjson = None
+
+def loads(body:bytes | str):
+    '''Parses JSON.'''
+    if orjson is not None:
+        return orjson.loads(body)
+    return json_loads(body)
+
+def dumps(value) -> bytes:
+    '''Encodes value as compact UTF-8 JSON.'''
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json_dumps(value, separators=(',', ':'), ensure_ascii=False).encode()
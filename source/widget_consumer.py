@@ -1,24 +1,156 @@
 from argparse import ArgumentParser
 from boto3 import client, resource
 from botocore.exceptions import ClientError
-from json import dumps, loads
-from logging import basicConfig, INFO
+from collections import deque
+from collections.abc import Collection
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count
+from logging import INFO
+from multiprocessing import get_context
+from queue import Empty, Queue
+from random import uniform
+from signal import SIG_IGN, SIGINT, signal
+from threading import BoundedSemaphore, Event, Lock, Thread
 from time import sleep
 from timeit import default_timer
-from queue import Queue
+from zlib import crc32
 
+from request_batcher import RequestBatcher
+from run_deadline import RunDeadline
 from widget_app_base import WidgetAppBase
+from widget_idempotency import DynamoDBIdempotencyStore, IdempotencyStore
+from widget_logging import SamplingFilter, start_queue_logging
+from widget_metrics import MetricsRegistry, start_metrics_server
+from widget_request import WidgetRequest
+from widget_retry import DeadLetterSink, FileDeadLetterSink, RetryScheduler, SQSDeadLetterSink
+from widget_store import (FanOutWidgetStore, WIDGET_STORES, WidgetStore,
+                          WriteSuppressingWidgetStore)
+from widget_tracing import ConsumerProfiler, RequestTrace, RequestTracer
 
 DEBUG_LEVEL = INFO
+# delete_message_batch and change_message_visibility_batch accept at most 10 entries per call
+MAX_ACK_BATCH_SIZE = 10
+# list_objects_v2 returns at most 1000 keys per call
+MAX_REQUEST_BUCKET_PAGE_SIZE = 1000
+# BatchWriteItem accepts at most 25 items per call
+MAX_DYNAMODB_BATCH_SIZE = 25
+# 16^8 shards is already far more than S3 will ever split a bucket into
+MAX_WIDGET_KEY_SHARD_LENGTH = 8
+# Metrics the consumer records
+STAGE_SECONDS = 'widget_consumer_stage_seconds'
+MESSAGES_RECEIVED = 'widget_consumer_messages_received_total'
+REQUESTS_PROCESSED = 'widget_consumer_requests_processed_total'
+MESSAGES_ACKED = 'widget_consumer_messages_acked_total'
+WORKER_RESTARTS = 'widget_consumer_worker_restarts_total'
+WRITES_SUPPRESSED = 'widget_consumer_writes_suppressed_total'
+DUPLICATES_SKIPPED = 'widget_consumer_duplicates_skipped_total'
+RETRIES_SCHEDULED = 'widget_consumer_retries_total'
+DEAD_LETTERED = 'widget_consumer_dead_lettered_total'
+INVALID_MESSAGES = 'widget_consumer_invalid_messages_total'
+# Lines logged for every request (or every empty poll), sampled by type when logging
+RECEIVED_LOG = { 'sample': 'received' }
+PROCESSING_LOG = { 'sample': 'processing' }
+PROCESSED_LOG = { 'sample': 'processed' }
+IDLE_LOG = { 'sample': 'idle' }
+# Requests handed to worker processes but not yet written, across all of them. Enough for each
+# process to fill a batch while its last one is being written.
+PROCESS_QUEUE_DEPTH = 100
+# How often (in seconds) worker processes send their metrics and are checked for crashes
+PROCESS_REPORT_INTERVAL = 1
+# Longest time (in seconds) to wait for a worker process to finish before killing it
+PROCESS_STOP_TIMEOUT = 30
+# What worker processes send back to the supervisor
+PROCESS_RESULT = 'result'
+PROCESS_METRICS = 'metrics'
+
+def widget_partition(widget_id:str, partitions:int) -> int:
+    '''Picks the partition (worker process) for a widget. crc32 is used instead of hash() since
+    string hashes change between runs.
+    '''
+    return crc32(str(widget_id).encode()) % partitions
 
 class WidgetConsumer(WidgetAppBase):
     def __init__(self) -> None:
         super().__init__()
-        basicConfig(filename='log/consumer.log', level=DEBUG_LEVEL)
         self.logger.name = 'consumer_logger'
+        self.log_sampler:SamplingFilter = start_queue_logging('log/consumer.log', DEBUG_LEVEL,
+                                                              self.logger)
         # Only instantiate this if needed
         self.request_queue:Queue = None 
-        self.receipt_handle_queue:Queue = None
+        self.ack_batcher:RequestBatcher = None
+        # Queue messages received but not yet deleted, by receipt handle. The heartbeat keeps
+        # these hidden from other consumers until we are done with them.
+        self.in_flight_messages:dict[str, WidgetRequest] = {}
+        self.in_flight_lock = Lock()
+        self.heartbeat_thread:Thread = None
+        self.heartbeat_stop = Event()
+        # Every configured store by name, and the one (or fan out) widgets are written to
+        self.widget_stores:dict[str, WidgetStore] = {}
+        self.widget_store:WidgetStore = None
+        # Only instantiate this if the widget store writes in batches
+        self.store_batcher:RequestBatcher = None
+        # Keys listed from the request bucket but not yet fetched, and the last key listed
+        self.request_key_buffer:deque[str] = deque()
+        self.request_bucket_cursor:str = None
+        # Failed attempts to read request objects, by key, and the keys given up on
+        self.request_key_attempts:dict[str, int] = {}
+        self.skipped_request_keys:set[str] = set()
+        self.request_key_lock = Lock()
+        # Only created when reading ahead from the request bucket
+        self.prefetch_pool:ThreadPoolExecutor = None
+        self.prefetched_requests:deque[Future] = deque()
+        self.metrics = MetricsRegistry()
+        self.metrics.describe(STAGE_SECONDS, 'Time spent in each stage of handling a request')
+        self.metrics.describe(MESSAGES_RECEIVED, 'Requests received from the request bucket/queue')
+        self.metrics.describe(REQUESTS_PROCESSED, 'Requests written to the widget store')
+        self.metrics.describe(MESSAGES_ACKED, 'Requests removed from the request bucket/queue')
+        self.metrics.describe(WRITES_SUPPRESSED, 'Updates not written since nothing changed')
+        self.metrics.describe(DUPLICATES_SKIPPED, 'Requests already processed that were skipped')
+        # Only created when asked to skip requests that were already processed
+        self.idempotency:IdempotencyStore = None
+        # Failed requests waiting to be tried again, and where the ones that keep failing go
+        self.retries:RetryScheduler = None
+        self.dead_letter:DeadLetterSink = None
+        self.metrics.describe(RETRIES_SCHEDULED, 'Failed requests scheduled to be tried again')
+        self.metrics.describe(DEAD_LETTERED, 'Requests dead-lettered after using up their attempts')
+        self.metrics.describe(INVALID_MESSAGES, 'Requests received that were not valid')
+        self.metrics_server = None
+        # Only created when asked to profile or trace the consumer
+        self.profiler:ConsumerProfiler = None
+        self.tracer:RequestTracer = None
+        # Set to ask a running consume_requests to wrap up and return
+        self.stopping = Event()
+        # Only created for runs with a max_runtime. When the batch being processed was fetched.
+        self.deadline:RunDeadline = None
+        self.batch_started:float = None
+        # Current idle backoff (in milliseconds). 0 means we are not backing off.
+        self.idle_delay:int = 0
+        # Only created when running with --workers
+        self.worker_pool:ThreadPoolExecutor = None
+        self.worker_slots:BoundedSemaphore = None
+        # Used instead of the worker pool for FIFO queues. Each lane runs one request at a time,
+        # so the requests of a message group (always sent to the same lane) stay in order.
+        self.worker_lanes:list[ThreadPoolExecutor] = []
+        self.fifo_queue:bool = False
+        # Message groups with a request that failed since their messages were last received.
+        # The rest of their requests are left for redelivery so they are not written out of order.
+        self.failed_groups:set[str] = set()
+        # Counts the batches of messages received. Worker processes hold back a failed group's
+        # requests from the same batch, and take its requests from a later one as redelivered.
+        self.receive_batch:int = 0
+        self.failed_group_batches:dict[str, int] = {}
+        # Only created when running with --processes. Each worker process has its own queue of
+        # requests to write, and the requests it has not reported back on by sequence number.
+        self.process_context = None
+        self.worker_processes:list = []
+        self.process_queues:list = []
+        self.process_pending:list[dict[int, WidgetRequest]] = []
+        self.process_lock = Lock()
+        self.process_sequence = count()
+        self.process_results = None
+        self.process_collector:Thread = None
+        self.next_process_check:float = 0
+        self.metrics.describe(WORKER_RESTARTS, 'Worker processes restarted after crashing')
 
     def get_consumer_parser(self) -> ArgumentParser:
         '''Returns the parser for the consumer'''
@@ -30,8 +162,9 @@ class WidgetConsumer(WidgetAppBase):
                             action='store',
                             type=int,
                             default=0,
-                            help='Maximum runtime in milliseconds. 0 means no maximum ' + 
-                                '(default: %(default)s)')
+                            help='Maximum runtime in milliseconds. No more requests are ' +
+                                'fetched once there is not enough time left to process them. ' +
+                                '0 means no maximum (default: %(default)s)')
         parser.add_argument('-wb', '--widget-bucket',
                             action='store',
                             type=str,
@@ -42,11 +175,51 @@ class WidgetConsumer(WidgetAppBase):
                             type=str,
                             default='widgets/',
                             help='Prefix for widget objects in S3 (default: %(default)s)')
+        parser.add_argument('-wksl', '--widget-key-shard-length',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Hex characters of a hash of the widgetId to put in front of ' +
+                                'widget keys in S3, up to 8. 0 does not shard keys. Move existing ' +
+                                'widgets with widget_key_migration.py first ' +
+                                '(default: %(default)s)')
         parser.add_argument('-dwt', '--dynamodb-widget-table',
                             action='store',
                             type=str,
                             default=None,
                             help='Name of DynamoDB table that holds widgets (default: %(default)s)')
+        parser.add_argument('-fo', '--fan-out',
+                            action='store_true',
+                            default=False,
+                            help='Write widgets to every configured store in parallel instead ' +
+                                'of only the first one (default: %(default)s)')
+        parser.add_argument('-wcs', '--write-cache-size',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Number of recently written widgets to remember so updates that ' +
+                                'change nothing are acked without a write. Only use when one ' +
+                                'consumer writes each widget. 0 writes every update ' +
+                                '(default: %(default)s)')
+        parser.add_argument('-iw', '--idempotency-window',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Time (in seconds) to remember processed requestIds for, so ' +
+                                'requests delivered again are skipped. 0 does not remember them ' +
+                                '(default: %(default)s)')
+        parser.add_argument('-ic', '--idempotency-capacity',
+                            action='store',
+                            type=int,
+                            default=100000,
+                            help='Most processed requestIds to remember in memory ' +
+                                '(default: %(default)s)')
+        parser.add_argument('-it', '--idempotency-table',
+                            action='store',
+                            type=str,
+                            default=None,
+                            help='DynamoDB table (keyed by requestId) to share processed ' +
+                                'requestIds between consumers in (default: %(default)s)')
         parser.add_argument('-pdbc', '--pdb-conn',
                             action='store',
                             type=str,
@@ -62,6 +235,29 @@ class WidgetConsumer(WidgetAppBase):
                             type=str,
                             default=None,
                             help='Postgres Database password (default: %(default)s)')
+        parser.add_argument('-pdbt', '--pdb-table',
+                            action='store',
+                            type=str,
+                            default='widgets',
+                            help='Postgres Database table that holds widgets (default: %(default)s)')
+        parser.add_argument('-pdbps', '--pdb-pool-size',
+                            action='store',
+                            type=int,
+                            default=4,
+                            help='Most Postgres Database connections to keep open ' +
+                                '(default: %(default)s)')
+        parser.add_argument('-pdbbs', '--pdb-batch-size',
+                            action='store',
+                            type=int,
+                            default=100,
+                            help='Most widgets to write to the Postgres Database in one ' +
+                                'transaction (default: %(default)s)')
+        parser.add_argument('-pdbbi', '--pdb-batch-interval',
+                            action='store',
+                            type=int,
+                            default=100,
+                            help='Longest time (in milliseconds) a widget waits to be written ' +
+                                'to the Postgres Database (default: %(default)s)')
         parser.add_argument('-qwt', '--queue-wait-timeout',
                             action='store',
                             type=int,
@@ -75,6 +271,152 @@ class WidgetConsumer(WidgetAppBase):
                             default=2,
                             help='The duration (in seconds) to the messages received from the ' + 
                                 'queue are hidden from others (default: %(default)s)')
+        parser.add_argument('-rbps', '--request-bucket-page-size',
+                            action='store',
+                            type=int,
+                            default=MAX_REQUEST_BUCKET_PAGE_SIZE,
+                            help='Number of request keys to list from the request bucket at a ' +
+                                'time, up to 1000 (default: %(default)s)')
+        parser.add_argument('-pf', '--prefetch',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Number of requests to read ahead from the request bucket. ' +
+                                '0 reads each request when it is needed (default: %(default)s)')
+        parser.add_argument('-cr', '--coalesce-requests',
+                            action='store_true',
+                            default=False,
+                            help='Only write the last request for each widget in a batch of ' +
+                                'queue messages (default: %(default)s)')
+        parser.add_argument('-cw', '--coalesce-window',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Time (in milliseconds) to keep receiving queue messages into ' +
+                                'one batch when coalescing requests (default: %(default)s)')
+        parser.add_argument('-abs', '--ack-batch-size',
+                            action='store',
+                            type=int,
+                            default=MAX_ACK_BATCH_SIZE,
+                            help='Number of processed queue messages to delete in a single ' +
+                                'call, up to 10 (default: %(default)s)')
+        parser.add_argument('-afi', '--ack-flush-interval',
+                            action='store',
+                            type=int,
+                            default=500,
+                            help='Longest time (in milliseconds) a processed queue message waits ' +
+                                'to be deleted (default: %(default)s)')
+        parser.add_argument('-dbs', '--dynamodb-batch-size',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Number of creates/updates to write to DynamoDB in a single ' +
+                                'batch, up to 25. 0 writes each widget on its own ' +
+                                '(default: %(default)s)')
+        parser.add_argument('-dbi', '--dynamodb-batch-interval',
+                            action='store',
+                            type=int,
+                            default=100,
+                            help='Longest time (in milliseconds) a widget waits to be written ' +
+                                'in a DynamoDB batch (default: %(default)s)')
+        parser.add_argument('-ibmin', '--idle-backoff-min',
+                            action='store',
+                            type=int,
+                            default=10,
+                            help='First backoff (in milliseconds) when there are no requests or ' +
+                                'a request fails (default: %(default)s)')
+        parser.add_argument('-ibmax', '--idle-backoff-max',
+                            action='store',
+                            type=int,
+                            default=5000,
+                            help='Longest backoff (in milliseconds) when there are no requests ' +
+                                'or requests keep failing (default: %(default)s)')
+        parser.add_argument('-rma', '--retry-max-attempts',
+                            action='store',
+                            type=int,
+                            default=3,
+                            help='Times to try writing a request before giving up on it. Failed ' +
+                                'requests are retried in the background while other requests ' +
+                                'keep being processed. 1 does not retry. FIFO queues leave ' +
+                                'retrying to SQS (default: %(default)s)')
+        parser.add_argument('-rbd', '--retry-base-delay',
+                            action='store',
+                            type=int,
+                            default=100,
+                            help='Time (in milliseconds) to wait before the first retry. It ' +
+                                'doubles with every attempt (default: %(default)s)')
+        parser.add_argument('-rmd', '--retry-max-delay',
+                            action='store',
+                            type=int,
+                            default=10000,
+                            help='Longest time (in milliseconds) to wait between retries ' +
+                                '(default: %(default)s)')
+        parser.add_argument('-dlf', '--dead-letter-file',
+                            action='store',
+                            type=str,
+                            default=None,
+                            help='File to append requests that used up their attempts to, with ' +
+                                'their error, as NDJSON (default: %(default)s)')
+        parser.add_argument('-dlq', '--dead-letter-queue',
+                            action='store',
+                            type=str,
+                            default=None,
+                            help='URL of queue to send requests that used up their attempts to, ' +
+                                'with their error (default: %(default)s)')
+        parser.add_argument('-mp', '--metrics-port',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Port to serve Prometheus metrics on at /metrics. 0 does not ' +
+                                'serve metrics (default: %(default)s)')
+        parser.add_argument('-mh', '--metrics-host',
+                            action='store',
+                            type=str,
+                            default='127.0.0.1',
+                            help='Address to serve Prometheus metrics on (default: %(default)s)')
+        parser.add_argument('-w', '--workers',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Number of worker threads processing requests. 0 processes ' +
+                                'requests on the consume loop (default: %(default)s)')
+        parser.add_argument('-pr', '--processes',
+                            action='store',
+                            type=int,
+                            default=0,
+                            help='Number of worker processes writing widgets, picked by widgetId. ' +
+                                'The consume loop only receives and acks requests. 0 does not ' +
+                                'start any (default: %(default)s)')
+        parser.add_argument('-po', '--profile-output',
+                            action='store',
+                            type=str,
+                            default=None,
+                            help='File to write cProfile stats of the consume loop to on exit or ' +
+                                'on SIGUSR1 (default: %(default)s)')
+        parser.add_argument('-to', '--trace-output',
+                            action='store',
+                            type=str,
+                            default=None,
+                            help='File to append sampled per-request stage timings to as NDJSON ' +
+                                '(default: %(default)s)')
+        parser.add_argument('-tsr', '--trace-sample-rate',
+                            action='store',
+                            type=float,
+                            default=0.01,
+                            help='Fraction of requests to trace when trace-output is set ' +
+                                '(default: %(default)s)')
+        parser.add_argument('-lse', '--log-sample-every',
+                            action='store',
+                            type=int,
+                            default=1,
+                            help='Only log 1 in this many of the lines logged for every ' +
+                                'request (default: %(default)s)')
+        parser.add_argument('-lrl', '--log-rate-limit',
+                            action='store',
+                            type=int,
+                            default=10,
+                            help='Most of each line logged for every request to write per ' +
+                                'second. 0 does not limit them (default: %(default)s)')
         self.logger.debug('Consumer argument options added! Returning parser.')
         
         return parser
@@ -94,6 +436,22 @@ class WidgetConsumer(WidgetAppBase):
             self.logger.error('no widget save location was set before trying to use.')
             raise ValueError('widget-bucket, dynamodb-widget-table, or pdb-conn must be set in ' +
                 'to use WidgetConsumer!')
+        if args.widget_key_shard_length < 0 or \
+           args.widget_key_shard_length > MAX_WIDGET_KEY_SHARD_LENGTH:
+            self.logger.error('widget_key_shard_length tried to be set outside of 0-8')
+            raise ValueError('widget_key_shard_length must be between 0 and 8!')
+        if args.write_cache_size < 0:
+            self.logger.error('write_cache_size tried to be set as negative for some reason')
+            raise ValueError('write_cache_size cannot be negative!')
+        if args.idempotency_window < 0:
+            self.logger.error('idempotency_window tried to be set as negative for some reason')
+            raise ValueError('idempotency_window cannot be negative!')
+        if args.idempotency_capacity < 1:
+            self.logger.error('idempotency_capacity tried to be set below 1')
+            raise ValueError('idempotency_capacity must be at least 1!')
+        if args.idempotency_table is not None and args.idempotency_window == 0:
+            self.logger.error('idempotency_table was set without an idempotency_window')
+            raise ValueError('idempotency_window must be set to use idempotency_table!')
         if args.request_bucket is not None and args.request_queue is not None:
             self.logger.error('Both a request bucket and request queue were specified!')
             raise Exception('Both a request bucket and request queue have been specified.' +
@@ -105,6 +463,76 @@ class WidgetConsumer(WidgetAppBase):
             self.logger.error('queue_visibility_timeout tried to be set as negative ' +
                 'for some reason')
             raise ValueError()
+        if args.request_bucket_page_size < 1 or \
+           args.request_bucket_page_size > MAX_REQUEST_BUCKET_PAGE_SIZE:
+            self.logger.error('request_bucket_page_size tried to be set outside of 1-1000')
+            raise ValueError('request_bucket_page_size must be between 1 and 1000!')
+        if args.prefetch < 0:
+            self.logger.error('prefetch tried to be set as negative for some reason')
+            raise ValueError('prefetch cannot be negative!')
+        if args.coalesce_window < 0:
+            self.logger.error('coalesce_window tried to be set as negative for some reason')
+            raise ValueError('coalesce_window cannot be negative!')
+        if args.ack_batch_size < 1 or args.ack_batch_size > MAX_ACK_BATCH_SIZE:
+            self.logger.error('ack_batch_size tried to be set outside of 1-10')
+            raise ValueError('ack_batch_size must be between 1 and 10!')
+        if args.ack_flush_interval < 0:
+            self.logger.error('ack_flush_interval tried to be set as negative for some reason')
+            raise ValueError('ack_flush_interval cannot be negative!')
+        if args.dynamodb_batch_size < 0 or args.dynamodb_batch_size > MAX_DYNAMODB_BATCH_SIZE:
+            self.logger.error('dynamodb_batch_size tried to be set outside of 0-25')
+            raise ValueError('dynamodb_batch_size must be between 0 and 25!')
+        if args.dynamodb_batch_interval < 0:
+            self.logger.error('dynamodb_batch_interval tried to be set as negative for some reason')
+            raise ValueError('dynamodb_batch_interval cannot be negative!')
+        if args.pdb_pool_size < 1:
+            self.logger.error('pdb_pool_size tried to be set below 1')
+            raise ValueError('pdb_pool_size must be at least 1!')
+        if args.pdb_batch_size < 1:
+            self.logger.error('pdb_batch_size tried to be set below 1')
+            raise ValueError('pdb_batch_size must be at least 1!')
+        if args.pdb_batch_interval < 0:
+            self.logger.error('pdb_batch_interval tried to be set as negative for some reason')
+            raise ValueError('pdb_batch_interval cannot be negative!')
+        if args.idle_backoff_min < 1:
+            self.logger.error('idle_backoff_min tried to be set below 1')
+            raise ValueError('idle_backoff_min must be at least 1!')
+        if args.idle_backoff_max < args.idle_backoff_min:
+            self.logger.error('idle_backoff_max tried to be set below idle_backoff_min')
+            raise ValueError('idle_backoff_max cannot be less than idle_backoff_min!')
+        if args.retry_max_attempts < 1:
+            self.logger.error('retry_max_attempts tried to be set below 1')
+            raise ValueError('retry_max_attempts must be at least 1!')
+        if args.retry_base_delay < 0:
+            self.logger.error('retry_base_delay tried to be set as negative for some reason')
+            raise ValueError('retry_base_delay cannot be negative!')
+        if args.retry_max_delay < args.retry_base_delay:
+            self.logger.error('retry_max_delay tried to be set below retry_base_delay')
+            raise ValueError('retry_max_delay cannot be less than retry_base_delay!')
+        if args.dead_letter_file is not None and args.dead_letter_queue is not None:
+            self.logger.error('Both a dead-letter file and dead-letter queue were specified!')
+            raise ValueError('dead_letter_file and dead_letter_queue cannot be used together!')
+        if args.metrics_port < 0 or args.metrics_port > 65535:
+            self.logger.error('metrics_port tried to be set outside of 0-65535')
+            raise ValueError('metrics_port must be between 0 and 65535!')
+        if args.workers < 0:
+            self.logger.error('workers tried to be set as negative for some reason')
+            raise ValueError('workers cannot be negative!')
+        if args.processes < 0:
+            self.logger.error('processes tried to be set as negative for some reason')
+            raise ValueError('processes cannot be negative!')
+        if args.workers > 0 and args.processes > 0:
+            self.logger.error('Both workers and processes were specified!')
+            raise ValueError('workers and processes cannot be used together!')
+        if args.trace_sample_rate <= 0 or args.trace_sample_rate > 1:
+            self.logger.error('trace_sample_rate tried to be set outside of (0, 1]')
+            raise ValueError('trace_sample_rate must be above 0 and at most 1!')
+        if args.log_sample_every < 1:
+            self.logger.error('log_sample_every tried to be set below 1')
+            raise ValueError('log_sample_every must be at least 1!')
+        if args.log_rate_limit < 0:
+            self.logger.error('log_rate_limit tried to be set as negative for some reason')
+            raise ValueError('log_rate_limit cannot be negative!')
         
         return True
 
@@ -115,149 +543,1021 @@ class WidgetConsumer(WidgetAppBase):
         '''
         if self.request_bucket is not None or self.widget_bucket is not None:
             self.aws_s3 = client('s3', region_name=self.region)
+        if self.request_bucket is not None and self.prefetch > 0:
+            self.prefetch_pool = ThreadPoolExecutor(max_workers=self.prefetch,
+                                                    thread_name_prefix='widget-prefetch')
         if self.request_queue_url is not None:
             self.aws_sqs_queue = client('sqs', region_name=self.region)
+            # SQS requires FIFO queue names to end in .fifo
+            self.fifo_queue = self.request_queue_url.endswith('.fifo')
             # Guess we need the queue after all!
             self.request_queue = Queue()
-            self.receipt_handle_queue = Queue()
+            self.ack_batcher = RequestBatcher(self._delete_requests_from_queue,
+                                              self.ack_batch_size,
+                                              self.ack_flush_interval / 1000)
+
+        if self.processes == 0: # Worker processes create their own
+            self._create_store_clients()
+        if self.idempotency_window > 0:
+            self._create_idempotency_store()
+        self._create_retry_scheduler()
+
+    def _create_retry_scheduler(self) -> None:
+        '''Creates the scheduler failed requests wait in for their next attempt, and the sink for
+        requests that use up their attempts if one was given.
+        '''
+        self.retries = RetryScheduler(self.retry_max_attempts, self.retry_base_delay / 1000,
+                                      self.retry_max_delay / 1000)
+        if self.dead_letter_queue is not None:
+            sqs = getattr(self, 'aws_sqs_queue', None) or client('sqs', region_name=self.region)
+            self.dead_letter = SQSDeadLetterSink(sqs, self.dead_letter_queue)
+        elif self.dead_letter_file is not None:
+            self.dead_letter = FileDeadLetterSink(self.dead_letter_file)
 
+    def _create_idempotency_store(self) -> None:
+        '''Creates the store of processed requestIds, shared through DynamoDB if given a table.'''
+        if self.idempotency_table is None:
+            self.idempotency = IdempotencyStore(self.idempotency_window, self.idempotency_capacity)
+            return
+        table = resource('dynamodb', region_name=self.region).Table(self.idempotency_table)
+        self.idempotency = DynamoDBIdempotencyStore(table, self.idempotency_window,
+                                                    self.idempotency_capacity)
+
+    def _create_store_clients(self) -> None:
+        '''Creates the clients for the widget stores and then the stores. Widgets in S3 share the
+        client of the request bucket if there is one.
+        '''
+        if self.widget_bucket is not None and getattr(self, 'aws_s3', None) is None:
+            self.aws_s3 = client('s3', region_name=self.region)
         if self.dynamodb_widget_table is not None:
             self.aws_dynamodb = resource('dynamodb', region_name=self.region)
             self.aws_dynamodb_table = self.aws_dynamodb.Table(self.dynamodb_widget_table)
 
+        self._create_widget_stores()
+
+    def _create_widget_stores(self) -> None:
+        '''Builds every store the consumer was configured with from the store registry. Widgets
+        are written to the first one, or to all of them in parallel when fanning out.
+        '''
+        for name, store_class in WIDGET_STORES.items():
+            store:WidgetStore = store_class.create(self)
+            if store is not None:
+                self.widget_stores[name] = store
+        if not self.widget_stores:
+            return
+
+        stores:list[WidgetStore] = list(self.widget_stores.values())
+        if self.fan_out and len(stores) > 1:
+            self.widget_store = FanOutWidgetStore(stores, self.workers)
+        else:
+            self.widget_store = stores[0]
+        self.logger.info('Writing widgets to %s', self.widget_store.name)
+        if self.write_cache_size > 0:
+            self.widget_store = WriteSuppressingWidgetStore(self.widget_store,
+                                                            self.write_cache_size,
+                                                            self._count_suppressed)
+
+        if self.widget_store.batch_size > 0:
+            self.store_batcher = RequestBatcher(self._write_widget_batch,
+                                                self.widget_store.batch_size,
+                                                self.widget_store.batch_interval / 1000)
+
     def save_arguments(self, args: object) -> bool:
         '''Saves the arguments to WidgetConsumer to be used when running.'''
         self._save_base_arguments(args)
         
         self.logger.debug('Saving WidgetConsumer arguments...')
+        self.arguments = args # Handed to worker processes so they can set themselves up
         self.widget_bucket:str = args.widget_bucket
         self.widget_key_prefix:str = args.widget_key_prefix
+        self.widget_key_shard_length:int = args.widget_key_shard_length
         self.dynamodb_widget_table:str = args.dynamodb_widget_table
         self.pdb_conn:str = args.pdb_conn
         self.pdb_username = args.pdb_username
         self.pdb_password = args.pdb_password
+        self.pdb_table:str = args.pdb_table
+        self.pdb_pool_size:int = args.pdb_pool_size
+        self.pdb_batch_size:int = args.pdb_batch_size
+        self.pdb_batch_interval:int = args.pdb_batch_interval
+        self.fan_out:bool = args.fan_out
+        self.write_cache_size:int = args.write_cache_size
+        self.idempotency_window:int = args.idempotency_window
+        self.idempotency_capacity:int = args.idempotency_capacity
+        self.idempotency_table:str = args.idempotency_table
         self.queue_wait_timeout = args.queue_wait_timeout
         self.queue_visibility_timeout = args.queue_visibility_timeout
+        self.request_bucket_page_size:int = args.request_bucket_page_size
+        self.prefetch:int = args.prefetch
+        self.coalesce_requests:bool = args.coalesce_requests
+        self.coalesce_window:int = args.coalesce_window
+        self.ack_batch_size:int = args.ack_batch_size
+        self.ack_flush_interval:int = args.ack_flush_interval
+        self.dynamodb_batch_size:int = args.dynamodb_batch_size
+        self.dynamodb_batch_interval:int = args.dynamodb_batch_interval
+        self.idle_backoff_min:int = args.idle_backoff_min
+        self.idle_backoff_max:int = args.idle_backoff_max
+        self.retry_max_attempts:int = args.retry_max_attempts
+        self.retry_base_delay:int = args.retry_base_delay
+        self.retry_max_delay:int = args.retry_max_delay
+        self.dead_letter_file:str = args.dead_letter_file
+        self.dead_letter_queue:str = args.dead_letter_queue
+        self.metrics_port:int = args.metrics_port
+        self.metrics_host:str = args.metrics_host
+        self.workers:int = args.workers
+        self.processes:int = args.processes
+        self.profile_output:str = args.profile_output
+        self.trace_output:str = args.trace_output
+        self.trace_sample_rate:float = args.trace_sample_rate
+        self.log_sampler.sample_every = args.log_sample_every
+        self.log_sampler.rate_limit = args.log_rate_limit
         self.logger.debug('WidgetConsumer arguments saved!')
 
         return True
 
     def consume_requests(self):
         '''Runner for Consumer. Consumes requests as they come in.'''
+        if self.profile_output is not None:
+            self.profiler = ConsumerProfiler(self.profile_output)
+            self.profiler.start()
+        if self.trace_output is not None:
+            self.tracer = RequestTracer(self.trace_output, self.trace_sample_rate)
         self._create_service_clients()
-        start_time = default_timer()
-
+        self._start_worker_pool()
+        self._start_worker_processes()
+        self._start_heartbeat()
+        if self.metrics_port != 0:
+            self.metrics_server = start_metrics_server(self.metrics, self.metrics_port,
+                                                       self.metrics_host)
+            self.logger.info('Serving metrics on %s:%d', self.metrics_host, self.metrics_port)
         # Assume we are not suppose to be running forever unless otherwise specified
-        infinite_runtime:bool = True if self.max_runtime == 0 else False
+        if self.max_runtime != 0:
+            self.deadline = RunDeadline(self.max_runtime / 1000)
         done:bool = False
 
         self.logger.info('Consumer ready. Waiting for requests...')
-        while not done:
+        try:
+            while not done and not self.stopping.is_set():
+                try:
+                    if self.worker_processes:
+                        self._check_worker_processes()
+                    request = self._next_retry()
+                    if request is None:
+                        if self._fetching() and not self._start_batch():
+                            done = True # No time to process another batch before the deadline
+                            continue
+                        request = self._receive_request()
+                    if request is None:
+                        self.batch_started = None # Nothing to time
+                        self._wait_for_requests()
+                    else:
+                        self._trace(request, 'dispatch')
+                        if self._skip_duplicate(request):
+                            self._reset_backoff()
+                        elif self.worker_processes:
+                            self._submit_to_process(request)
+                            self._reset_backoff()
+                        elif self.worker_pool is not None or self.worker_lanes:
+                            self._submit_request(request)
+                            self._reset_backoff()
+                        elif self._process_and_acknowledge(request):
+                            self._reset_backoff()
+                        elif request.attempts == 0: # The retry scheduler paces the others
+                            self._back_off()
+                except ValueError:
+                    continue # Error already logged somewhere, continue on
+                except KeyboardInterrupt:
+                    self.logger.info('\nCtrl+C detected. Shutting Down consumer...')
+                    return
+                except Exception as e: # Keep going, one bad request shouldn't stop the consumer
+                    self.logger.error('Unexpected error while consuming requests: %s', e,
+                                      exc_info=e)
+                    self._back_off()
+                
+                # Consumer is only suppose to run until max_runtime is hit (unless infinite)
+                if self.deadline is not None and self.deadline.expired():
+                    self.logger.info('Max runtime reached. Shutting down consumer...')
+                    done = True
+        finally:
+            self._stop_worker_pool()
+            self._stop_worker_processes()
+            self._stop_prefetch_pool()
+            if self.store_batcher is not None:
+                self.store_batcher.flush()
+            if self.widget_store is not None:
+                self.widget_store.close()
+            self._drop_retries()
+            if self.ack_batcher is not None:
+                self.ack_batcher.flush()
+            if self.dead_letter is not None:
+                self.dead_letter.close()
+                self.dead_letter = None
+            if self.idempotency is not None:
+                self.idempotency.close()
+            self._stop_heartbeat()
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+                self.metrics_server.server_close() # Frees the port for the next run
+                self.metrics_server = None
+            if self.tracer is not None:
+                self.tracer.close()
+                self.tracer = None
+            if self.profiler is not None:
+                self.profiler.stop()
+                self.profiler = None
+
+    def _fetching(self) -> bool:
+        '''Returns whether getting the next request fetches more from the request bucket/queue,
+        rather than handing out one of the queue messages already received.
+        '''
+        return self.request_queue is None or self.request_queue.empty()
+
+    def _start_batch(self) -> bool:
+        '''Records how long the last batch took and returns whether there is still time to fetch
+        and process another before the deadline.
+        '''
+        if self.deadline is None:
+            return True
+        now:float = default_timer()
+        if self.batch_started is not None:
+            self.deadline.record_batch(now - self.batch_started)
+        if not self.deadline.should_fetch():
+            self.logger.info('%.3f seconds left, not enough for another batch (about %.3f ' +
+                             'seconds). Finishing up...', self.deadline.remaining(),
+                             self.deadline.expected_batch or 0)
+            self.batch_started = None
+            return False
+        self.batch_started = now
+        return True
+
+    def stop(self) -> None:
+        '''Asks a running consume_requests (e.g. on another thread) to finish the request it is on,
+        flush anything batched, and return.
+        '''
+        self.stopping.set()
+
+    def _receive_request(self) -> WidgetRequest:
+        '''Gets the next new request, or None if there are none, and starts its trace if it was
+        sampled. Requests from the request bucket are deleted from it as soon as they are received.
+        '''
+        trace:RequestTrace = None if self.tracer is None else self.tracer.start()
+        request = self._get_request()
+        if request is None:
+            return None
+        if trace is not None:
+            trace.mark('receive')
+            request.trace = trace
+        self.logger.info('Received request of type %s: %s', request.type,
+                         request.request_id, extra=RECEIVED_LOG)
+        if self.request_bucket is not None:
+            self._delete_object_S3(self.request_bucket, request.bucket_key)
+        return request
+
+    def _next_retry(self) -> WidgetRequest:
+        '''Returns a failed request whose next attempt is due, or None if none are.'''
+        if self.retries is None:
+            return None
+        request:WidgetRequest = self.retries.pop_due()
+        if request is None:
+            return None
+        if self.tracer is not None:
+            request.trace = self.tracer.start()
+        self.logger.info('Retrying request %s (attempt %d)', request.request_id,
+                         request.attempts + 1)
+        return request
+
+    def _drop_retries(self) -> None:
+        '''Gives up on the requests still waiting to be retried when the consumer stops. Requests
+        from the request bucket were deleted when they were received, so they are put back.
+        '''
+        if self.retries is None:
+            return
+        requests:list[WidgetRequest] = self.retries.drain()
+        if not requests:
+            return
+
+        self.logger.info('Dropping %d requests waiting to be retried', len(requests))
+        if self.request_bucket is None:
+            return
+        for request in requests:
             try:
-                request = self._get_request()
-                if request['type'] != 'unknown':
-                    self.logger.info('Received request of type %s: %s', request['type'], 
-                                     request['requestId'])
-                if self.request_bucket is not None:
-                    self._delete_object_S3(self.request_bucket, request['request-bucket-key'])
-                if self.process_request(request):
-                    self.logger.info(f'{request['type']} request processed successfully')
-                    if self.request_queue_url is not None:
-                        self._delete_request_from_queue()
-                else:
-                    sleep(.01) # 100 milliseconds
-            except ValueError:
-                continue # Error already logged somewhere, continue on
-            except KeyboardInterrupt:
-                self.logger.info('\nCtrl+C detected. Shutting Down consumer...')
-                return
-            except Exception as e: # Some unknown error occured, do not continue running!
-                self.logger.error(e)
+                self.aws_s3.put_object(Bucket=self.request_bucket, Key=request.bucket_key,
+                                       Body=request.encoded_widget())
+            except Exception as e:
+                self.logger.error('Failed to put request %s back in the request bucket: %s',
+                                  request.request_id, e)
+
+    def _wait_for_requests(self) -> None:
+        '''Called when there were no requests to get. The queue already waited for messages
+        with long polling, so only back off when polling the bucket or short polling the queue.
+        '''
+        if self.request_queue_url is not None and self._receive_wait_time() > 0:
+            return
+        self._back_off()
+
+    def _receive_wait_time(self) -> int:
+        '''Returns how long (in seconds) to long poll the request queue for, cut short when a
+        retry is due sooner or the run is near its deadline.
+        '''
+        wait_time:int = self.queue_wait_timeout
+        next_due:float = None if self.retries is None else self.retries.next_due()
+        if next_due is not None:
+            wait_time = min(wait_time, int(next_due))
+        if self.deadline is not None: # Leave time to process whatever the poll returns
+            wait_time = min(wait_time, int(self.deadline.fetch_budget()))
+        return max(wait_time, 0)
+
+    def _back_off(self) -> None:
+        '''Sleeps before looking for more work. The delay doubles every time we back off in a row,
+        up to idle_backoff_max, and is jittered so idle consumers don't poll in lockstep.
+        '''
+        if self.idle_delay == 0:
+            self.logger.info('No work to do. Backing off until requests show up...')
+        delay:int = max(self.idle_delay, self.idle_backoff_min)
+        pause:float = uniform(delay / 2, delay) / 1000
+        next_due:float = None if self.retries is None else self.retries.next_due()
+        if next_due is not None:
+            pause = min(pause, next_due)
+        if self.deadline is not None:
+            pause = min(pause, self.deadline.remaining())
+        sleep(pause)
+        self.idle_delay = min(delay * 2, self.idle_backoff_max)
+
+    def _reset_backoff(self) -> None:
+        '''Goes back to polling right away now that there is work to do.'''
+        if self.idle_delay != 0:
+            self.logger.info('Requests found. No longer backing off.')
+            self.idle_delay = 0
+
+    def _process_and_acknowledge(self, request:WidgetRequest) -> bool:
+        '''Processes a single request and, if it succeeded, queues its message up to be removed
+        from the request queue.
+        '''
+        if self._skip_failed_group(request):
+            return False
+        if self.store_batcher is not None:
+            # Acknowledged once the batch holding it has been written
+            self._trace(request, 'batch')
+            self.store_batcher.add(request)
+            return True
+
+        try:
+            processed:bool = self.process_request(request)
+        except Exception as e:
+            self.logger.error('Failed to process request %s: %s', request.request_id, e)
+            self._trace(request, 'store')
+            self._fail_request(request, 'error', str(e))
+            return False
+        self._trace(request, 'store')
+        if not processed:
+            self._fail_request(request, 'failure', self._write_failed_error())
+            return False
+
+        self.logger.info('%s request processed successfully', request.type,
+                         extra=PROCESSED_LOG)
+        self._acknowledge_request(request)
+        return True
+
+    def _skip_failed_group(self, request:WidgetRequest) -> bool:
+        '''Leaves a request for redelivery if an earlier request in its message group failed.
+        Returns whether it was skipped.
+        '''
+        if request.message_group_id not in self.failed_groups:
+            return False
+        self.logger.info('Skipping request %s, an earlier request in its group failed',
+                         request.request_id)
+        self._forget_request(request)
+        self._finish_trace(request, 'skipped')
+        return True
+
+    def _fail_request(self, request:WidgetRequest, result:str, error:str = None) -> None:
+        '''Schedules a request that could not be written to be tried again, or dead-letters it
+        once it has used up its attempts. FIFO requests are left for redelivery instead.
+        '''
+        if request.message_group_id is not None:
+            self.failed_groups.add(request.message_group_id)
+        elif self.retries is not None and self.retries.schedule(request):
+            self.logger.warning('Request %s failed (attempt %d), retrying it later: %s',
+                                request.request_id, request.attempts, error)
+            self.metrics.increment(RETRIES_SCHEDULED)
+            self._finish_trace(request, 'retry')
+            return # Still in flight, the heartbeat keeps its message hidden until it is retried
+        elif self._dead_letter(request, error):
+            return
+        self._forget_request(request)
+        self._finish_trace(request, result)
+
+    def _dead_letter(self, request:WidgetRequest, error:str) -> bool:
+        '''Sends a request that used up its attempts to the dead-letter sink and acks it, so it
+        stops coming back. Returns whether it was dead-lettered.
+        '''
+        if self.dead_letter is None:
+            self.logger.error('Giving up on request %s after %d attempts: %s',
+                              request.request_id, request.attempts, error)
+            return False
+        if not self.dead_letter.send(request, error):
+            return False
+        self.logger.error('Dead-lettered request %s after %d attempts: %s', request.request_id,
+                          request.attempts, error)
+        self.metrics.increment(DEAD_LETTERED, sink=self.dead_letter.name)
+        self._acknowledge_request(request, 'dead-letter')
+        return True
+
+    def _write_failed_error(self) -> str:
+        '''The error dead-lettered with a request the widget store did not write. The store has
+        already logged why.
+        '''
+        return f'{self.widget_store.name} did not write the widget'
+
+    def _skip_duplicate(self, request:WidgetRequest) -> bool:
+        '''Acknowledges a request without processing it if it was already processed. Returns
+        whether it was skipped.
+        '''
+        if self.idempotency is None or request.request_id is None or \
+           not self.idempotency.seen(request.request_id):
+            return False
+        self.logger.info('Request %s was already processed, skipping it', request.request_id)
+        self.metrics.increment(DUPLICATES_SKIPPED)
+        self._acknowledge_request(request)
+        return True
+
+    def _acknowledge_request(self, request:WidgetRequest, result:str = 'success') -> None:
+        '''Queues the message of a processed request up to be removed from the request queue.
+        Requests from the request bucket were already removed when they were received.
+        '''
+        if self.ack_batcher is not None:
+            self.ack_batcher.add(request)
+            for coalesced_request in request.coalesced_requests:
+                self.ack_batcher.add(coalesced_request)
+        if self.idempotency is not None:
+            for processed in [request, *request.coalesced_requests]:
+                if processed.request_id is not None:
+                    self.idempotency.record(processed.request_id)
+        self._trace(request, 'ack')
+        self._finish_trace(request, result)
+
+    def _trace(self, request:WidgetRequest, stage:str) -> None:
+        '''Marks the end of a stage if the request is being traced.'''
+        if self.tracer is not None and request.trace is not None:
+            request.trace.mark(stage)
+
+    def _finish_trace(self, request:WidgetRequest, result:str) -> None:
+        '''Writes out the trace of a request that is done, if it is being traced.'''
+        if self.tracer is None or request.trace is None:
+            return
+        trace:RequestTrace = request.trace
+        request.trace = None
+        self.tracer.finish(trace, request, result)
+
+    def _start_worker_pool(self) -> None:
+        '''Creates the worker pool if the consumer was asked to run with workers. FIFO queues get
+        a lane per worker instead.
+        '''
+        if self.workers == 0:
+            return
+
+        self.logger.info('Starting %d workers...', self.workers)
+        if self.fifo_queue:
+            self.worker_lanes = [ThreadPoolExecutor(max_workers=1,
+                                                    thread_name_prefix=f'widget-worker-{index}')
+                                 for index in range(self.workers)]
+        else:
+            self.worker_pool = ThreadPoolExecutor(max_workers=self.workers,
+                                                  thread_name_prefix='widget-worker')
+        self.worker_slots = BoundedSemaphore(self.workers * 2)
+
+    def _submit_request(self, request:WidgetRequest) -> Future:
+        '''Hands a request to the worker pool, or to the lane for its message group. Blocks while
+        the pool is full.
+        '''
+        executor:ThreadPoolExecutor = self.worker_pool
+        if self.worker_lanes:
+            executor = self.worker_lanes[widget_partition(request.partition_key,
+                                                          len(self.worker_lanes))]
+        self.worker_slots.acquire()
+        try:
+            future = executor.submit(self._process_and_acknowledge, request)
+        except BaseException:
+            self.worker_slots.release()
+            raise
+        future.add_done_callback(self._request_done)
+        return future
+
+    def _request_done(self, future:Future) -> None:
+        '''Frees the worker slot of a finished request and logs anything that went wrong.'''
+        self.worker_slots.release()
+        error = future.exception()
+        if error is not None:
+            self.logger.error('Worker failed to process request: %s', error)
+
+    def _stop_worker_pool(self) -> None:
+        '''Waits for the requests already handed to the workers to finish, then shuts the pool
+        down. Requests still sitting in the request queue are left for redelivery.
+        '''
+        if self.worker_pool is None and not self.worker_lanes:
+            return
+
+        self.logger.info('Waiting for workers to finish...')
+        for executor in [self.worker_pool, *self.worker_lanes]:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self.worker_pool = None
+        self.worker_lanes = []
+        self.worker_slots = None
+        self.logger.info('Workers stopped.')
+
+    def _start_worker_processes(self) -> None:
+        '''Starts the worker processes if the consumer was asked to run with them. They are
+        spawned rather than forked so each one starts its own logging thread and AWS clients.
+        '''
+        if self.processes == 0:
+            return
+
+        self.logger.info('Starting %d worker processes...', self.processes)
+        self.process_context = get_context('spawn')
+        self.process_results = self.process_context.Queue()
+        self.worker_slots = BoundedSemaphore(self.processes * PROCESS_QUEUE_DEPTH)
+        self.worker_processes = [None] * self.processes
+        self.process_queues = [None] * self.processes
+        self.process_pending = [{} for _ in range(self.processes)]
+        for index in range(self.processes):
+            self._start_worker_process(index)
+        self.process_collector = Thread(target=self._collect_process_results,
+                                        name='widget-process-results', daemon=True)
+        self.process_collector.start()
+
+    def _start_worker_process(self, index:int) -> None:
+        '''Starts (or restarts) the worker process for a partition with a fresh request queue. A
+        crashed process may have left its old queue locked.
+        '''
+        self.process_queues[index] = self.process_context.Queue()
+        process = self.process_context.Process(target=_run_worker_process,
+                                               args=(self.arguments, index,
+                                                     self.process_queues[index],
+                                                     self.process_results),
+                                               name=f'widget-worker-{index}', daemon=True)
+        process.start()
+        self.worker_processes[index] = process
+
+    def _submit_to_process(self, request:WidgetRequest) -> None:
+        '''Hands a request to the worker process for its widget. Blocks while every slot is taken,
+        checking on the processes so a crashed one can't hold the slots forever.
+        '''
+        if self._skip_failed_group(request):
+            return
+        index:int = widget_partition(request.partition_key, self.processes)
+        while not self.worker_slots.acquire(timeout=PROCESS_REPORT_INTERVAL):
+            self._check_worker_processes()
+        with self.process_lock:
+            sequence:int = next(self.process_sequence)
+            self.process_pending[index][sequence] = request
+            self._send_to_process(index, sequence, request)
+
+    def _send_to_process(self, index:int, sequence:int, request:WidgetRequest) -> None:
+        '''Puts a request on a worker process's queue with its message group and the batch of
+        messages it came in, so the process can hold back the rest of a group after a failure.
+        '''
+        self.process_queues[index].put((sequence, request.encoded_widget(),
+                                        request.message_group_id, self.receive_batch))
+
+    def _collect_process_results(self) -> None:
+        '''Handles what the worker processes send back until told to stop with None.'''
+        while True:
+            message:tuple = self.process_results.get()
+            if message is None:
                 return
-            
-            # Consumer is only suppose to run until max_runtime is hit (unless infinite)
-            current_runtime = (default_timer() - start_time) * 1000
-            if not infinite_runtime and current_runtime < self.max_runtime:
-                done = True
+            try:
+                self._handle_process_message(message)
+            except Exception as e: # Keep collecting, the other results still need acking
+                self.logger.error('Failed to handle worker process result: %s', e)
+
+    def _handle_process_message(self, message:tuple) -> None:
+        '''Merges metrics from a worker process, or acks (or forgets) a request it is done with.'''
+        if message[0] == PROCESS_METRICS:
+            self.metrics.merge(message[2])
+            return
+
+        _, index, sequence, written, error = message
+        with self.process_lock:
+            request:WidgetRequest = self.process_pending[index].pop(sequence, None)
+        if request is None: # Already reported by the process before it was restarted
+            return
+        self.worker_slots.release()
+        self._trace(request, 'store')
+        if not written: # Our widget store is in the worker process, so it sent the error
+            self._fail_request(request, 'failure', error)
+            return
+        self.logger.info('%s request processed successfully', request.type, extra=PROCESSED_LOG)
+        self._acknowledge_request(request)
+
+    def _check_worker_processes(self) -> None:
+        '''Restarts any worker process that died, at most once every PROCESS_REPORT_INTERVAL.
+        Whatever it had not reported back on is sent again, in order, to the new process.
+        '''
+        now:float = default_timer()
+        if now < self.next_process_check:
+            return
+        self.next_process_check = now + PROCESS_REPORT_INTERVAL
+
+        for index, process in enumerate(self.worker_processes):
+            if process.is_alive():
+                continue
+            self.logger.error('Worker process %d exited with code %s. Restarting it...', index,
+                              process.exitcode)
+            self.metrics.increment(WORKER_RESTARTS)
+            with self.process_lock:
+                self._start_worker_process(index)
+                pending:list[tuple[int, WidgetRequest]] = sorted(self.process_pending[index].items())
+                for sequence, request in pending:
+                    self._send_to_process(index, sequence, request)
+            if pending:
+                self.logger.info('Resent %d requests to worker process %d', len(pending), index)
+
+    def _stop_worker_processes(self) -> None:
+        '''Lets every worker process finish the requests it was sent, then stops them. Requests a
+        process never reported back on are forgotten so they are redelivered.
+        '''
+        if not self.worker_processes:
+            return
+
+        self.logger.info('Waiting for worker processes to finish...')
+        for queue in self.process_queues:
+            queue.put(None)
+        for process in self.worker_processes:
+            process.join(PROCESS_STOP_TIMEOUT)
+            if process.is_alive():
+                self.logger.warning('Worker process %s did not stop in time. Killing it...',
+                                    process.name)
+                process.kill()
+                process.join()
+        # Everything the processes sent is ahead of this, so nothing is left behind
+        self.process_results.put(None)
+        self.process_collector.join()
 
-    def _get_request(self) -> dict:
+        for pending in self.process_pending:
+            for request in pending.values():
+                self._forget_request(request)
+                self._finish_trace(request, 'failure')
+        self.worker_processes = []
+        self.process_queues = []
+        self.process_pending = []
+        self.process_results = None
+        self.process_collector = None
+        self.worker_slots = None
+        self.logger.info('Worker processes stopped.')
+
+    def _serve_partition(self, index:int, requests, results) -> None:
+        '''Runs in a worker process. Writes the requests the supervisor sends, in batches, until it
+        sends None, reporting back whether each one was written.
+        '''
+        batch_size:int = max(self.widget_store.batch_size, 1)
+        last_report:float = default_timer()
+        done:bool = False
+        while not done:
+            batch:list[tuple[int, bytes, str, int]] = []
+            try:
+                item:tuple = requests.get(timeout=PROCESS_REPORT_INTERVAL)
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        break
+                    item = requests.get_nowait()
+                done = item is None
+            except Empty:
+                pass
+            if batch:
+                self._write_partition_batch(index, batch, results)
+
+            if done or default_timer() - last_report >= PROCESS_REPORT_INTERVAL:
+                metrics, self.metrics = self.metrics, MetricsRegistry()
+                results.put((PROCESS_METRICS, index, metrics))
+                last_report = default_timer()
+
+    def _write_partition_batch(self, index:int, batch:list[tuple[int, bytes, str, int]],
+                               results) -> None:
+        '''Decodes and writes a batch of (sequence, body, message group, receive batch) sent by
+        the supervisor and reports back on each one, with the error for the ones not written.
+        '''
+        requests:list[WidgetRequest] = []
+        for _, body, group_id, receive_batch in batch:
+            if self.failed_group_batches.get(group_id, receive_batch) < receive_batch:
+                # Received again since it failed, so this is its redelivery
+                del self.failed_group_batches[group_id]
+            requests.append(WidgetRequest.decode(body, message_group_id=group_id))
+        written, error = self._write_widgets(requests, self.failed_group_batches)
+
+        written_ids:set[int] = { id(request) for request in written }
+        for (sequence, _, group_id, receive_batch), request in zip(batch, requests):
+            was_written:bool = id(request) in written_ids
+            if not was_written and group_id is not None:
+                self.failed_group_batches[group_id] = receive_batch
+            self._count_processed(request, was_written)
+            results.put((PROCESS_RESULT, index, sequence, was_written,
+                         None if was_written else error))
+
+    def _get_request(self) -> WidgetRequest:
         '''Retrieves the request from either an S3 bucket or a queue. If both are setup, defaults
-        to using the bucket and not the queue.
+        to using the bucket and not the queue. Returns None if there are no requests.
         '''
         if self.request_bucket is not None:
             return self._get_request_s3()
         if self.request_queue_url is not None:
             return self._get_request_queue()
         
-        # Something wacky happened. Returning default dict
+        # Something wacky happened. Returning no request
         self.logger.warning('Some unknown error happened when getting a request. ' + 
-                            'Returning empty request dict.')
-        return { 'type': 'unknown' } # Take advantage of our error handling above
+                            'Returning no request.')
+        return None # Take advantage of our error handling above
 
-    def _get_request_s3(self) -> dict:
-        '''Retrieves a Widget request from S3'''
+    def _get_request_s3(self) -> WidgetRequest:
+        '''Retrieves a Widget request from S3. Keys that are already gone (another consumer got to
+        them first) are passed over for the next one.
+        '''
         try:
-            # Get the first object key in the bucket since we don't know it
-            response = self.aws_s3.list_objects_v2(Bucket=self.request_bucket, MaxKeys=1)
-            key = response['Contents'][0]['Key']
-            self.logger.debug('Found widget key: %s', key)
-            
-            # Now that we have the key, get the actual request and return it
-            self.logger.debug('Getting object using key: %s', key)
-            response = self.aws_s3.get_object(Bucket=self.request_bucket, Key=key)
-            request = loads(response["Body"].read())
-            request['request-bucket-key'] = key
-            return request
-        except KeyError:
-            self.logger.warning('No requests found. Please wait until some more are complete')
+            while True:
+                if self.prefetch_pool is not None:
+                    fetched:Future = self._next_prefetched_request_s3()
+                    if fetched is None:
+                        break
+                    request:WidgetRequest = fetched.result()
+                else:
+                    key = self._next_request_key()
+                    if key is None:
+                        break
+                    request = self._fetch_request_s3(key)
+                if request is not None:
+                    return request
+            self.logger.debug('No requests found. Please wait until some more are complete',
+                              extra=IDLE_LOG)
         except Exception as e:
             self.logger.warning('Issue when getting request from s3: %s', e)
         
-        return { 'type': 'unknown' }
+        return None
 
-    def _get_request_queue(self) -> dict:
-        '''Retrieves a request from the queue'''
-        if not self.request_queue.empty(): # We are single-threaded for now, so this is ok.
-            return self.request_queue.get()
+    def _fetch_request_s3(self, key:str) -> WidgetRequest:
+        '''Gets and decodes the request stored under the given key in the request bucket. Returns
+        None if it is already gone, is not a valid request, or could not be read in time.
+        '''
+        self.logger.debug('Getting object using key: %s', key)
+        try:
+            with self.metrics.time(STAGE_SECONDS, stage='receive', backend='s3'):
+                response = self.aws_s3.get_object(Bucket=self.request_bucket, Key=key)
+                body:bytes = response["Body"].read()
+        except Exception as e:
+            if isinstance(e, ClientError) and e.response['Error']['Code'] == 'NoSuchKey':
+                self.logger.debug('Request %s is already gone, skipping it', key)
+                return None
+            if self._fail_request_key(key, str(e)):
+                return None
+            raise
+        if self.request_key_attempts:
+            with self.request_key_lock:
+                self.request_key_attempts.pop(key, None)
+        self.metrics.increment(MESSAGES_RECEIVED, backend='s3')
+        try:
+            with self.metrics.time(STAGE_SECONDS, stage='decode', backend='s3'):
+                return WidgetRequest.decode(body, bucket_key=key)
+        except ValueError as e:
+            self._handle_invalid_object(key, body, str(e))
+            return None
+
+    def _fail_request_key(self, key:str, error:str) -> bool:
+        '''Counts a failed attempt to read a request object. Once it has used up its attempts it is
+        dead-lettered by key and skipped from then on. Returns whether it was given up on.
+        '''
+        with self.request_key_lock:
+            attempts:int = self.request_key_attempts.get(key, 0) + 1
+            if attempts < self.retry_max_attempts:
+                self.request_key_attempts[key] = attempts
+                return False
+            self.request_key_attempts.pop(key, None)
+            self.skipped_request_keys.add(key)
+
+        if self.dead_letter is not None and \
+           self.dead_letter.send_invalid(None, key, error, attempts=attempts):
+            self.logger.error('Dead-lettered request %s after %d attempts to read it: %s', key,
+                              attempts, error)
+            self.metrics.increment(DEAD_LETTERED, sink=self.dead_letter.name)
+        else:
+            self.logger.error('Giving up on request %s after %d attempts to read it: %s', key,
+                              attempts, error)
+        return True
+
+    def _handle_invalid_object(self, key:str, body:bytes, error:str) -> None:
+        '''Dead-letters a request object that is not a valid request, with why, and deletes it from
+        the request bucket. Without a dead-letter sink it is only deleted.
+        '''
+        if self.dead_letter is None:
+            self.logger.warning('Deleting request %s, not a valid request: %s', key, error)
+            self.metrics.increment(INVALID_MESSAGES, result='deleted')
+        elif self.dead_letter.send_invalid(body.decode(errors='replace'), key, error):
+            self.logger.error('Dead-lettered request %s, not a valid request: %s', key, error)
+            self.metrics.increment(INVALID_MESSAGES, result='dead-letter')
+            self.metrics.increment(DEAD_LETTERED, sink=self.dead_letter.name)
+        else:
+            return # Left in the bucket to be dead-lettered next time it is read
+        self._delete_object_S3(self.request_bucket, key)
 
-        response:dict = self.aws_sqs_queue.receive_message(
-            QueueUrl=self.request_queue_url,
-            MaxNumberOfMessages=10,
-            VisibilityTimeout=self.queue_visibility_timeout,
-            WaitTimeSeconds=self.queue_wait_timeout
-        )
+    def _next_prefetched_request_s3(self) -> Future:
+        '''Returns the oldest request being read ahead, first topping the read ahead back up to
+        prefetch requests in flight. Returns None if there is nothing left to read.
+        '''
+        while len(self.prefetched_requests) < self.prefetch:
+            # Only list again once everything read ahead has been handed out (and deleted), so
+            # a listing can never return a key that is still in flight.
+            if not self.request_key_buffer and self.prefetched_requests:
+                break
+            key = self._next_request_key()
+            if key is None:
+                break
+            self.prefetched_requests.append(self.prefetch_pool.submit(self._fetch_request_s3, key))
 
-        if 'Messages' not in response.keys():
-            return { 'type': 'unknown' }
+        if not self.prefetched_requests:
+            return None
+        return self.prefetched_requests.popleft()
+
+    def _stop_prefetch_pool(self) -> None:
+        '''Drops any requests still being read ahead. Their objects are still in the request
+        bucket, so they will be picked up again next time.
+        '''
+        if self.prefetch_pool is None:
+            return
 
-        for message in response['Messages']:
-            self.request_queue.put(loads(message["Body"]))
-            self.receipt_handle_queue.put(message['ReceiptHandle'])
+        self.prefetch_pool.shutdown(wait=True, cancel_futures=True)
+        self.prefetch_pool = None
+        self.prefetched_requests.clear()
 
+    def _next_request_key(self) -> str:
+        '''Returns the next request key from the key buffer, listing another page of keys from the
+        request bucket once the buffer is empty. Returns None if the bucket has no requests.
+        '''
+        if not self.request_key_buffer:
+            self._list_request_keys()
+        if not self.request_key_buffer:
+            return None
+        
+        key = self.request_key_buffer.popleft()
+        self.logger.debug('Found widget key: %s', key)
+        return key
+
+    def _list_request_keys(self) -> None:
+        '''Lists the next page of request keys into the key buffer, starting after the last key
+        listed. Starts over from the top once the end of the bucket is reached.
+        '''
+        arguments:dict = { 'Bucket': self.request_bucket, 'MaxKeys': self.request_bucket_page_size }
+        if self.request_bucket_cursor is not None:
+            arguments['StartAfter'] = self.request_bucket_cursor
+
+        self.logger.debug('Listing request keys after: %s', self.request_bucket_cursor)
+        with self.metrics.time(STAGE_SECONDS, stage='list', backend='s3'):
+            response:dict = self.aws_s3.list_objects_v2(**arguments)
+        keys:list[str] = [item['Key'] for item in response.get('Contents', [])]
+
+        if not keys and self.request_bucket_cursor is not None:
+            self.request_bucket_cursor = None
+            return self._list_request_keys()
+        
+        if keys:
+            self.request_bucket_cursor = keys[-1]
+        self.request_key_buffer.extend(key for key in keys if key not in self.skipped_request_keys)
+
+    def _get_request_queue(self) -> WidgetRequest:
+        '''Retrieves a request from the queue. Messages that are not valid requests are left in
+        the queue.
+        '''
+        if not self.request_queue.empty(): # Only the consume loop reads, so this is ok.
+            return self.request_queue.get()
+
+        # Anything processed from the last batch should be written and deleted before we wait
+        if self.store_batcher is not None:
+            self.store_batcher.flush()
+        self.ack_batcher.flush()
+        messages:list[dict] = self._receive_messages()
+        if not messages:
+            return None
+
+        self.receive_batch += 1
+        requests:list[WidgetRequest] = []
+        for message in messages:
+            group_id:str = message.get('Attributes', {}).get('MessageGroupId')
+            # SQS only hands out more of a group once its earlier messages are done with, so
+            # anything held back after a failure has been redelivered
+            self.failed_groups.discard(group_id)
+            try:
+                with self.metrics.time(STAGE_SECONDS, stage='decode', backend='sqs'):
+                    requests.append(WidgetRequest.decode(message['Body'],
+                                                         receipt_handle=message['ReceiptHandle'],
+                                                         message_group_id=group_id))
+            except ValueError as e:
+                self._handle_invalid_message(message, str(e))
+        with self.in_flight_lock:
+            for request in requests:
+                self.in_flight_messages[request.receipt_handle] = request
+        if self.coalesce_requests:
+            requests = self._coalesce_requests(requests)
+
+        for request in requests:
+            self.request_queue.put(request)
+        if self.request_queue.empty(): # Everything cancelled out, nothing to write
+            return None
         return self.request_queue.get()
 
-    def _delete_request(self, request:dict) -> bool:
+    def _receive_messages(self) -> list[dict]:
+        '''Receives the next batch of messages from the request queue. When coalescing with a
+        window, keeps receiving whatever is already waiting until the window closes.
+        '''
+        arguments:dict = { 'QueueUrl': self.request_queue_url, 'MaxNumberOfMessages': 10,
+                           'VisibilityTimeout': self.queue_visibility_timeout }
+        if self.fifo_queue:
+            arguments['MessageSystemAttributeNames'] = ['MessageGroupId']
+        with self.metrics.time(STAGE_SECONDS, stage='receive', backend='sqs'):
+            response:dict = self.aws_sqs_queue.receive_message(
+                WaitTimeSeconds=self._receive_wait_time(), **arguments
+            )
+        messages:list[dict] = response.get('Messages', [])
+        if messages and self.coalesce_requests and self.coalesce_window > 0:
+            window:float = self.coalesce_window / 1000
+            if self.deadline is not None: # Don't receive more than there is time to process
+                window = min(window, self.deadline.fetch_budget())
+            window_end = default_timer() + window
+            while default_timer() < window_end:
+                with self.metrics.time(STAGE_SECONDS, stage='receive', backend='sqs'):
+                    response = self.aws_sqs_queue.receive_message(WaitTimeSeconds=0,
+                                                                  **arguments)
+                if 'Messages' not in response.keys():
+                    break
+                messages.extend(response['Messages'])
+
+        if messages:
+            self.metrics.increment(MESSAGES_RECEIVED, len(messages), backend='sqs')
+        return messages
+
+    def _handle_invalid_message(self, message:dict, error:str) -> None:
+        '''Dead-letters a queue message that is not a valid request, with why, and deletes it.
+        Without a dead-letter sink it is only counted and left in the queue.
+        '''
+        group_id:str = message.get('Attributes', {}).get('MessageGroupId')
+        if self.dead_letter is None or \
+           not self.dead_letter.send_invalid(message['Body'], message.get('MessageId'), error,
+                                             group_id):
+            self.logger.warning('Skipping message %s, not a valid request: %s',
+                                message.get('MessageId'), error)
+            self.metrics.increment(INVALID_MESSAGES, result='skipped')
+            return
+
+        self.logger.error('Dead-lettered message %s, not a valid request: %s',
+                          message.get('MessageId'), error)
+        self.metrics.increment(INVALID_MESSAGES, result='dead-letter')
+        self.metrics.increment(DEAD_LETTERED, sink=self.dead_letter.name)
+        self._delete_request_from_queue(message['ReceiptHandle'])
+
+    def _coalesce_requests(self, requests:list[WidgetRequest]) -> list[WidgetRequest]:
+        '''Collapses a batch of requests down to the last request for each widget. The requests
+        it replaces ride along in coalesced_requests so they are acked with it.
+        '''
+        latest:dict = {}
+        for request in requests:
+            widget_id = request.widget_id
+            previous:WidgetRequest = latest.pop(widget_id, None)
+            if previous is not None:
+                chain:list[WidgetRequest] = previous.coalesced_requests + [previous]
+                previous.coalesced_requests = []
+                if chain[0].type == 'create' and request.type == 'delete':
+                    self.logger.debug('Widget %s created and deleted in one batch', widget_id)
+                    for cancelled_request in chain + [request]:
+                        self._acknowledge_request(cancelled_request)
+                    continue
+                request.coalesced_requests = chain
+            latest[widget_id] = request
+
+        if len(latest) != len(requests):
+            self.logger.info('Coalesced %d requests into %d', len(requests), len(latest))
+        return list(latest.values())
+
+    def _delete_request(self, request:WidgetRequest) -> bool:
         '''Deletes the request from dynamodb or the queue depending on what is being used.'''
         if self.request_bucket is not None:
-            return self._delete_object_S3(self.request_bucket, request['request-bucket-key'])
+            return self._delete_object_S3(self.request_bucket, request.bucket_key)
         if self.request_queue_url is not None:
-            return self._delete_request_from_queue()
+            return self._delete_request_from_queue(request.receipt_handle)
         
     def _delete_object_S3(self, bucket:str, key:str) -> bool:
         '''Actual implementation for any delete requests to an S3 bucket.'''
         try:
             self.logger.debug('Deleting Request: %s', key)
-            self.aws_s3.delete_object(Bucket=bucket,Key=key)
+            with self.metrics.time(STAGE_SECONDS, stage='ack', backend='s3'):
+                self.aws_s3.delete_object(Bucket=bucket,Key=key)
             self.logger.debug('Request Deleted!')
         except Exception as e:
             self.logger.error(e)
+            self.metrics.increment(MESSAGES_ACKED, backend='s3', result='failure')
             return False
         
+        self.metrics.increment(MESSAGES_ACKED, backend='s3', result='success')
         return True
     
-    def _delete_request_from_queue(self) -> bool:
+    def _delete_request_from_queue(self, receipt_handle:str) -> bool:
+        '''Removes a processed message from the request queue using its receipt handle.'''
         try:
-            receipt_handle:str = self.receipt_handle_queue.get()
             self.logger.debug('deleting message: %s', receipt_handle)
             self.aws_sqs_queue.delete_message(
                 QueueUrl=self.request_queue_url,
@@ -269,93 +1569,267 @@ class WidgetConsumer(WidgetAppBase):
         
         return True
 
-    def process_request(self, request:dict) -> bool:
+    def _delete_requests_from_queue(self, requests:list[WidgetRequest]) -> bool:
+        '''Removes a batch of processed messages (up to 10) from the request queue in a single
+        call. Every message that could not be deleted is logged.
+        '''
+        entries:list[dict] = [{ 'Id': str(index), 'ReceiptHandle': request.receipt_handle }
+                              for index, request in enumerate(requests)]
+        try:
+            self.logger.debug('deleting %d messages', len(entries))
+            with self.metrics.time(STAGE_SECONDS, stage='ack', backend='sqs'):
+                response:dict = self.aws_sqs_queue.delete_message_batch(
+                    QueueUrl=self.request_queue_url,
+                    Entries=entries
+                )
+        except ClientError as e:
+            self.logger.error('Failed to delete %d messages: %s', len(entries), e)
+            self.metrics.increment(MESSAGES_ACKED, len(entries), backend='sqs', result='failure')
+            return False
+        finally:
+            # Deleted or not, these are done with. Failed ones come back after their timeout.
+            with self.in_flight_lock:
+                for entry in entries:
+                    self.in_flight_messages.pop(entry['ReceiptHandle'], None)
+
+        for failure in response.get('Failed', []):
+            request:WidgetRequest = requests[int(failure['Id'])]
+            self.logger.error('Failed to delete message for request %s: %s',
+                              request.request_id, failure.get('Message', failure['Code']))
+        failed:int = len(response.get('Failed', []))
+        self.metrics.increment(MESSAGES_ACKED, len(entries) - failed, backend='sqs',
+                               result='success')
+        if failed:
+            self.metrics.increment(MESSAGES_ACKED, failed, backend='sqs', result='failure')
+        return failed == 0
+
+    def _forget_request(self, request:WidgetRequest) -> None:
+        '''Stops keeping a request that failed hidden, so it is redelivered once its visibility
+        timeout runs out.
+        '''
+        if self.ack_batcher is None:
+            return
+        with self.in_flight_lock:
+            for forgotten in [request, *request.coalesced_requests]:
+                self.in_flight_messages.pop(forgotten.receipt_handle, None)
+
+    def _start_heartbeat(self) -> None:
+        '''Starts the thread that keeps in-flight queue messages hidden. It runs twice per
+        visibility timeout so messages are extended well before they would expire.
+        '''
+        if self.request_queue_url is None or self.queue_visibility_timeout == 0:
+            return
+
+        self.heartbeat_stop.clear()
+        self.heartbeat_thread = Thread(target=self._run_heartbeat, name='widget-heartbeat',
+                                       daemon=True)
+        self.heartbeat_thread.start()
+
+    def _run_heartbeat(self) -> None:
+        '''Extends the visibility of every in-flight message until told to stop.'''
+        while not self.heartbeat_stop.wait(self.queue_visibility_timeout / 2):
+            try:
+                self._extend_visibility()
+            except Exception as e: # Keep the heartbeat going, the next beat may work
+                self.logger.warning('Heartbeat failed to extend visibility: %s', e)
+
+    def _extend_visibility(self) -> None:
+        '''Resets the visibility timeout of every in-flight message. Messages SQS will not extend
+        (usually because they were just deleted) are no longer tracked.
+        '''
+        with self.in_flight_lock:
+            receipt_handles:list[str] = list(self.in_flight_messages.keys())
+        if not receipt_handles:
+            return
+
+        self.logger.debug('Extending visibility of %d messages', len(receipt_handles))
+        failed:list[str] = self._change_visibility(receipt_handles, self.queue_visibility_timeout)
+        with self.in_flight_lock:
+            for receipt_handle in failed:
+                self.in_flight_messages.pop(receipt_handle, None)
+
+    def _stop_heartbeat(self) -> None:
+        '''Stops the heartbeat and releases every message we never finished with, so other
+        consumers can pick them up right away instead of waiting out the visibility timeout.
+        '''
+        if self.heartbeat_thread is not None:
+            self.heartbeat_stop.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+        if self.request_queue_url is None:
+            return
+
+        with self.in_flight_lock:
+            receipt_handles:list[str] = list(self.in_flight_messages.keys())
+            self.in_flight_messages.clear()
+        if receipt_handles:
+            self.logger.info('Releasing %d unprocessed messages', len(receipt_handles))
+            self._change_visibility(receipt_handles, 0)
+
+    def _change_visibility(self, receipt_handles:list[str], timeout:int) -> list[str]:
+        '''Changes the visibility timeout of the messages, 10 at a time. Returns the receipt
+        handles of the messages that could not be changed.
+        '''
+        failed:list[str] = []
+        for start in range(0, len(receipt_handles), MAX_ACK_BATCH_SIZE):
+            batch:list[str] = receipt_handles[start:start + MAX_ACK_BATCH_SIZE]
+            entries:list[dict] = [{ 'Id': str(index), 'ReceiptHandle': receipt_handle,
+                                    'VisibilityTimeout': timeout }
+                                  for index, receipt_handle in enumerate(batch)]
+            try:
+                response:dict = self.aws_sqs_queue.change_message_visibility_batch(
+                    QueueUrl=self.request_queue_url,
+                    Entries=entries
+                )
+            except ClientError as e:
+                self.logger.warning('Failed to change visibility of %d messages: %s',
+                                    len(entries), e)
+                failed += batch
+                continue
+
+            for failure in response.get('Failed', []):
+                self.logger.debug('Failed to change visibility of message: %s',
+                                  failure.get('Message', failure['Code']))
+                failed.append(batch[int(failure['Id'])])
+        return failed
+
+    def process_request(self, request:WidgetRequest) -> bool:
         '''Processes any create, update, or delete requests. Raises a ValueError if a request is not
         one of those three.
         '''
-        if request['type'] == 'create':
-            self.logger.info('Request type is create. Creating widget...')
+        if request.type == 'create':
+            self.logger.info('Request type is create. Creating widget...', extra=PROCESSING_LOG)
             return self.update_widget(request)
-        if request['type'] == 'update':
-            self.logger.info('Request type is update. Updating widget...')
+        if request.type == 'update':
+            self.logger.info('Request type is update. Updating widget...', extra=PROCESSING_LOG)
             return self.update_widget(request)
-        if request['type'] == 'delete':
-            self.logger.info('Request type is delete. Deleting widget...')
+        if request.type == 'delete':
+            self.logger.info('Request type is delete. Deleting widget...', extra=PROCESSING_LOG)
             return self.delete_widget(request)
         else:
             raise ValueError('Cannot process request due to unknown request type: %s', 
-                             request['type'])
+                             request.type)
 
-    def update_widget(self, request:dict) -> bool:
-        '''Creates or replaces a widget in S3 or dynamodb depending on passed args.'''
-        if self.widget_bucket is not None:
-            self.logger.info('Saving widget to S3')
-            return self._update_widget_s3(request)
-        if self.dynamodb_widget_table is not None:
-            self.logger.info('Saving widget to DynamoDB')
-            return self._update_widget_dynamodb(request)
+    def update_widget(self, request:WidgetRequest) -> bool:
+        '''Creates or replaces a widget in the configured widget store.'''
+        self.logger.info('Saving widget to %s', self.widget_store.name, extra=PROCESSING_LOG)
+        with self.metrics.time(STAGE_SECONDS, stage='store', backend=self.widget_store.name,
+                               type=request.type):
+            saved:bool = self.widget_store.put_widget(request)
+        self._count_processed(request, saved)
+        return saved
 
-    def _update_widget_s3(self, request:dict) -> bool:
+    def _update_widget_s3(self, request:WidgetRequest) -> bool:
         '''Base function to create/replace the widget in S3'''
-        key:str = self.widget_key_prefix
-        if self.use_owner_in_prefix:
-           key += (request['owner'] + '/')
-        key += str(request['widgetId'])
-        try:
-            self.logger.debug('Placing object into s3 using key: %s', key)
-            self.aws_s3.put_object(Body=dumps(request), Bucket=self.widget_bucket, Key=key)
-            self.logger.debug('Saved!')
-        except ClientError as e:
-            self.logger.warning(e)
-            return False
-        
-        return True
+        return self.widget_stores['s3'].put_widget(request)
 
-    def _update_widget_dynamodb(self, request:dict) -> bool:
+    def _update_widget_dynamodb(self, request:WidgetRequest) -> bool:
         '''Base function to create/replace the widget in dynamodb'''
-        try:
-            request.pop('requestId') # don't need this one either
-            # Adjust the id before sending it to dynamodb
-            request['id'] = request.pop('widgetId')
-
-            # Then go and save it
-            self.aws_dynamodb_table.put_item(Item=request)
-        except Exception as e:
-            self.logger.warning(e)
-            return False
-        
-        return True
+        return self.widget_stores['dynamodb'].put_widget(request)
 
-    def delete_widget(self, request:dict) -> bool:
-        '''Deletes the widget from S3 or Dynamodb according to the request and args passed.'''
-        if self.widget_bucket is not None:
-            self.logger.info('Deleting widget from S3')
-            return self._delete_widget_s3(request)
-        if self.dynamodb_widget_table is not None:
-            self.logger.info('Deleting widget from DynamoDB')
-            return self._delete_widget_dynamodb(request)
+    def delete_widget(self, request:WidgetRequest) -> bool:
+        '''Deletes the widget from the configured widget store.'''
+        self.logger.info('Deleting widget from %s', self.widget_store.name,
+                         extra=PROCESSING_LOG)
+        with self.metrics.time(STAGE_SECONDS, stage='store', backend=self.widget_store.name,
+                               type=request.type):
+            deleted:bool = self.widget_store.delete_widget(request)
+        self._count_processed(request, deleted)
+        return deleted
 
-    def _delete_widget_s3(self, request:dict) -> bool:
+    def _delete_widget_s3(self, request:WidgetRequest) -> bool:
         '''Deletes widgets from the S3 widget bucket'''
-        key:str = self.widget_key_prefix
-        if self.use_owner_in_prefix:
-           key += (request['owner'] + '/')
-        key += str(request['widgetId'])
-        return self._delete_object_S3(self.widget_bucket, key)
+        return self.widget_stores['s3'].delete_widget(request)
 
-    def _delete_widget_dynamodb(self, request:dict) -> bool:
+    def _delete_widget_dynamodb(self, request:WidgetRequest) -> bool:
         '''Base function that deletes the widget from the dynamodb table'''
+        return self.widget_stores['dynamodb'].delete_widget(request)
+
+    def _write_widgets(self, requests:list[WidgetRequest],
+                       failed_groups:Collection[str] = ()) -> tuple[list[WidgetRequest], str]:
+        '''Writes requests to the widget store, returning the ones written and the error for the
+        rest. FIFO requests go one per message group at a time, and none are written after their
+        group fails (or if it is in failed_groups), so the group stays in order.
+        '''
+        if all(request.message_group_id is None for request in requests):
+            return self._write_to_store(requests)
+
+        written:list[WidgetRequest] = []
+        error:str = 'an earlier request in its message group failed'
+        failed:set[str] = set(failed_groups)
+        while requests:
+            wave:list[WidgetRequest] = []
+            later:list[WidgetRequest] = []
+            groups:set[str] = set()
+            for request in requests:
+                if request.message_group_id in failed:
+                    continue
+                (later if request.message_group_id in groups else wave).append(request)
+                groups.add(request.message_group_id)
+            if not wave:
+                break
+            wave_written, wave_error = self._write_to_store(wave)
+            written_ids:set[int] = { id(request) for request in wave_written }
+            for request in wave:
+                if id(request) not in written_ids:
+                    failed.add(request.message_group_id)
+                    error = wave_error
+            written.extend(wave_written)
+            requests = later
+        return written, error
+
+    def _write_to_store(self, requests:list[WidgetRequest]) -> tuple[list[WidgetRequest], str]:
+        '''Writes requests to the widget store in one batch, returning the ones written and the
+        error for the rest.
+        '''
         try:
-            key:dict = { 'id': request['widgetId']}
-            self.aws_dynamodb_table.delete_item(
-                Key=key,
-                ConditionExpression='attribute_exists(id)'
-            )
+            with self.metrics.time(STAGE_SECONDS, stage='store', backend=self.widget_store.name,
+                                   type='batch'):
+                return self.widget_store.write_widgets(requests), self._write_failed_error()
         except Exception as e:
-            self.logger.warning(e)
-            return False
-        
-        return True
+            self.logger.error('Failed to write %d widgets: %s', len(requests), e)
+            return [], str(e)
+
+    def _write_widget_batch(self, requests:list[WidgetRequest]) -> bool:
+        '''Writes a batch of requests to the widget store and acknowledges each one once it has
+        been written. Requests that were not written are left for redelivery.
+        '''
+        written, error = self._write_widgets(requests, self.failed_groups)
+        for request in written:
+            self._trace(request, 'store')
+            self.logger.info('%s request processed successfully', request.type,
+                             extra=PROCESSED_LOG)
+            self._acknowledge_request(request)
+
+        written_ids:set[int] = { id(request) for request in written }
+        for request in requests:
+            self._count_processed(request, id(request) in written_ids)
+            if id(request) not in written_ids:
+                self._fail_request(request, 'failure', error)
+        return len(written) == len(requests)
+
+    def _count_suppressed(self, request:WidgetRequest) -> None:
+        '''Counts an update that was not written because it changed nothing.'''
+        self.logger.debug('Widget %s unchanged, not writing it', request.widget_id)
+        self.metrics.increment(WRITES_SUPPRESSED, backend=self.widget_store.name)
+
+    def _count_processed(self, request:WidgetRequest, written:bool) -> None:
+        '''Counts a request written (or not) to the widget store.'''
+        self.metrics.increment(REQUESTS_PROCESSED, backend=self.widget_store.name,
+                               type=request.type, result='success' if written else 'failure')
+
+def _run_worker_process(args, index:int, requests, results) -> None:
+    '''Entry point of a worker process. Sets up its own widget stores from the consumer's
+    arguments and writes what the supervisor sends it until told to stop.
+    '''
+    signal(SIGINT, SIG_IGN) # Ctrl+C goes to the supervisor, which stops us once it is done
+    app = WidgetConsumer()
+    app.save_arguments(args)
+    app._create_store_clients()
+    try:
+        app._serve_partition(index, requests, results)
+    finally:
+        app.widget_store.close()
 
 if __name__ == '__main__':
     app = WidgetConsumer()
@@ -366,4 +1840,4 @@ if __name__ == '__main__':
     app.verify_arguments(args)
     app.save_arguments(args)
 
-    app.consume_requests()
\ No newline at end of file
+    app.consume_requests()
@@ -0,0 +1,98 @@
+'''Remembers which requests the consumer already processed, by requestId, so requests that are
+delivered more than once (SQS is at-least-once) are only written once. Ids are only kept for a
+time window, so memory stays bounded no matter how long the consumer runs.
+'''
+
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+from time import monotonic, time
+
+from request_batcher import RequestBatcher
+from widget_store import ThreadLocalTable
+
+logger = getLogger(__name__)
+
+# BatchWriteItem accepts at most 25 items per call
+MAX_RECORD_BATCH_SIZE = 25
+
+class IdempotencyStore():
+    '''Keeps the requestIds processed in the last window seconds in memory, at most capacity of
+    them, oldest first.
+    '''
+    def __init__(self, window:float, capacity:int) -> None:
+        self.window:float = window
+        self.capacity:int = capacity
+        self._expiries:OrderedDict[str, float] = OrderedDict()
+        self._lock = Lock()
+
+    def seen(self, request_id:str) -> bool:
+        '''Returns whether the request was processed within the window.'''
+        with self._lock:
+            self._expire(monotonic())
+            return request_id in self._expiries
+
+    def record(self, request_id:str) -> None:
+        '''Remembers that the request was processed.'''
+        now:float = monotonic()
+        with self._lock:
+            self._expiries[request_id] = now + self.window
+            self._expiries.move_to_end(request_id)
+            self._expire(now)
+            while len(self._expiries) > self.capacity:
+                self._expiries.popitem(last=False)
+
+    def _expire(self, now:float) -> None:
+        '''Drops every id whose window has passed. Must be called while holding the lock.'''
+        while self._expiries:
+            request_id, expiry = next(iter(self._expiries.items()))
+            if expiry > now:
+                return
+            self._expiries.popitem(last=False)
+
+    def close(self) -> None:
+        '''Writes out anything not yet saved.'''
+        pass
+
+class DynamoDBIdempotencyStore(IdempotencyStore):
+    '''Shares processed requestIds between consumers through a DynamoDB table keyed by requestId.
+    Each item has an expiresAt (epoch seconds) that DynamoDB TTL can delete it by. Ids are also
+    kept in memory, so only ids this consumer hasn't seen are looked up, and records are written
+    in batches.
+    '''
+    def __init__(self, table, window:float, capacity:int) -> None:
+        super().__init__(window, capacity)
+        # Looked up from worker threads and written from the batcher's, so each gets its own
+        self.tables = ThreadLocalTable(table)
+        self.batcher = RequestBatcher(self._write_records, MAX_RECORD_BATCH_SIZE, 0.1)
+
+    @property
+    def table(self):
+        return self.tables.get()
+
+    def seen(self, request_id:str) -> bool:
+        if super().seen(request_id):
+            return True
+        try:
+            item:dict = self.table.get_item(Key={ 'requestId': request_id }).get('Item')
+        except Exception as e: # Process it, a duplicate write is better than a lost one
+            logger.warning('Failed to look up request %s: %s', request_id, e)
+            return False
+        # TTL can take a while to delete expired items, so check the expiry ourselves
+        return item is not None and item['expiresAt'] > time()
+
+    def record(self, request_id:str) -> None:
+        super().record(request_id)
+        self.batcher.add(request_id)
+
+    def _write_records(self, request_ids:list[str]) -> None:
+        expires_at:int = int(time() + self.window)
+        try:
+            with self.table.batch_writer(overwrite_by_pkeys=['requestId']) as batch:
+                for request_id in request_ids:
+                    batch.put_item(Item={ 'requestId': request_id, 'expiresAt': expires_at })
+        except Exception as e:
+            logger.warning('Failed to record %d processed requests: %s', len(request_ids), e)
+
+    def close(self) -> None:
+        self.batcher.flush()
@@ -0,0 +1,148 @@
+'''Moves the widgets in an S3 widget bucket from one key layout to another, e.g. to start sharding
+keys with --widget-key-shard-length. New keys are built with the same widget_key function the
+consumer uses. Stop the consumers before migrating and restart them with the new layout after,
+so no widget is written under the old layout while it is being moved.
+
+`python3 widget_key_migration.py -wb {widget-bucket} --to-shard-length 2`
+'''
+
+from argparse import ArgumentParser
+from boto3 import client
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from logging import basicConfig, getLogger, INFO
+from sys import exit
+
+from widget_store import widget_key
+
+logger = getLogger('widget_key_migration')
+
+class WidgetKeyMigration():
+    '''Copies every widget object in the old layout to its key in the new layout, then deletes
+    the old object.
+    '''
+    def __init__(self, s3, bucket:str, key_prefix:str, use_owner_in_prefix:bool,
+                 from_shard_length:int, to_shard_length:int, dry_run:bool = False) -> None:
+        self.s3 = s3
+        self.bucket:str = bucket
+        self.key_prefix:str = key_prefix
+        self.use_owner_in_prefix:bool = use_owner_in_prefix
+        self.from_shard_length:int = from_shard_length
+        self.to_shard_length:int = to_shard_length
+        self.dry_run:bool = dry_run
+
+    def old_keys(self):
+        '''Yields every key in the bucket that is a widget in the old layout.'''
+        # Sharded keys start with the shard, so they can't be listed by the key prefix
+        prefix:str = self.key_prefix if self.from_shard_length == 0 else ''
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=self.bucket,
+                                                                      Prefix=prefix):
+            for item in page.get('Contents', []):
+                if self.parse_key(item['Key']) is not None:
+                    yield item['Key']
+
+    def parse_key(self, key:str) -> tuple[str, str]:
+        '''Returns the (widgetId, owner) of a key in the old layout, or None if the key is not a
+        widget in that layout.
+        '''
+        rest:str = key
+        if self.from_shard_length > 0:
+            shard, _, rest = key.partition('/')
+            if len(shard) != self.from_shard_length:
+                return None
+        if not rest.startswith(self.key_prefix):
+            return None
+        rest = rest[len(self.key_prefix):]
+
+        owner:str = None
+        if self.use_owner_in_prefix:
+            owner, _, rest = rest.partition('/')
+        if not rest or '/' in rest:
+            return None
+        if widget_key(rest, owner, self.key_prefix, self.use_owner_in_prefix,
+                      self.from_shard_length) != key:
+            return None # e.g. a shard that isn't the widgetId's
+        return rest, owner
+
+    def new_key(self, key:str) -> str:
+        '''Returns the key a widget in the old layout moves to.'''
+        widget_id, owner = self.parse_key(key)
+        return widget_key(widget_id, owner, self.key_prefix, self.use_owner_in_prefix,
+                          self.to_shard_length)
+
+    def move(self, key:str) -> bool:
+        '''Moves a single widget. Returns whether it was moved.'''
+        new_key:str = self.new_key(key)
+        if new_key == key:
+            return True
+        if self.dry_run:
+            logger.info('Would move %s to %s', key, new_key)
+            return True
+        try:
+            self.s3.copy_object(Bucket=self.bucket, Key=new_key,
+                                CopySource={ 'Bucket': self.bucket, 'Key': key })
+            self.s3.delete_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            logger.error('Failed to move %s to %s: %s', key, new_key, e)
+            return False
+        return True
+
+    def run(self, threads:int = 16) -> tuple[int, int]:
+        '''Moves every widget in the old layout. Returns how many were moved and how many failed.'''
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results:list[bool] = list(pool.map(self.move, self.old_keys()))
+        moved:int = results.count(True)
+        logger.info('Moved %d widgets, %d failed', moved, len(results) - moved)
+        return moved, len(results) - moved
+
+def get_migration_parser() -> ArgumentParser:
+    '''Returns the parser for the migration'''
+    parser = ArgumentParser(description='Move widgets in S3 to a new key layout.')
+    parser.add_argument('-r', '--region',
+                        action='store',
+                        type=str,
+                        default='us-east-1',
+                        help='The AWS region to use (default: %(default)s)')
+    parser.add_argument('-wb', '--widget-bucket',
+                        action='store',
+                        type=str,
+                        required=True,
+                        help='Name of S3 bucket holding widgets')
+    parser.add_argument('-wkp', '--widget-key-prefix',
+                        action='store',
+                        type=str,
+                        default='widgets/',
+                        help='Prefix for widget objects in S3 (default: %(default)s)')
+    parser.add_argument('-uop', '--use-owner-in-prefix',
+                        action='store_true',
+                        default=False,
+                        help='Widget keys have the owner after the prefix (default: %(default)s)')
+    parser.add_argument('-fsl', '--from-shard-length',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Shard length widgets are saved with now (default: %(default)s)')
+    parser.add_argument('-tsl', '--to-shard-length',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Shard length to move widgets to (default: %(default)s)')
+    parser.add_argument('-t', '--threads',
+                        action='store',
+                        type=int,
+                        default=16,
+                        help='Widgets to move at the same time (default: %(default)s)')
+    parser.add_argument('-d', '--dry-run',
+                        action='store_true',
+                        default=False,
+                        help='Only log what would be moved (default: %(default)s)')
+    return parser
+
+if __name__ == '__main__':
+    args = get_migration_parser().parse_args()
+    basicConfig(level=INFO)
+    migration = WidgetKeyMigration(client('s3', region_name=args.region), args.widget_bucket,
+                                   args.widget_key_prefix, args.use_owner_in_prefix,
+                                   args.from_shard_length, args.to_shard_length, args.dry_run)
+    _, failed = migration.run(args.threads)
+    exit(1 if failed else 0)
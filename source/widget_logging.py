@@ -0,0 +1,104 @@
+'''Logging for the consumer that keeps log I/O off the threads processing requests. Records are put
+on a queue and formatted and written by a QueueListener thread. Lines logged for every request
+can be sampled and rate limited so a busy consumer doesn't spend its time writing the same line.
+'''
+
+from atexit import register
+from logging import BASIC_FORMAT, FileHandler, Filter, Formatter, getLogger, Logger, LogRecord
+from logging.handlers import QueueHandler, QueueListener
+from os import makedirs
+from os.path import dirname
+from queue import SimpleQueue
+from threading import Lock
+from time import monotonic
+
+class SamplingFilter(Filter):
+    '''Thins out records logged with extra={'sample': <message type>}. Only the first of every
+    sample_every records of a type is kept, and at most rate_limit of them per second (0 = no
+    limit). The next record kept for a type says how many were dropped since the last one.
+    Records without a message type are always kept.
+    '''
+    def __init__(self, sample_every:int = 1, rate_limit:int = 0) -> None:
+        super().__init__()
+        self.sample_every:int = sample_every
+        self.rate_limit:int = rate_limit
+        self._seen:dict[str, int] = {}
+        self._dropped:dict[str, int] = {}
+        # Start of the current one second window and how many records were kept in it, by type
+        self._windows:dict[str, tuple[float, int]] = {}
+        self._lock = Lock()
+
+    def filter(self, record:LogRecord) -> bool:
+        message_type:str = getattr(record, 'sample', None)
+        if message_type is None:
+            return True
+
+        with self._lock:
+            seen:int = self._seen.get(message_type, 0)
+            self._seen[message_type] = seen + 1
+            keep:bool = seen % self.sample_every == 0
+            if keep and self.rate_limit > 0:
+                now:float = monotonic()
+                window_start, kept = self._windows.get(message_type, (now, 0))
+                if now - window_start >= 1:
+                    window_start, kept = now, 0
+                keep = kept < self.rate_limit
+                self._windows[message_type] = (window_start, kept + keep)
+            if not keep:
+                self._dropped[message_type] = self._dropped.get(message_type, 0) + 1
+                return False
+            dropped:int = self._dropped.pop(message_type, 0)
+
+        if dropped:
+            record.msg = f'{record.msg} ({dropped} similar messages dropped)'
+        return True
+
+class _InProcessQueueHandler(QueueHandler):
+    '''QueueHandler that leaves formatting to the listener thread. The stock handler formats the
+    message before queueing it so the record can be pickled, which we never need to do.
+    '''
+    def prepare(self, record:LogRecord) -> LogRecord:
+        return record
+
+_listener:QueueListener = None
+_sampling_filter:SamplingFilter = None
+
+def start_queue_logging(filename:str, level:int, app_logger:Logger) -> SamplingFilter:
+    '''Sends every record to filename, and the app logger's records to the handlers it already
+    has (e.g. stdout), through a background thread. Only the first call starts the thread; later
+    calls reuse it. Returns the filter that samples repeated lines so it can be configured.
+
+    Like basicConfig, filename is left out if the root logger already has handlers (e.g. under
+    pytest), so whoever set those up decides where records go.
+    '''
+    global _listener, _sampling_filter
+
+    # These now sit behind the queue, so take them off the logger either way
+    app_handlers = app_logger.handlers[:]
+    for handler in app_handlers:
+        app_logger.removeHandler(handler)
+    if _listener is not None:
+        return _sampling_filter
+
+    root = getLogger()
+    file_handlers:list[FileHandler] = []
+    if not root.handlers:
+        if dirname(filename):
+            makedirs(dirname(filename), exist_ok=True)
+        file_handler = FileHandler(filename, delay=True) # Only created once something is logged
+        file_handler.setFormatter(Formatter(BASIC_FORMAT))
+        file_handlers.append(file_handler)
+    for handler in app_handlers:
+        handler.addFilter(Filter(app_logger.name)) # They only ever saw the app logger's records
+
+    queue:SimpleQueue = SimpleQueue()
+    _sampling_filter = SamplingFilter()
+    queue_handler = _InProcessQueueHandler(queue)
+    queue_handler.addFilter(_sampling_filter)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(queue, *file_handlers, *app_handlers, respect_handler_level=True)
+    _listener.start()
+    register(_listener.stop) # Writes out whatever is still queued before exiting
+    return _sampling_filter
@@ -0,0 +1,172 @@
+'''In-process counters and latency histograms for the Widget apps, with an optional HTTP endpoint
+that serves them in the Prometheus text format.
+'''
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+
+# Upper bounds (in seconds) of the latency histogram buckets. AWS calls land between 1 ms and 1 s.
+LATENCY_BUCKETS:tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                                     2.5, 5.0, 10.0)
+
+class Histogram():
+    '''Counts observations into fixed buckets, keeping their count and sum.'''
+    __slots__ = ('bucket_counts', 'count', 'sum')
+
+    def __init__(self) -> None:
+        # One extra bucket for anything past the last bound (+Inf)
+        self.bucket_counts:list[int] = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count:int = 0
+        self.sum:float = 0.0
+
+    def observe(self, value:float) -> None:
+        self.bucket_counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other:'Histogram') -> None:
+        for index, bucket_count in enumerate(other.bucket_counts):
+            self.bucket_counts[index] += bucket_count
+        self.count += other.count
+        self.sum += other.sum
+
+class _StageTimer():
+    '''Context manager that observes how long its block took.'''
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry:'MetricsRegistry', name:str, labels:dict) -> None:
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> '_StageTimer':
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.registry.observe(self.name, perf_counter() - self.start, **self.labels)
+
+class MetricsRegistry():
+    '''Holds every counter and histogram, keyed by metric name and labels. Labels are kept in the
+    order they are given, so each call site should always pass them in the same order.
+    '''
+    def __init__(self) -> None:
+        self.counters:dict[tuple[str, tuple], float] = {}
+        self.histograms:dict[tuple[str, tuple], Histogram] = {}
+        self.descriptions:dict[str, str] = {}
+        self._lock = Lock()
+
+    def __getstate__(self) -> dict:
+        # Registries are pickled to send them between processes. Locks can't be, and the copy
+        # gets its own anyway.
+        with self._lock:
+            return { 'counters': dict(self.counters), 'histograms': dict(self.histograms),
+                     'descriptions': dict(self.descriptions) }
+
+    def __setstate__(self, state:dict) -> None:
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def describe(self, name:str, description:str) -> None:
+        '''Sets the HELP text shown for a metric.'''
+        self.descriptions[name] = description
+
+    def increment(self, name:str, amount:float = 1, **labels:str) -> None:
+        '''Adds to a counter.'''
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name:str, value:float, **labels:str) -> None:
+        '''Records a value (usually seconds) in a histogram.'''
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            histogram:Histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def time(self, name:str, **labels:str) -> _StageTimer:
+        '''Returns a context manager that records how long its block takes in a histogram.'''
+        return _StageTimer(self, name, labels)
+
+    def merge(self, other:'MetricsRegistry') -> None:
+        '''Adds every counter and histogram from another registry into this one.'''
+        with self._lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other_histogram in other.histograms.items():
+                histogram:Histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.merge(other_histogram)
+            self.descriptions.update(other.descriptions)
+
+    def render(self) -> str:
+        '''Returns every metric in the Prometheus text exposition format.'''
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+
+        lines:list[str] = []
+        described:set[str] = set()
+        for (name, labels), value in counters:
+            self._render_header(lines, described, name, 'counter')
+            lines.append(f'{name}{_format_labels(labels)} {value:g}')
+
+        for (name, labels), histogram in histograms:
+            self._render_header(lines, described, name, 'histogram')
+            cumulative:int = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + (float('inf'),),
+                                           histogram.bucket_counts):
+                cumulative += bucket_count
+                bucket_labels:tuple = labels + (('le', '+Inf' if bound == float('inf')
+                                                 else f'{bound:g}'),)
+                lines.append(f'{name}_bucket{_format_labels(bucket_labels)} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum:g}')
+            lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _render_header(self, lines:list[str], described:set[str], name:str, kind:str) -> None:
+        '''Adds the HELP and TYPE lines the first time a metric is rendered.'''
+        if name in described:
+            return
+        described.add(name)
+        if name in self.descriptions:
+            lines.append(f'# HELP {name} {self.descriptions[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+
+def _format_labels(labels:tuple) -> str:
+    '''Formats labels as {key="value",...}, or nothing if there are none.'''
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+def start_metrics_server(registry:MetricsRegistry, port:int,
+                         host:str = '127.0.0.1') -> ThreadingHTTPServer:
+    '''Serves the registry at /metrics on a background thread. Call shutdown() and then
+    server_close() on the returned server to stop it.
+    '''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body:bytes = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format:str, *args) -> None:
+            pass # Scrapes would flood the consumer log
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name='widget-metrics', daemon=True).start()
+    return server
@@ -0,0 +1,70 @@
+'''The requests the consumer works on. A request is decoded and validated once when it is received.
+Its widget is never changed after that, so every store can share it.
+'''
+
+from time import monotonic
+
+from widget_codec import dumps, loads
+
+REQUEST_TYPES = frozenset(('create', 'update', 'delete'))
+
+class WidgetRequest():
+    '''A create, update, or delete request for a single widget. widget holds the request exactly as
+    it was sent, which is also how the widget is saved, and must not be changed. The other fields
+    are copied out of it or describe where the request came from.
+    '''
+    __slots__ = ('type', 'request_id', 'widget_id', 'owner', 'widget', 'body', 'receipt_handle',
+                 'message_group_id', 'bucket_key', 'received_at', 'coalesced_requests', 'attempts',
+                 'trace')
+
+    def __init__(self, widget:dict, body:bytes | str = None, receipt_handle:str = None,
+                 bucket_key:str = None, message_group_id:str = None) -> None:
+        request_type = widget.get('type')
+        if request_type not in REQUEST_TYPES:
+            raise ValueError(f'Unknown request type: {request_type}')
+        if widget.get('widgetId') is None:
+            raise ValueError(f'{request_type} request {widget.get('requestId')} has no widgetId')
+
+        self.type:str = request_type
+        self.request_id:str = widget.get('requestId')
+        self.widget_id:str = widget['widgetId']
+        self.owner:str = widget.get('owner')
+        self.widget:dict = widget
+        # The widget as JSON. The body the request arrived with, or encoded the first time a
+        # store asks for it.
+        self.body:bytes | str = body
+        # Where the request came from: a queue message or an object in the request bucket
+        self.receipt_handle:str = receipt_handle
+        self.bucket_key:str = bucket_key
+        # Set for messages from a FIFO queue. Requests in a group must be handled in order.
+        self.message_group_id:str = message_group_id
+        self.received_at:float = monotonic()
+        # Older requests for the same widget that this one replaced. They are acked with it.
+        self.coalesced_requests:list[WidgetRequest] = []
+        self.attempts:int = 0 # Failed attempts to write it so far
+        self.trace = None # RequestTrace, when the request is being traced
+
+    @classmethod
+    def decode(cls, body:bytes | str, receipt_handle:str = None, bucket_key:str = None,
+               message_group_id:str = None) -> 'WidgetRequest':
+        '''Parses and validates a request body. Raises a ValueError if it is not a valid request.'''
+        widget = loads(body)
+        if not isinstance(widget, dict):
+            raise ValueError('Request body is not a JSON object')
+        return cls(widget, body, receipt_handle, bucket_key, message_group_id)
+
+    @property
+    def partition_key(self) -> str:
+        '''What requests are routed to workers by. Requests with the same key are handled in the
+        order they were received: its message group, or else its widget.
+        '''
+        return self.message_group_id if self.message_group_id is not None else self.widget_id
+
+    def encoded_widget(self) -> bytes | str:
+        '''Returns the widget as JSON, encoding it only once no matter how many stores save it.'''
+        if self.body is None:
+            self.body = dumps(self.widget)
+        return self.body
+
+    def __repr__(self) -> str:
+        return f'WidgetRequest({self.type} {self.widget_id}, requestId={self.request_id})'
@@ -1,7 +1,5 @@
-
-from boto3 import client
 from botocore.exceptions import ClientError
-from json import dumps, loads
+from json import dumps, JSONDecodeError, loads
 from logging import basicConfig, getLogger, INFO
 from os import environ
 from uuid import uuid4
@@ -13,37 +11,133 @@ else:
 
 logger = getLogger()
 
-def handler(event, context) -> None:
+REQUEST_TYPES = { 'create', 'update', 'delete' }
+# send_message_batch accepts at most 10 entries, and 256 KB of message bodies, per call
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 262_144
+
+# Kept for every warm invocation of the lambda after the first
+_config:dict = None
+_sqs = None
+
+def get_config() -> dict:
+    '''Reads the lambda's settings from its environment the first time it is called.'''
+    global _config
+    if _config is None:
+        _config = { 'region': environ['REGION'], 'queue_url': environ['QUEUE_URL'] }
+    return _config
+
+def get_sqs_client():
+    '''Returns the SQS client, creating it the first time it is called. Importing boto3 and
+    building a client is most of a cold start, so it is only done once per lambda instance.
+    '''
+    global _sqs
+    if _sqs is None:
+        from boto3 import client
+        _sqs = client('sqs', region_name=get_config()['region'])
+    return _sqs
+
+def handler(event, context) -> dict:
     '''AWS lambda function'''
     logger.info('Sending new message to SQS...')
-    logger.debug('REGION: %s', environ['REGION'])
-    logger.debug('QUEUE_URL: %s', environ['QUEUE_URL'])
+    config:dict = get_config()
+    logger.debug('REGION: %s', config['region'])
+    logger.debug('QUEUE_URL: %s', config['queue_url'])
+
+    requests, bulk = parse_body(event['body'])
+    sqs = get_sqs_client()
+    if bulk:
+        logger.info('Bulk upload %s with %d requests', context.aws_request_id, len(requests))
+        results:list[dict] = handle_bulk_request(requests, context.aws_request_id, sqs,
+                                                 config['queue_url'])
+        return { 'statusCode': 200, 'body': dumps({ 'results': results }) }
 
-    request = loads(event['body'])
+    request = requests[0]
     request['requestId'] = context.aws_request_id
     logger.info('requestId: %s', request['requestId'])
 
-    sqs = client('sqs', region_name=environ['REGION'])
-    result = handle_request(request, sqs)
+    sent:bool = handle_request(request, sqs, config['queue_url'])
 
-    logger.debug('Result of handling request: %s', result.__str__())
-    logger.info('Request %s sent to SQS!', request['requestId'])
+    logger.debug('Result of handling request: %s', sent)
+    # The same shape as a result of a bulk upload
+    result:dict = { 'requestId': request['requestId'], 'status': 'queued' if sent else 'error' }
+    if sent:
+        logger.info('Request %s sent to SQS!', request['requestId'])
+        result['widgetId'] = request['widgetId']
+    return { 'statusCode': 200 if sent else 400, 'body': dumps(result) }
 
-def handle_request(request:dict, sqs) -> bool:
-    '''Handles the widget requests sent from devices.'''
-    if request['type'] not in { 'create', 'update', 'delete' }:
-        logger.error('%s is not a valid request type', request['type'])
-        return False
+def parse_body(body:str) -> tuple[list, bool]:
+    '''Returns the requests in a body and whether it was a bulk upload. A bulk upload is a JSON
+    array or NDJSON (one request per line). NDJSON lines that are not valid JSON are returned as
+    ValueErrors so they can be reported back in their place.
+    '''
+    try:
+        parsed = loads(body)
+    except JSONDecodeError:
+        requests:list = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                requests.append(loads(line))
+            except JSONDecodeError as e:
+                requests.append(ValueError(f'Not valid JSON: {e}'))
+        return requests, True
+
+    if isinstance(parsed, list):
+        return parsed, True
+    return [parsed], False
+
+def prepare_request(request:dict) -> str:
+    '''Checks that a request can be sent and gives creates their widgetId. Returns what is wrong
+    with the request, or None if it is good to send.
+    '''
+    if isinstance(request, ValueError):
+        return str(request)
+    if not isinstance(request, dict):
+        return 'Request is not a JSON object'
+    if request.get('type') not in REQUEST_TYPES:
+        return f'{request.get('type')} is not a valid request type'
     if request['type'] == 'create':
         widgetId = str(uuid4())
         logger.info('widgetId created: %s', widgetId)
         request['widgetId'] = widgetId
-    
+    elif request.get('widgetId') is None:
+        return f'{request['type']} request has no widgetId'
+    return None
+
+def fifo_message_attributes(request:dict, queue_url:str) -> dict:
+    '''Returns the group and deduplication ids for sending a request to a FIFO queue, or nothing
+    for a standard queue. Requests are grouped by widget (or by owner when MESSAGE_GROUP_FIELD is
+    owner), so the consumer handles each widget's requests in order. Resending a request with the
+    same requestId is dropped by SQS.
+    '''
+    if not queue_url.endswith('.fifo'):
+        return {}
+    group_field:str = environ.get('MESSAGE_GROUP_FIELD', 'widgetId')
+    group_id = request.get(group_field) or request.get('widgetId')
+    return {
+        'MessageGroupId': str(group_id),
+        'MessageDeduplicationId': str(request['requestId'])
+    }
+
+def handle_request(request:dict, sqs, queue_url:str = None) -> bool:
+    '''Handles the widget requests sent from devices. Sends to QUEUE_URL unless given a
+    queue_url.
+    '''
+    error:str = prepare_request(request)
+    if error is not None:
+        logger.error(error)
+        return False
+
     # Send the request to the queue
     try:
+        if queue_url is None:
+            queue_url = environ['QUEUE_URL']
         response = sqs.send_message(
-            QueueUrl=environ['QUEUE_URL'],
-            MessageBody=dumps(request)
+            QueueUrl=queue_url,
+            MessageBody=dumps(request),
+            **fifo_message_attributes(request, queue_url)
         )
         logger.info('Sent message %s', response['MessageId'])
     except ClientError as e:
@@ -53,4 +147,72 @@ def handle_request(request:dict, sqs) -> bool:
         logger.error('QUEUE_URL environment variable was not set!')
         return False
 
-    return True
\ No newline at end of file
+    return True
+
+def handle_bulk_request(requests:list, request_id:str, sqs, queue_url:str = None) -> list[dict]:
+    '''Sends every valid request of a bulk upload to the queue, as few send_message_batch calls as
+    the entry and size limits allow. Each request gets a requestId made from the upload's. Returns
+    a result for every request, in order, with its widgetId and whether it was queued.
+    '''
+    if queue_url is None:
+        if 'QUEUE_URL' not in environ:
+            logger.error('QUEUE_URL environment variable was not set!')
+            return [{ 'index': index, 'status': 'error', 'error': 'No queue to send to' }
+                    for index in range(len(requests))]
+        queue_url = environ['QUEUE_URL']
+    results:list[dict] = []
+    entries:list[tuple[dict, int]] = []
+    for index, request in enumerate(requests):
+        result:dict = { 'index': index }
+        results.append(result)
+        error:str = prepare_request(request)
+        if error is None:
+            request['requestId'] = f'{request_id}-{index}'
+            result['requestId'] = request['requestId']
+            result['widgetId'] = request['widgetId']
+            body:str = dumps(request)
+            size:int = len(body.encode())
+            if size > MAX_BATCH_BYTES:
+                error = f'Request is {size} bytes, more than the {MAX_BATCH_BYTES} SQS allows'
+        if error is not None:
+            logger.warning('Request %d of bulk upload %s is invalid: %s', index, request_id, error)
+            result.update(status='error', error=error)
+            continue
+        entries.append(({ 'Id': str(index), 'MessageBody': body,
+                          **fifo_message_attributes(request, queue_url) },
+                        size))
+
+    batch:list[dict] = []
+    batch_bytes:int = 0
+    for entry, size in entries:
+        if len(batch) == MAX_BATCH_ENTRIES or batch_bytes + size > MAX_BATCH_BYTES:
+            send_batch(batch, results, sqs, queue_url)
+            batch, batch_bytes = [], 0
+        batch.append(entry)
+        batch_bytes += size
+    if batch:
+        send_batch(batch, results, sqs, queue_url)
+    return results
+
+def send_batch(batch:list[dict], results:list[dict], sqs, queue_url:str) -> None:
+    '''Sends up to 10 entries with one send_message_batch call and fills in their results.'''
+    try:
+        response:dict = sqs.send_message_batch(QueueUrl=queue_url, Entries=batch)
+    except ClientError as e:
+        logger.error('Failed to send %d messages: %s', len(batch), e)
+        for entry in batch:
+            results[int(entry['Id'])].update(status='error', error='Could not send to the queue')
+        return
+
+    logger.info('Sent %d messages', len(response.get('Successful', [])))
+    for success in response.get('Successful', []):
+        results[int(success['Id'])].update(status='queued', messageId=success['MessageId'])
+    for failure in response.get('Failed', []):
+        logger.error('Failed to send message %s: %s', failure['Id'], failure.get('Message'))
+        results[int(failure['Id'])].update(status='error',
+                                           error=failure.get('Message', failure['Code']))
+
+if 'AWS_LAMBDA_FUNCTION_NAME' in environ:
+    # Lambda runs module code once, before the first request, with a full CPU. Creating the client
+    # there keeps it out of the first request's latency.
+    get_sqs_client()
@@ -0,0 +1,170 @@
+'''Retries requests the consumer failed to write, and dead-letters the ones that keep failing.'''
+
+from heapq import heappop, heappush
+from itertools import count
+from json import dumps
+from logging import getLogger
+from random import uniform
+from threading import Lock
+from time import monotonic, time
+from uuid import uuid4
+
+logger = getLogger(__name__)
+
+class RetryScheduler():
+    '''Holds failed requests until their next attempt is due, soonest first. The delay doubles
+    with every attempt, from base_delay up to max_delay (in seconds), with jitter.
+    '''
+    def __init__(self, max_attempts:int, base_delay:float, max_delay:float) -> None:
+        self.max_attempts:int = max_attempts
+        self.base_delay:float = base_delay
+        self.max_delay:float = max_delay
+        self._waiting:list[tuple[float, int, object]] = []
+        self._sequence = count() # Breaks ties so requests are never compared
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._waiting)
+
+    def delay(self, attempts:int) -> float:
+        '''Returns how long (in seconds) to wait after a request's attempts-th failed attempt.'''
+        delay:float = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return uniform(delay / 2, delay)
+
+    def schedule(self, request) -> bool:
+        '''Counts a failed attempt of a WidgetRequest and schedules the next one. Returns False,
+        without scheduling it, once the request has used up its attempts.
+        '''
+        request.attempts += 1
+        if request.attempts >= self.max_attempts:
+            return False
+        due:float = monotonic() + self.delay(request.attempts)
+        with self._lock:
+            heappush(self._waiting, (due, next(self._sequence), request))
+        return True
+
+    def pop_due(self):
+        '''Returns the request whose attempt is the most overdue, or None if none are due yet.'''
+        with self._lock:
+            if not self._waiting or self._waiting[0][0] > monotonic():
+                return None
+            return heappop(self._waiting)[2]
+
+    def next_due(self) -> float:
+        '''Returns how long (in seconds) until the next attempt is due, or None if nothing is
+        waiting.
+        '''
+        with self._lock:
+            if not self._waiting:
+                return None
+            return max(self._waiting[0][0] - monotonic(), 0)
+
+    def drain(self) -> list:
+        '''Removes and returns every waiting request, due or not.'''
+        with self._lock:
+            waiting, self._waiting = self._waiting, []
+        return [request for _, _, request in sorted(waiting)]
+
+class DeadLetterSink():
+    '''Somewhere to put requests that could not be written, with the error that stopped them.'''
+    name:str = 'none'
+
+    def send(self, request, error:str) -> bool:
+        '''Dead-letters a WidgetRequest. Returns whether it was saved.'''
+        raise NotImplementedError
+
+    def send_invalid(self, body:str, message_id:str, error:str, group_id:str = None,
+                     attempts:int = 1) -> bool:
+        '''Dead-letters a message (or request object) that is not a valid request, as the body it
+        arrived with, or None if it could not be read. Returns whether it was saved.
+        '''
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+class FileDeadLetterSink(DeadLetterSink):
+    '''Appends dead-lettered requests to a local NDJSON file, one line per request.'''
+    name = 'file'
+
+    def __init__(self, path:str) -> None:
+        self.path:str = path
+        self._file = open(path, 'a', buffering=1)
+        self._lock = Lock()
+
+    def send(self, request, error:str) -> bool:
+        line:str = dumps({
+            'requestId': request.request_id,
+            'error': error,
+            'attempts': request.attempts,
+            'deadLetteredAt': time(),
+            'request': request.widget
+        })
+        return self._write(line, request.request_id)
+
+    def send_invalid(self, body:str, message_id:str, error:str, group_id:str = None,
+                     attempts:int = 1) -> bool:
+        line:str = dumps({
+            'messageId': message_id,
+            'error': error,
+            'attempts': attempts,
+            'deadLetteredAt': time(),
+            'body': body
+        })
+        return self._write(line, message_id)
+
+    def _write(self, line:str, name:str) -> bool:
+        '''Appends a line. Returns whether it was written.'''
+        try:
+            with self._lock:
+                self._file.write(line + '\n')
+        except (OSError, ValueError) as e: # ValueError once the file is closed
+            logger.error('Failed to dead-letter %s to %s: %s', name, self.path, e)
+            return False
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+class SQSDeadLetterSink(DeadLetterSink):
+    '''Sends dead-lettered requests to an SQS queue as they were received, with the error and
+    attempts as message attributes.
+    '''
+    name = 'sqs'
+
+    def __init__(self, sqs, queue_url:str) -> None:
+        self.sqs = sqs
+        self.queue_url:str = queue_url
+
+    def send(self, request, error:str) -> bool:
+        body = request.encoded_widget()
+        return self._send(body.decode() if isinstance(body, bytes) else body, error,
+                          request.attempts, request.partition_key, request.request_id)
+
+    def send_invalid(self, body:str, message_id:str, error:str, group_id:str = None,
+                     attempts:int = 1) -> bool:
+        # SQS needs a body, so one that could not be read is sent as its id
+        return self._send(message_id if body is None else body, error, attempts,
+                          group_id or 'invalid', message_id)
+
+    def _send(self, body:str, error:str, attempts:int, group_id:str, name:str) -> bool:
+        '''Sends a body with its error and attempts. Returns whether it was sent.'''
+        arguments:dict = {
+            'QueueUrl': self.queue_url,
+            'MessageBody': body,
+            'MessageAttributes': {
+                'error': { 'DataType': 'String', 'StringValue': error or 'unknown' },
+                'attempts': { 'DataType': 'Number', 'StringValue': str(attempts) }
+            }
+        }
+        if self.queue_url.endswith('.fifo'):
+            arguments['MessageGroupId'] = str(group_id)
+            arguments['MessageDeduplicationId'] = str(name or uuid4())
+        try:
+            self.sqs.send_message(**arguments)
+        except Exception as e:
+            logger.error('Failed to dead-letter %s to %s: %s', name, self.queue_url, e)
+            return False
+        return True
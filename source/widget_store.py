@@ -0,0 +1,451 @@
+'''Places the consumer can save widgets to. Each store registers itself in WIDGET_STORES.'''
+
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b, md5
+from logging import getLogger
+from threading import local, Lock
+from typing import Callable
+
+try:
+    from psycopg import sql
+    from psycopg.types.json import Jsonb
+    from psycopg_pool import ConnectionPool
+except ImportError: # Only needed when saving widgets to postgres
+    ConnectionPool = None
+
+from widget_codec import dumps
+from widget_request import WidgetRequest
+
+logger = getLogger(__name__)
+
+# Every known store by name, in the order the consumer prefers them
+WIDGET_STORES:dict[str, type] = {}
+
+def widget_key(widget_id:str, owner:str, key_prefix:str, use_owner_in_prefix:bool,
+               shard_length:int = 0) -> str:
+    '''Builds the S3 key a widget is saved under: [shard/]key_prefix[owner/]widgetId. The shard is
+    the first shard_length hex characters of the md5 of the widgetId.
+    '''
+    key:str = key_prefix
+    if use_owner_in_prefix:
+        key += owner + '/'
+    key += str(widget_id)
+    if shard_length > 0:
+        shard:str = md5(str(widget_id).encode(), usedforsecurity=False).hexdigest()[:shard_length]
+        key = shard + '/' + key
+    return key
+
+def register_widget_store(name:str):
+    '''Class decorator that adds a WidgetStore to WIDGET_STORES under the given name.'''
+    def register(store_class:type) -> type:
+        store_class.name = name
+        WIDGET_STORES[name] = store_class
+        return store_class
+    return register
+
+class WidgetStore():
+    '''Base class for all widget stores. Stores only need put_widget and delete_widget; the batch
+    methods fall back to writing one widget at a time.
+    '''
+    name:str = None
+
+    def __init__(self, batch_size:int = 0, batch_interval:int = 0) -> None:
+        # How many requests the consumer should group into one write_widgets call (0 = none) and
+        # the longest time (in milliseconds) a request should wait for its group to fill.
+        self.batch_size:int = batch_size
+        self.batch_interval:int = batch_interval
+
+    @classmethod
+    def create(cls, consumer) -> 'WidgetStore':
+        '''Builds the store from the consumer's arguments and clients. Returns None if the
+        consumer was not configured to use this store.
+        '''
+        raise NotImplementedError
+
+    def put_widget(self, request:WidgetRequest) -> bool:
+        '''Creates or replaces the widget in the request.'''
+        raise NotImplementedError
+
+    def delete_widget(self, request:WidgetRequest) -> bool:
+        '''Deletes the widget in the request.'''
+        raise NotImplementedError
+
+    def put_widgets(self, requests:list[WidgetRequest]) -> list[WidgetRequest]:
+        '''Creates or replaces every widget in the requests. Returns the requests written.'''
+        return [request for request in requests if self.put_widget(request)]
+
+    def delete_widgets(self, requests:list[WidgetRequest]) -> list[WidgetRequest]:
+        '''Deletes every widget in the requests. Returns the requests written.'''
+        return [request for request in requests if self.delete_widget(request)]
+
+    def write_widgets(self, requests:list[WidgetRequest]) -> list[WidgetRequest]:
+        '''Writes a mix of create, update, and delete requests in order. Runs of puts and runs of
+        deletes are handed to put_widgets and delete_widgets. Returns the requests written.
+        '''
+        written:list[WidgetRequest] = []
+        run:list[WidgetRequest] = []
+        for request in requests:
+            if run and (run[-1].type == 'delete') != (request.type == 'delete'):
+                written += self._write_run(run)
+                run = []
+            run.append(request)
+        if run:
+            written += self._write_run(run)
+        return written
+
+    def _write_run(self, run:list[WidgetRequest]) -> list[WidgetRequest]:
+        '''Writes a run of requests that are all puts or all deletes.'''
+        if run[0].type == 'delete':
+            return self.delete_widgets(run)
+        return self.put_widgets(run)
+
+    def close(self) -> None:
+        '''Releases anything the store is holding on to.'''
+        pass
+
+@register_widget_store('s3')
+class S3WidgetStore(WidgetStore):
+    '''Saves each widget as a JSON object in an S3 bucket.'''
+    def __init__(self, s3, bucket:str, key_prefix:str, use_owner_in_prefix:bool,
+                 shard_length:int = 0) -> None:
+        super().__init__()
+        self.s3 = s3
+        self.bucket:str = bucket
+        self.key_prefix:str = key_prefix
+        self.use_owner_in_prefix:bool = use_owner_in_prefix
+        self.shard_length:int = shard_length
+
+    @classmethod
+    def create(cls, consumer) -> WidgetStore:
+        if consumer.widget_bucket is None:
+            return None
+        return cls(consumer.aws_s3, consumer.widget_bucket, consumer.widget_key_prefix,
+                   consumer.use_owner_in_prefix, consumer.widget_key_shard_length)
+
+    def widget_key(self, request:WidgetRequest) -> str:
+        '''Builds the key the widget is saved under.'''
+        return widget_key(request.widget_id, request.owner, self.key_prefix,
+                          self.use_owner_in_prefix, self.shard_length)
+
+    def put_widget(self, request:WidgetRequest) -> bool:
+        key:str = self.widget_key(request)
+        try:
+            logger.debug('Placing object into s3 using key: %s', key)
+            self.s3.put_object(Body=request.encoded_widget(), Bucket=self.bucket, Key=key)
+            logger.debug('Saved!')
+        except ClientError as e:
+            logger.warning(e)
+            return False
+
+        return True
+
+    def delete_widget(self, request:WidgetRequest) -> bool:
+        key:str = self.widget_key(request)
+        try:
+            logger.debug('Deleting widget: %s', key)
+            self.s3.delete_object(Bucket=self.bucket, Key=key)
+            logger.debug('Widget Deleted!')
+        except Exception as e:
+            logger.error(e)
+            return False
+
+        return True
+
+class ThreadLocalTable():
+    '''Hands every thread its own copy of a boto3 DynamoDB Table, since resources can't be shared
+    between threads. The copies share the table's client.
+    '''
+    def __init__(self, table) -> None:
+        self.table = table
+        self._local = local()
+        self._local.table = table
+
+    def get(self):
+        '''Returns this thread's copy of the table.'''
+        table = getattr(self._local, 'table', None)
+        if table is None:
+            table = self._local.table = type(self.table)(self.table.name,
+                                                         client=self.table.meta.client)
+        return table
+
+@register_widget_store('dynamodb')
+class DynamoDBWidgetStore(WidgetStore):
+    '''Saves each widget as an item in a DynamoDB table, keyed by id.'''
+    def __init__(self, table, batch_size:int = 0, batch_interval:int = 0) -> None:
+        super().__init__(batch_size, batch_interval)
+        self.tables = ThreadLocalTable(table)
+
+    @property
+    def table(self):
+        return self.tables.get()
+
+    @classmethod
+    def create(cls, consumer) -> WidgetStore:
+        if consumer.dynamodb_widget_table is None:
+            return None
+        return cls(consumer.aws_dynamodb_table, consumer.dynamodb_batch_size,
+                   consumer.dynamodb_batch_interval)
+
+    def widget_item(self, request:WidgetRequest) -> dict:
+        '''Converts a request into the item saved in the dynamodb table. Builds a new dict so the
+        widget the other stores see is left alone.
+        '''
+        item:dict = { key: value for key, value in request.widget.items()
+                      if key not in ('requestId', 'widgetId') }
+        # Adjust the id before sending it to dynamodb
+        item['id'] = request.widget_id
+        return item
+
+    def put_widget(self, request:WidgetRequest) -> bool:
+        try:
+            self.table.put_item(Item=self.widget_item(request))
+        except Exception as e:
+            logger.warning(e)
+            return False
+
+        return True
+
+    def put_widgets(self, requests:list[WidgetRequest]) -> list[WidgetRequest]:
+        '''Creates/replaces a batch of widgets using BatchWriteItem. Only the last write for each
+        widget is sent.
+        '''
+        try:
+            with self.table.batch_writer(overwrite_by_pkeys=['id']) as batch:
+                for request in requests:
+                    batch.put_item(Item=self.widget_item(request))
+        except Exception as e:
+            logger.warning('Failed to write batch of %d widgets: %s', len(requests), e)
+            return []
+
+        return requests
+
+    def delete_widget(self, request:WidgetRequest) -> bool:
+        '''Deletes the widget if it exists. BatchWriteItem can't check attribute_exists(id), so
+        deletes are always sent on their own, even when batching.
+        '''
+        try:
+            key:dict = { 'id': request.widget_id }
+            self.table.delete_item(
+                Key=key,
+                ConditionExpression='attribute_exists(id)'
+            )
+        except Exception as e:
+            logger.warning(e)
+            return False
+
+        return True
+
+@register_widget_store('postgres')
+class PostgresWidgetStore(WidgetStore):
+    '''Saves each widget as a jsonb row in a Postgres table, using a pool of connections.'''
+    def __init__(self, pool, table:str, batch_size:int, batch_interval:int) -> None:
+        super().__init__(batch_size, batch_interval)
+        self.pool = pool
+        self.table:str = table
+
+    @classmethod
+    def create(cls, consumer) -> WidgetStore:
+        if consumer.pdb_conn is None:
+            return None
+        if ConnectionPool is None:
+            logger.error('pdb-conn was set but psycopg is not installed')
+            raise ImportError('psycopg[binary] and psycopg_pool must be installed to use pdb-conn')
+
+        credentials:dict = {}
+        if consumer.pdb_username is not None:
+            credentials['user'] = consumer.pdb_username
+        if consumer.pdb_password is not None:
+            credentials['password'] = consumer.pdb_password
+        pool = ConnectionPool(consumer.pdb_conn, kwargs=credentials, min_size=1,
+                              max_size=consumer.pdb_pool_size, open=True)
+        store = cls(pool, consumer.pdb_table, consumer.pdb_batch_size,
+                    consumer.pdb_batch_interval)
+        store.create_table()
+        return store
+
+    def create_table(self) -> None:
+        '''Creates the widget table if it doesn't exist yet.'''
+        with self.pool.connection() as connection:
+            connection.execute(
+                sql.SQL('CREATE TABLE IF NOT EXISTS {} (id text PRIMARY KEY, owner text, ' +
+                        'widget jsonb NOT NULL)').format(sql.Identifier(self.table))
+            )
+
+    def put_widget(self, request:WidgetRequest) -> bool:
+        return len(self.write_widgets([request])) == 1
+
+    def delete_widget(self, request:WidgetRequest) -> bool:
+        return len(self.write_widgets([request])) == 1
+
+    def write_widgets(self, requests:list[WidgetRequest]) -> list[WidgetRequest]:
+        '''Writes create, update, and delete requests in a single transaction. Only the last
+        request for each widget is written.
+        '''
+        table = sql.Identifier(self.table)
+        try:
+            latest:dict[str, WidgetRequest] = { request.widget_id: request for request in requests }
+            upserts:list[tuple] = []
+            deletes:list[str] = []
+            for widget_id, request in latest.items():
+                if request.type == 'delete':
+                    deletes.append(widget_id)
+                else:
+                    upserts.append((widget_id, request.owner,
+                                    Jsonb(request, dumps=WidgetRequest.encoded_widget)))
+
+            with self.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    if upserts:
+                        cursor.executemany(
+                            sql.SQL('INSERT INTO {} (id, owner, widget) VALUES (%s, %s, %s) ' +
+                                    'ON CONFLICT (id) DO UPDATE SET owner = EXCLUDED.owner, ' +
+                                    'widget = EXCLUDED.widget').format(table),
+                            upserts
+                        )
+                    if deletes:
+                        cursor.execute(sql.SQL('DELETE FROM {} WHERE id = ANY(%s)').format(table),
+                                       (deletes,))
+        except Exception as e:
+            logger.warning('Failed to write batch of %d widgets to postgres: %s',
+                           len(requests), e)
+            return []
+
+        return requests
+
+    def close(self) -> None:
+        self.pool.close()
+
+class FanOutWidgetStore(WidgetStore):
+    '''Writes every request to several stores in parallel. A request only counts as written once
+    every store has written it.
+    '''
+    def __init__(self, stores:list[WidgetStore], callers:int = 1) -> None:
+        batching:list[WidgetStore] = [store for store in stores if store.batch_size > 0]
+        super().__init__(min((store.batch_size for store in batching), default=0),
+                         min((store.batch_interval for store in batching), default=0))
+        self.stores:list[WidgetStore] = stores
+        self.name = '+'.join(store.name for store in stores)
+        # Callers write the first store themselves, so each of the callers (threads writing at
+        # once) needs a thread for every other store
+        self.pool = ThreadPoolExecutor(max_workers=max(callers, 1) * max(len(stores) - 1, 1),
+                                       thread_name_prefix='widget-store')
+
+    def _call_stores(self, method:str, argument) -> list:
+        '''Calls the method on every store in parallel and returns what each one returned.'''
+        futures = [self.pool.submit(getattr(store, method), argument) for store in self.stores[1:]]
+        return [getattr(self.stores[0], method)(argument)] + \
+               [future.result() for future in futures]
+
+    def put_widget(self, request:WidgetRequest) -> bool:
+        return all(self._call_stores('put_widget', request))
+
+    def delete_widget(self, request:WidgetRequest) -> bool:
+        return all(self._call_stores('delete_widget', request))
+
+    def write_widgets(self, requests:list[WidgetRequest]) -> list[WidgetRequest]:
+        written:list[set[int]] = [{ id(request) for request in store_written }
+                                  for store_written in self._call_stores('write_widgets', requests)]
+        return [request for request in requests
+                if all(id(request) in store_written for store_written in written)]
+
+    def close(self) -> None:
+        for store in self.stores:
+            store.close()
+        self.pool.shutdown(wait=True)
+
+class WriteSuppressingWidgetStore(WidgetStore):
+    '''Wraps another store and skips updates that would save exactly what was last saved for the
+    widget. Only use this while a single consumer writes each widget.
+    '''
+    # Differ on every request without changing the widget
+    REQUEST_ONLY_KEYS = frozenset(('requestId', 'type'))
+
+    def __init__(self, store:WidgetStore, capacity:int,
+                 on_suppressed:Callable[[WidgetRequest], None] = None) -> None:
+        super().__init__(store.batch_size, store.batch_interval)
+        self.store:WidgetStore = store
+        self.name = store.name
+        self.capacity:int = capacity
+        self.on_suppressed = on_suppressed
+        self._hashes:OrderedDict[str, bytes] = OrderedDict()
+        self._lock = Lock()
+
+    def content_hash(self, request:WidgetRequest) -> bytes:
+        '''Hashes the widget without the fields that only describe the request.'''
+        content:dict = { key: value for key, value in request.widget.items()
+                         if key not in self.REQUEST_ONLY_KEYS }
+        return blake2b(dumps(content), digest_size=16).digest()
+
+    def _is_unchanged(self, request:WidgetRequest, content_hash:bytes) -> bool:
+        '''Returns whether the request is an update to what was last written for its widget.'''
+        if request.type != 'update':
+            return False
+        with self._lock:
+            if self._hashes.get(request.widget_id) != content_hash:
+                return False
+            self._hashes.move_to_end(request.widget_id)
+        if self.on_suppressed is not None:
+            self.on_suppressed(request)
+        return True
+
+    def _remember(self, request:WidgetRequest, content_hash:bytes) -> None:
+        with self._lock:
+            self._hashes[request.widget_id] = content_hash
+            self._hashes.move_to_end(request.widget_id)
+            if len(self._hashes) > self.capacity:
+                self._hashes.popitem(last=False)
+
+    def _forget(self, request:WidgetRequest) -> None:
+        with self._lock:
+            self._hashes.pop(request.widget_id, None)
+
+    def put_widget(self, request:WidgetRequest) -> bool:
+        content_hash:bytes = self.content_hash(request)
+        if self._is_unchanged(request, content_hash):
+            return True
+        if not self.store.put_widget(request):
+            self._forget(request)
+            return False
+        self._remember(request, content_hash)
+        return True
+
+    def delete_widget(self, request:WidgetRequest) -> bool:
+        self._forget(request) # Even if the delete fails, we no longer know what is saved
+        return self.store.delete_widget(request)
+
+    def write_widgets(self, requests:list[WidgetRequest]) -> list[WidgetRequest]:
+        '''Only checks a request against the cache if it is the first in the batch for its
+        widget. A later one depends on how the earlier writes went, so it is always written.
+        '''
+        to_write:list[tuple[WidgetRequest, bytes]] = []
+        suppressed:set[int] = set()
+        seen:set[str] = set()
+        for request in requests:
+            content_hash:bytes = None
+            if request.type == 'delete':
+                self._forget(request)
+            else:
+                content_hash = self.content_hash(request)
+                if request.widget_id not in seen and self._is_unchanged(request, content_hash):
+                    suppressed.add(id(request))
+                    seen.add(request.widget_id)
+                    continue
+            seen.add(request.widget_id)
+            to_write.append((request, content_hash))
+
+        written:set[int] = set()
+        if to_write:
+            written = { id(request) for request in
+                        self.store.write_widgets([request for request, _ in to_write]) }
+        for request, content_hash in to_write: # In order, so the last write for a widget wins
+            if content_hash is not None and id(request) in written:
+                self._remember(request, content_hash)
+            else:
+                self._forget(request)
+        return [request for request in requests
+                if id(request) in written or id(request) in suppressed]
+
+    def close(self) -> None:
+        self.store.close()
@@ -0,0 +1,94 @@
+'''Opt-in tools for finding out where the consumer spends its time: a cProfile wrapper that dumps
+pstats on exit or on SIGUSR1, and a sampled per-request trace written as NDJSON. Neither is
+created unless asked for, so the consumer pays nothing for them by default.
+'''
+
+from cProfile import Profile
+from json import dumps
+from logging import getLogger
+from random import random
+from threading import current_thread, Lock, main_thread
+from time import monotonic
+import signal
+
+logger = getLogger(__name__)
+
+class RequestTrace():
+    '''Monotonic timestamps of the stage boundaries a single request crossed.'''
+    __slots__ = ('start', 'marks')
+
+    def __init__(self) -> None:
+        self.start:float = monotonic()
+        self.marks:dict[str, float] = {}
+
+    def mark(self, stage:str) -> None:
+        '''Records that the request just finished the given stage.'''
+        self.marks[stage] = monotonic()
+
+class RequestTracer():
+    '''Starts a trace for a sample of requests and appends each finished trace to an NDJSON file,
+    one line per request.
+    '''
+    def __init__(self, path:str, sample_rate:float) -> None:
+        self.path:str = path
+        self.sample_rate:float = sample_rate
+        self._file = open(path, 'a', buffering=1)
+        self._lock = Lock()
+
+    def start(self) -> RequestTrace:
+        '''Returns a new trace if this request was sampled, otherwise None.'''
+        if random() >= self.sample_rate:
+            return None
+        return RequestTrace()
+
+    def finish(self, trace:RequestTrace, request, result:str) -> None:
+        '''Writes the trace out for a WidgetRequest. Stage times are milliseconds since the trace
+        started.
+        '''
+        line:str = dumps({
+            'requestId': request.request_id,
+            'type': request.type,
+            'result': result,
+            'start': trace.start,
+            'stages': { stage: round((mark - trace.start) * 1000, 3)
+                        for stage, mark in trace.marks.items() }
+        })
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + '\n')
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+class ConsumerProfiler():
+    '''Runs cProfile on the thread that starts it and dumps pstats to a file when stopped. When
+    started on the main thread, SIGUSR1 also dumps the stats so far without stopping.
+    '''
+    def __init__(self, path:str) -> None:
+        self.path:str = path
+        self.profile = Profile()
+        self._previous_handler = None
+
+    def start(self) -> None:
+        # Signal handlers can only be set from the main thread, and Windows has no SIGUSR1
+        if hasattr(signal, 'SIGUSR1') and current_thread() is main_thread():
+            self._previous_handler = signal.getsignal(signal.SIGUSR1)
+            signal.signal(signal.SIGUSR1, self._handle_signal)
+        self.profile.enable()
+
+    def dump(self) -> None:
+        '''Writes the stats collected so far to the output file.'''
+        self.profile.dump_stats(self.path)
+        logger.info('Profile written to %s', self.path)
+
+    def stop(self) -> None:
+        self.profile.disable()
+        if self._previous_handler is not None:
+            signal.signal(signal.SIGUSR1, self._previous_handler)
+            self._previous_handler = None
+        self.dump()
+
+    def _handle_signal(self, signal_number:int, frame) -> None:
+        self.dump()
+        self.profile.enable() # dump_stats stops the profiler, keep going until stop()
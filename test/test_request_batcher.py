@@ -0,0 +1,42 @@
+from time import sleep
+
+from source.request_batcher import RequestBatcher
+
+class TestRequestBatcher:
+    def test_flush_when_full(self):
+        # setup
+        batches:list[list] = []
+        batcher = RequestBatcher(batches.append, max_size=3, max_wait=60)
+
+        # exercise
+        for item in range(7):
+            batcher.add(item)
+
+        # verify
+        assert batches == [[0, 1, 2], [3, 4, 5]]
+        assert len(batcher) == 1
+
+    def test_flush_after_max_wait(self):
+        # setup
+        batches:list[list] = []
+        batcher = RequestBatcher(batches.append, max_size=10, max_wait=0.01)
+
+        # exercise
+        batcher.add('a')
+        batcher.add('b')
+        sleep(0.1)
+
+        # verify
+        assert batches == [['a', 'b']]
+        assert len(batcher) == 0
+
+    def test_flush_empty_does_nothing(self):
+        # setup
+        batches:list[list] = []
+        batcher = RequestBatcher(batches.append, max_size=10, max_wait=60)
+
+        # exercise
+        batcher.flush()
+
+        # verify
+        assert batches == []
@@ -0,0 +1,60 @@
+from source import run_deadline
+from source.run_deadline import RunDeadline
+
+class TestRunDeadline:
+    def test_remaining_counts_down_to_zero(self, mocker):
+        # setup
+        clock = mocker.patch.object(run_deadline, 'monotonic', return_value=100)
+        deadline = RunDeadline(10)
+
+        # exercise and verify
+        clock.return_value = 104
+        assert deadline.remaining() == 6
+        assert not deadline.expired()
+        clock.return_value = 111
+        assert deadline.remaining() == 0
+        assert deadline.expired()
+
+    def test_first_batch_sets_expected_time(self):
+        # setup
+        deadline = RunDeadline(10)
+
+        # exercise
+        deadline.record_batch(2)
+
+        # verify
+        assert deadline.expected_batch == 2
+
+    def test_expected_time_follows_recent_batches(self):
+        # setup
+        deadline = RunDeadline(10)
+        deadline.record_batch(1)
+
+        # exercise
+        deadline.record_batch(2)
+
+        # verify
+        assert deadline.expected_batch == 1 + run_deadline.BATCH_TIME_SMOOTHING
+
+    def test_fetch_budget_leaves_time_for_a_batch(self, mocker):
+        # setup
+        clock = mocker.patch.object(run_deadline, 'monotonic', return_value=0)
+        deadline = RunDeadline(5)
+        deadline.record_batch(2)
+
+        # exercise and verify
+        assert deadline.fetch_budget() == 3
+        assert deadline.should_fetch()
+        clock.return_value = 3.5
+        assert deadline.fetch_budget() == -0.5
+        assert not deadline.should_fetch()
+
+    def test_fetches_until_deadline_before_any_batch(self, mocker):
+        # setup
+        clock = mocker.patch.object(run_deadline, 'monotonic', return_value=0)
+        deadline = RunDeadline(1)
+
+        # exercise and verify
+        assert deadline.should_fetch()
+        clock.return_value = 1
+        assert not deadline.should_fetch()
@@ -0,0 +1,31 @@
+from pytest import raises
+
+from source import widget_codec
+from source.widget_codec import dumps, loads
+
+class TestWidgetCodec:
+    def test_round_trip_without_orjson(self, mocker):
+        # setup
+        mocker.patch.object(widget_codec, 'orjson', None)
+        widget:dict = { 'widgetId': 'a', 'label': 'café', 'otherAttributes': [] }
+
+        # exercise
+        body = dumps(widget)
+
+        # verify
+        assert body == '{"widgetId":"a","label":"café","otherAttributes":[]}'.encode()
+        assert loads(body) == widget
+
+    def test_dumps_matches_without_orjson(self, mocker):
+        # setup
+        widget:dict = { 'widgetId': 'a', 'size': 3, 'label': 'café' }
+        body = dumps(widget)
+        mocker.patch.object(widget_codec, 'orjson', None)
+
+        # exercise and verify
+        assert dumps(widget) == body
+
+    def test_invalid_json_is_value_error(self):
+        # exercise and verify
+        with raises(ValueError):
+            loads(b'{"type": ')
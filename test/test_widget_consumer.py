@@ -1,11 +1,18 @@
 from boto3 import client
 from botocore.exceptions import ClientError
-from json import dumps
+from json import dumps, loads
 from moto import mock_aws
 from queue import Queue
 from pytest import raises
+from threading import Thread
+from time import monotonic, sleep
 
+from source import widget_consumer
+from source.widget_request import WidgetRequest
+from source.widget_retry import FileDeadLetterSink
+from source.run_deadline import RunDeadline
 from source.widget_consumer import WidgetConsumer
+from source.widget_tracing import RequestTracer
 from test.test_widget_app_base import BaseArgReplica
 
 class ConsumerArgReplica(BaseArgReplica):
@@ -14,12 +21,105 @@ class ConsumerArgReplica(BaseArgReplica):
         self.max_runtime:int = 0
         self.widget_bucket:str = None
         self.widget_key_prefix:str = 'widgets/'
+        self.widget_key_shard_length:int = 0
         self.dynamodb_widget_table:str = None
         self.pdb_conn:str = None
         self.pdb_username:str = None
         self.pdb_password:str = None
+        self.pdb_table:str = 'widgets'
+        self.pdb_pool_size:int = 4
+        self.pdb_batch_size:int = 100
+        self.pdb_batch_interval:int = 100
+        self.fan_out:bool = False
+        self.write_cache_size:int = 0
+        self.idempotency_window:int = 0
+        self.idempotency_capacity:int = 100000
+        self.idempotency_table:str = None
         self.queue_wait_timeout:int = 10
         self.queue_visibility_timeout:int = 2
+        self.request_bucket_page_size:int = 1000
+        self.prefetch:int = 0
+        self.coalesce_requests:bool = False
+        self.coalesce_window:int = 0
+        self.ack_batch_size:int = 10
+        self.ack_flush_interval:int = 500
+        self.dynamodb_batch_size:int = 0
+        self.dynamodb_batch_interval:int = 100
+        self.idle_backoff_min:int = 10
+        self.idle_backoff_max:int = 5000
+        self.retry_max_attempts:int = 3
+        self.retry_base_delay:int = 100
+        self.retry_max_delay:int = 10000
+        self.dead_letter_file:str = None
+        self.dead_letter_queue:str = None
+        self.metrics_port:int = 0
+        self.metrics_host:str = '127.0.0.1'
+        self.workers:int = 0
+        self.processes:int = 0
+        self.profile_output:str = None
+        self.trace_output:str = None
+        self.trace_sample_rate:float = 0.01
+        self.log_sample_every:int = 1
+        self.log_rate_limit:int = 10
+
+def make_app(**arguments) -> WidgetConsumer:
+    '''Returns a consumer saved with the test arguments, changed by any given'''
+    args = ConsumerArgReplica()
+    for name, value in arguments.items():
+        setattr(args, name, value)
+    app = WidgetConsumer()
+    app.save_arguments(args)
+    return app
+
+def create_service_resources(app:WidgetConsumer) -> None:
+    '''Creates the service clients and the (mocked) widget bucket and table the app writes to'''
+    app._create_service_clients()
+    if app.widget_bucket is not None:
+        app.aws_s3.create_bucket(Bucket=app.widget_bucket)
+    if app.dynamodb_widget_table is not None:
+        app.aws_dynamodb.create_table(
+            AttributeDefinitions=[{ 'AttributeName': 'id', 'AttributeType': 'S' }],
+            TableName=app.dynamodb_widget_table,
+            KeySchema=[{ 'AttributeName': 'id', 'KeyType': 'HASH' }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+def setup_queue_app(widget_ids:list[str] = (), request_type:str = 'update',
+                    queue_name:str = 'test', **arguments) -> WidgetConsumer:
+    '''Returns a consumer reading from a (mocked) queue and writing to test-bucket, with a request
+    sent for each of the widget_ids'''
+    app = make_app(request_queue='test', widget_bucket='test-bucket', **arguments)
+    app.aws_sqs_queue = client('sqs', region_name='us-east-1')
+    attributes:dict = { 'FifoQueue': 'true' } if queue_name.endswith('.fifo') else {}
+    app.request_queue_url = app.aws_sqs_queue.create_queue(QueueName=queue_name,
+                                                           Attributes=attributes)['QueueUrl']
+    create_service_resources(app)
+    for widget_id in widget_ids:
+        send_request(app, request_type, widget_id)
+    return app
+
+def setup_bucket_app(keys:list[str] = (), **arguments) -> WidgetConsumer:
+    '''Returns a consumer reading from a (mocked) request bucket holding a create request for each
+    of the keys'''
+    app = make_app(request_bucket='test', **arguments)
+    create_service_resources(app)
+    app.aws_s3.create_bucket(Bucket=app.request_bucket)
+    for key in keys:
+        app.aws_s3.put_object(Body=dumps({ 'type': 'create', 'widgetId': key }),
+                              Bucket=app.request_bucket,
+                              Key=key)
+    return app
+
+def send_request(app:WidgetConsumer, request_type:str, widget_id:str, request_id:str = None,
+                 **message) -> None:
+    '''Sends a request for a widget to the app's queue, with the widget_id as its requestId unless
+    one is given'''
+    app.aws_sqs_queue.send_message(QueueUrl=app.request_queue_url, MessageBody=dumps({
+        'type': request_type,
+        'requestId': widget_id if request_id is None else request_id,
+        'owner': 'tester',
+        'widgetId': widget_id
+    }), **message)
 
 class TestWidgetConsumerVerifyArguments:
     def test_verify_arguments_negative_max_runtime(self):
@@ -97,6 +197,55 @@ class TestWidgetConsumerVerifyArguments:
         with raises(ValueError):
             app.verify_arguments(args)
 
+    def test_verify_arguments_ack_batch_size_too_large(self):
+        # setup
+        args = ConsumerArgReplica()
+        args.request_queue = 'test'
+        args.dynamodb_widget_table = 'test'
+        args.ack_batch_size = 11
+        app = WidgetConsumer()
+        
+        # exercise and verify
+        with raises(ValueError):
+            app.verify_arguments(args)
+
+    def test_verify_arguments_negative_workers(self):
+        # setup
+        args = ConsumerArgReplica()
+        args.request_bucket = 'test'
+        args.dynamodb_widget_table = 'test'
+        args.workers = -1
+        app = WidgetConsumer()
+        
+        # exercise and verify
+        with raises(ValueError):
+            app.verify_arguments(args)
+
+    def test_verify_arguments_retry_max_attempts_zero(self):
+        # setup
+        args = ConsumerArgReplica()
+        args.request_bucket = 'test'
+        args.dynamodb_widget_table = 'test'
+        args.retry_max_attempts = 0
+        app = WidgetConsumer()
+        
+        # exercise and verify
+        with raises(ValueError):
+            app.verify_arguments(args)
+
+    def test_verify_arguments_two_dead_letter_sinks(self):
+        # setup
+        args = ConsumerArgReplica()
+        args.request_bucket = 'test'
+        args.dynamodb_widget_table = 'test'
+        args.dead_letter_file = 'dead.ndjson'
+        args.dead_letter_queue = 'dead'
+        app = WidgetConsumer()
+        
+        # exercise and verify
+        with raises(ValueError):
+            app.verify_arguments(args)
+
 @mock_aws
 class TestWidgetConsumerGetRequestS3:
     def test_valid_get_request(self):
@@ -112,25 +261,26 @@ class TestWidgetConsumerGetRequestS3:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        widget:dict[str, str] = {
             'owner': 'tester',
             'widgetId': '1',
-            'request-bucket-key': '1',
             'type': 'create'
         }
 
         ## mock s3
         ### setup test object for request_bucket
         app.aws_s3.create_bucket(Bucket=args.request_bucket)
-        app.aws_s3.put_object(Body=dumps(request),
+        app.aws_s3.put_object(Body=dumps(widget),
                                Bucket=app.request_bucket, 
-                               Key=request['request-bucket-key'])
+                               Key='1')
 
         # exercise
         test_request = app._get_request_s3()
 
         # verify
-        assert request == test_request
+        assert widget == test_request.widget
+        assert test_request.bucket_key == '1'
+        assert test_request.body == dumps(widget).encode()
 
     def test_errored_get_request(self):
         # setup
@@ -151,7 +301,140 @@ class TestWidgetConsumerGetRequestS3:
         test_request = app._get_request_s3()
 
         # verify
-        assert { 'type' : 'unknown' } == test_request
+        assert test_request is None
+
+@mock_aws
+class TestWidgetConsumerRequestKeyBuffer:
+    def test_single_list_for_page(self, mocker):
+        # setup
+        app = setup_bucket_app(['1', '2', '3', '4', '5'])
+        spy = mocker.spy(app.aws_s3, 'list_objects_v2')
+
+        # exercise
+        requests = [app._get_request_s3() for _ in range(5)]
+
+        # verify
+        assert [request.widget_id for request in requests] == ['1', '2', '3', '4', '5']
+        assert spy.call_count == 1
+
+    def test_list_starts_after_cursor(self, mocker):
+        # setup
+        app = setup_bucket_app(['1', '2', '3', '4', '5'], request_bucket_page_size=2)
+        spy = mocker.spy(app.aws_s3, 'list_objects_v2')
+
+        # exercise
+        requests = [app._get_request_s3() for _ in range(5)]
+
+        # verify
+        assert [request.widget_id for request in requests] == ['1', '2', '3', '4', '5']
+        assert spy.call_count == 3
+        assert spy.call_args_list[1].kwargs['StartAfter'] == '2'
+        assert spy.call_args_list[2].kwargs['StartAfter'] == '4'
+
+    def test_prefetch_keeps_listing_order(self):
+        # setup
+        app = setup_bucket_app(['1', '2', '3', '4', '5'], request_bucket_page_size=2)
+        app.prefetch = 3
+        app._create_service_clients()
+
+        # exercise
+        requests = []
+        for _ in range(5):
+            requests.append(app._get_request_s3())
+            app._delete_object_S3(app.request_bucket, requests[-1].bucket_key)
+        app._stop_prefetch_pool()
+
+        # verify
+        assert [request.widget_id for request in requests] == ['1', '2', '3', '4', '5']
+        assert app._get_request_s3() is None
+
+    def test_prefetch_keeps_requests_in_flight(self):
+        # setup
+        app = setup_bucket_app(['1', '2', '3', '4', '5'])
+        app.prefetch = 3
+        app._create_service_clients()
+
+        # exercise
+        request = app._get_request_s3()
+        in_flight = len(app.prefetched_requests)
+        app._stop_prefetch_pool()
+
+        # verify
+        assert request.widget_id == '1'
+        assert in_flight == 2
+
+    def test_gone_keys_are_skipped(self):
+        # setup
+        app = setup_bucket_app(['3'])
+        app.request_key_buffer.extend(['1', '2']) # Listed, then taken by another consumer
+
+        # exercise
+        request = app._get_request_s3()
+
+        # verify
+        assert request.widget_id == '3'
+
+    def test_prefetch_skips_gone_keys(self):
+        # setup
+        app = setup_bucket_app(['3'])
+        app.prefetch = 2
+        app._create_service_clients()
+        app.request_key_buffer.extend(['1', '2'])
+
+        # exercise
+        request = app._get_request_s3()
+        app._stop_prefetch_pool()
+
+        # verify
+        assert request.widget_id == '3'
+
+    def test_invalid_requests_are_deleted(self):
+        # setup
+        app = setup_bucket_app(['2'])
+        app.aws_s3.put_object(Body='not json', Bucket=app.request_bucket, Key='1')
+
+        # exercise
+        request = app._get_request_s3()
+
+        # verify
+        assert request.widget_id == '2'
+        keys = [item['Key'] for item in
+                app.aws_s3.list_objects_v2(Bucket=app.request_bucket)['Contents']]
+        assert keys == ['2']
+        assert app.metrics.counters[(widget_consumer.INVALID_MESSAGES,
+                                     (('result', 'deleted'),))] == 1
+
+    def test_invalid_requests_are_dead_lettered(self, tmp_path):
+        # setup
+        app = setup_bucket_app([])
+        app.dead_letter = FileDeadLetterSink(str(tmp_path / 'dead.ndjson'))
+        app.aws_s3.put_object(Body='not json', Bucket=app.request_bucket, Key='1')
+
+        # exercise
+        request = app._get_request_s3()
+        app.dead_letter.close()
+
+        # verify
+        assert request is None
+        line:dict = loads((tmp_path / 'dead.ndjson').read_text())
+        assert line['messageId'] == '1'
+        assert line['body'] == 'not json'
+        assert 'Contents' not in app.aws_s3.list_objects_v2(Bucket=app.request_bucket).keys()
+
+    def test_cursor_resets_at_end_of_bucket(self):
+        # setup
+        app = setup_bucket_app(['5'])
+        assert app._get_request_s3().widget_id == '5'
+        app._delete_object_S3(app.request_bucket, '5')
+        app.aws_s3.put_object(Body=dumps({ 'type': 'create', 'widgetId': '1' }),
+                              Bucket=app.request_bucket,
+                              Key='1')
+
+        # exercise
+        request = app._get_request_s3()
+
+        # verify
+        assert request.widget_id == '1'
 
 @mock_aws
 class TestWidgetConsumerDeleteRequest:
@@ -168,19 +451,19 @@ class TestWidgetConsumerDeleteRequest:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'delete',
             'owner': 'tester',
-            'widgetId': '1',
-            'request-bucket-key': '1'
-        }
+            'widgetId': '1'
+        }, bucket_key='1')
         
         ## mock s3
         app.aws_s3.create_bucket(Bucket=args.request_bucket)
 
         ## Prep bucket to delete
-        app.aws_s3.put_object(Body=dumps(request), 
+        app.aws_s3.put_object(Body=dumps(request.widget), 
                               Bucket=args.request_bucket, 
-                              Key=request['request-bucket-key'])
+                              Key=request.bucket_key)
 
         # exercise and verify
         assert app._delete_request(request)
@@ -198,32 +481,906 @@ class TestWidgetConsumerDeleteRequest:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'delete',
             'owner': 'tester',
-            'widgetId': '1',
-            'request-bucket-key': '2'
-        }
+            'widgetId': '1'
+        }, bucket_key='2')
         
         ## mock s3
         app.aws_s3.create_bucket(Bucket=args.request_bucket)
 
         ## Prep bucket to delete
-        app.aws_s3.put_object(Body=dumps(request), 
+        app.aws_s3.put_object(Body=dumps(request.widget), 
                               Bucket=args.request_bucket, 
-                              Key=request['request-bucket-key'])
+                              Key=request.bucket_key)
 
         # exercise and verify
         assert app._delete_request(request)
 
+@mock_aws
+class TestWidgetConsumerAckRequestsQueue:
+    def test_requests_carry_receipt_handles(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+
+        # exercise
+        requests = [app._get_request_queue() for _ in range(3)]
+
+        # verify
+        assert len({ request.receipt_handle for request in requests }) == 3
+
+    def test_acks_are_batched(self, mocker):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        spy = mocker.spy(app.aws_sqs_queue, 'delete_message_batch')
+        requests = [app._get_request_queue() for _ in range(3)]
+
+        # exercise
+        for request in requests:
+            app.ack_batcher.add(request)
+        app.ack_batcher.flush()
+
+        # verify
+        assert spy.call_count == 1
+        response:dict = app.aws_sqs_queue.receive_message(
+            QueueUrl=app.request_queue_url,
+            VisibilityTimeout=0
+        )
+        assert 'Messages' not in response.keys()
+
+    def test_failed_request_does_not_shift_acks(self, mocker):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        app.queue_visibility_timeout = 0 # Let the failed message come straight back
+        requests = [app._get_request_queue() for _ in range(3)]
+        mocker.patch.object(app, 'update_widget', side_effect=[True, False, True])
+
+        # exercise
+        for request in requests:
+            app._process_and_acknowledge(request)
+        app.ack_batcher.flush()
+
+        # verify
+        response:dict = app.aws_sqs_queue.receive_message(
+            QueueUrl=app.request_queue_url,
+            VisibilityTimeout=0,
+            WaitTimeSeconds=0
+        )
+        assert len(response['Messages']) == 1
+        assert loads(response['Messages'][0]['Body'])['requestId'] == '2'
+
+    def test_invalid_messages_are_skipped(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        app.aws_sqs_queue.send_message(QueueUrl=app.request_queue_url,
+                                       MessageBody=dumps({ 'type': 'unknown', 'widgetId': '4' }))
+
+        # exercise
+        requests = [app._get_request_queue() for _ in range(3)]
+
+        # verify
+        assert sorted(request.widget_id for request in requests) == ['1', '2', '3']
+        assert app.request_queue.empty()
+        assert len(app.in_flight_messages) == 3
+        assert app.metrics.counters[(widget_consumer.INVALID_MESSAGES,
+                                     (('result', 'skipped'),))] == 1
+
+    def test_invalid_messages_are_dead_lettered(self, tmp_path):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        app.dead_letter = FileDeadLetterSink(str(tmp_path / 'dead.ndjson'))
+        app.aws_sqs_queue.send_message(QueueUrl=app.request_queue_url, MessageBody='not json')
+
+        # exercise
+        for _ in range(3):
+            app._get_request_queue()
+        app.dead_letter.close()
+
+        # verify
+        line:dict = loads((tmp_path / 'dead.ndjson').read_text())
+        assert line['body'] == 'not json'
+        assert line['error']
+        assert app.metrics.counters[(widget_consumer.INVALID_MESSAGES,
+                                     (('result', 'dead-letter'),))] == 1
+        attributes:dict = app.aws_sqs_queue.get_queue_attributes(
+            QueueUrl=app.request_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesNotVisible']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesNotVisible'] == '3' # Only the valid ones
+
+    def test_failed_ack_is_reported(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        request = app._get_request_queue()
+        request.receipt_handle = 'not-a-real-handle'
+
+        # exercise and verify
+        assert not app._delete_requests_from_queue([request])
+
+    def test_metadata_is_not_saved_with_widget(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        app.aws_s3.create_bucket(Bucket=app.widget_bucket)
+        request = app._get_request_queue()
+
+        # exercise
+        assert app._update_widget_s3(request)
+
+        # verify
+        response = app.aws_s3.get_object(Bucket=app.widget_bucket, Key='widgets/1')
+        assert loads(response['Body'].read()) == request.widget
+        assert request.receipt_handle is not None
+
+class TestWidgetConsumerCoalesceRequests:
+    def setup_app(self, mocker) -> WidgetConsumer:
+        app = make_app(request_queue='test', widget_bucket='test-bucket', coalesce_requests=True)
+        mocker.patch.object(app, '_acknowledge_request')
+        return app
+
+    def test_last_write_wins(self, mocker):
+        # setup
+        app = self.setup_app(mocker)
+        requests:list[WidgetRequest] = [WidgetRequest(widget) for widget in [
+            { 'type': 'update', 'requestId': '1', 'widgetId': 'a', 'price': '1.00' },
+            { 'type': 'update', 'requestId': '2', 'widgetId': 'b', 'price': '2.00' },
+            { 'type': 'update', 'requestId': '3', 'widgetId': 'a', 'price': '3.00' },
+        ]]
+
+        # exercise
+        coalesced = app._coalesce_requests(requests)
+
+        # verify
+        assert [request.request_id for request in coalesced] == ['2', '3']
+        assert coalesced[1].coalesced_requests == [requests[0]]
+        assert app._acknowledge_request.call_count == 0
+
+    def test_create_then_delete_is_dropped(self, mocker):
+        # setup
+        app = self.setup_app(mocker)
+        requests:list[WidgetRequest] = [WidgetRequest(widget) for widget in [
+            { 'type': 'create', 'requestId': '1', 'widgetId': 'a' },
+            { 'type': 'update', 'requestId': '2', 'widgetId': 'a' },
+            { 'type': 'delete', 'requestId': '3', 'widgetId': 'a' },
+        ]]
+
+        # exercise
+        coalesced = app._coalesce_requests(requests)
+
+        # verify
+        assert coalesced == []
+        assert app._acknowledge_request.call_count == 3
+
+    def test_update_then_delete_keeps_delete(self, mocker):
+        # setup
+        app = self.setup_app(mocker)
+        requests:list[WidgetRequest] = [WidgetRequest(widget) for widget in [
+            { 'type': 'update', 'requestId': '1', 'widgetId': 'a' },
+            { 'type': 'delete', 'requestId': '2', 'widgetId': 'a' },
+        ]]
+
+        # exercise
+        coalesced = app._coalesce_requests(requests)
+
+        # verify
+        assert [request.type for request in coalesced] == ['delete']
+
+@mock_aws
+class TestWidgetConsumerCoalesceRequestsQueue:
+    def test_coalesced_messages_are_acked(self):
+        # setup
+        app = setup_queue_app(coalesce_requests=True)
+        for request_id, price in [('1', '1.00'), ('2', '2.00')]:
+            app.aws_sqs_queue.send_message(
+                QueueUrl=app.request_queue_url,
+                MessageBody=dumps({
+                    'type': 'update',
+                    'requestId': request_id,
+                    'owner': 'tester',
+                    'widgetId': 'a',
+                    'price': price
+                })
+            )
+
+        # exercise
+        request = app._get_request_queue()
+        assert app._process_and_acknowledge(request)
+        app.ack_batcher.flush()
+
+        # verify
+        assert app.request_queue.empty()
+        response = app.aws_s3.get_object(Bucket=app.widget_bucket, Key='widgets/a')
+        assert loads(response['Body'].read())['price'] == '2.00'
+        response:dict = app.aws_sqs_queue.receive_message(
+            QueueUrl=app.request_queue_url,
+            VisibilityTimeout=0
+        )
+        assert 'Messages' not in response.keys()
+
+class TestWidgetConsumerBackOff:
+    def setup_app(self, mocker) -> WidgetConsumer:
+        app = make_app(request_bucket='test', widget_bucket='test-bucket', idle_backoff_min=10,
+                       idle_backoff_max=50)
+        mocker.patch('source.widget_consumer.sleep')
+        return app
+
+    def test_back_off_doubles_up_to_max(self, mocker):
+        # setup
+        app = self.setup_app(mocker)
+
+        # exercise
+        delays:list[int] = []
+        for _ in range(5):
+            app._back_off()
+            delays.append(app.idle_delay)
+
+        # verify
+        assert delays == [20, 40, 50, 50, 50]
+
+    def test_back_off_is_jittered(self, mocker):
+        # setup
+        app = self.setup_app(mocker)
+        app.idle_delay = 40
+
+        # exercise
+        app._back_off()
+
+        # verify
+        slept:float = widget_consumer.sleep.call_args.args[0]
+        assert 0.02 <= slept <= 0.04
+
+    def test_reset_backoff(self, mocker):
+        # setup
+        app = self.setup_app(mocker)
+        app._back_off()
+
+        # exercise
+        app._reset_backoff()
+
+        # verify
+        assert app.idle_delay == 0
+
+    def test_long_polling_queue_does_not_back_off(self, mocker):
+        # setup
+        app = self.setup_app(mocker)
+        app.request_bucket = None
+        app.request_queue_url = 'test'
+
+        # exercise
+        app._wait_for_requests()
+
+        # verify
+        assert widget_consumer.sleep.call_count == 0
+        assert app.idle_delay == 0
+
+@mock_aws
+class TestWidgetConsumerTracing:
+    def test_processed_request_is_traced(self, tmp_path):
+        # setup
+        app = setup_bucket_app(widget_bucket='test-bucket')
+        app.tracer = RequestTracer(str(tmp_path / 'trace.ndjson'), 1)
+        request = WidgetRequest({
+            'type': 'create',
+            'requestId': '1',
+            'owner': 'tester',
+            'widgetId': 'a'
+        })
+        request.trace = app.tracer.start()
+
+        # exercise
+        assert app._process_and_acknowledge(request)
+        app.tracer.close()
+
+        # verify
+        trace:dict = loads((tmp_path / 'trace.ndjson').read_text())
+        assert trace['requestId'] == '1'
+        assert trace['result'] == 'success'
+        assert list(trace['stages']) == ['store', 'ack']
+        response = app.aws_s3.get_object(Bucket=app.widget_bucket, Key='widgets/a')
+        assert loads(response['Body'].read()) == request.widget
+
+@mock_aws
+class TestWidgetConsumerStop:
+    def test_stop_ends_consume_requests(self):
+        # setup
+        app = make_app(request_bucket='test', widget_bucket='test-bucket', idle_backoff_min=10,
+                       idle_backoff_max=10)
+        client('s3', region_name='us-east-1').create_bucket(Bucket=app.request_bucket)
+        consumer = Thread(target=app.consume_requests)
+        consumer.start()
+
+        # exercise
+        app.stop()
+        consumer.join(timeout=5)
+
+        # verify
+        assert not consumer.is_alive()
+
+@mock_aws
+class TestWidgetConsumerMaxRuntime:
+    def test_runs_until_max_runtime(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'], 'create', max_runtime=500,
+                              queue_wait_timeout=0)
+
+        # exercise
+        start:float = monotonic()
+        app.consume_requests()
+        runtime:float = monotonic() - start
+
+        # verify
+        assert 0.4 <= runtime < 2 # Stops a batch early at most
+        for widget_id in ['1', '2', '3']:
+            app.aws_s3.get_object(Bucket='test-bucket', Key='widgets/' + widget_id)
+
+    def test_unprocessed_messages_released_at_deadline(self, mocker):
+        # setup
+        app = setup_queue_app(['1', '2', '3'], 'create', max_runtime=200,
+                              queue_wait_timeout=0)
+        mocker.patch.object(app, 'process_request',
+                            side_effect=lambda request: sleep(0.3) or True)
+
+        # exercise
+        app.consume_requests()
+
+        # verify
+        assert app.process_request.call_count == 1
+        response:dict = app.aws_sqs_queue.receive_message(QueueUrl=app.request_queue_url,
+                                                          MaxNumberOfMessages=10)
+        assert len(response['Messages']) == 2
+
+    def test_no_fetch_without_time_for_a_batch(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'], 'create', max_runtime=0,
+                              queue_wait_timeout=0)
+        app.deadline = RunDeadline(1)
+        app.deadline.record_batch(2)
+
+        # exercise and verify
+        assert not app._start_batch()
+
+    def test_long_poll_leaves_time_for_a_batch(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'], 'create', max_runtime=0,
+                              queue_wait_timeout=0)
+        app.queue_wait_timeout = 20
+        app.deadline = RunDeadline(10)
+        app.deadline.record_batch(4)
+
+        # exercise
+        wait_time:int = app._receive_wait_time()
+
+        # verify
+        assert wait_time == 5 # Just under 6 seconds left after the batch
+
+@mock_aws
+class TestWidgetConsumerVisibilityHeartbeat:
+    def test_received_messages_are_extended(self, mocker):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        request = app._get_request_queue()
+        spy = mocker.spy(app.aws_sqs_queue, 'change_message_visibility_batch')
+
+        # exercise
+        app._extend_visibility()
+
+        # verify
+        entries:list[dict] = spy.call_args.kwargs['Entries']
+        assert len(entries) == 3
+        assert request.receipt_handle in [entry['ReceiptHandle'] for entry in entries]
+        assert all(entry['VisibilityTimeout'] == 2 for entry in entries)
+
+    def test_acked_and_failed_messages_are_not_extended(self, mocker):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        app.retries.max_attempts = 1 # Give up on the failed request straight away
+        mocker.patch.object(app, 'update_widget', side_effect=[True, False])
+        acked = app._get_request_queue()
+        failed = app._get_request_queue()
+
+        # exercise
+        app._process_and_acknowledge(acked)
+        app._process_and_acknowledge(failed)
+        app.ack_batcher.flush()
+
+        # verify
+        assert len(app.in_flight_messages) == 1
+        assert acked.receipt_handle not in app.in_flight_messages.keys()
+        assert failed.receipt_handle not in app.in_flight_messages.keys()
+
+    def test_unprocessed_messages_released_on_stop(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'])
+        app._start_heartbeat()
+        app._get_request_queue()
+
+        # exercise
+        app._stop_heartbeat()
+
+        # verify
+        assert app.heartbeat_thread is None
+        assert app.in_flight_messages == {}
+        response:dict = app.aws_sqs_queue.receive_message(
+            QueueUrl=app.request_queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=0
+        )
+        assert len(response['Messages']) == 3
+
+@mock_aws
+class TestWidgetConsumerMetrics:
+    def test_stages_are_recorded(self):
+        # setup
+        app = setup_queue_app()
+        app.aws_sqs_queue.send_message(
+            QueueUrl=app.request_queue_url,
+            MessageBody=dumps({ 'type': 'create', 'requestId': '1', 'widgetId': '1' })
+        )
+
+        # exercise
+        assert app._process_and_acknowledge(app._get_request_queue())
+        app.ack_batcher.flush()
+
+        # verify
+        stages = { dict(labels)['stage'] for name, labels in app.metrics.histograms.keys() }
+        assert stages == { 'receive', 'decode', 'store', 'ack' }
+        assert app.metrics.counters[(widget_consumer.REQUESTS_PROCESSED,
+                                     (('backend', 's3'), ('type', 'create'),
+                                      ('result', 'success')))] == 1
+        assert app.metrics.counters[(widget_consumer.MESSAGES_ACKED,
+                                     (('backend', 'sqs'), ('result', 'success')))] == 1
+
+@mock_aws
+class TestWidgetConsumerWorkerPool:
+    def test_workers_process_and_ack_requests(self):
+        # setup
+        app = setup_queue_app(['1', '2', '3'], 'create', workers=2)
+
+        # exercise
+        app._start_worker_pool()
+        for _ in range(3):
+            app._submit_request(app._get_request_queue())
+        app._stop_worker_pool()
+        app.ack_batcher.flush()
+
+        # verify
+        for widget_id in ['1', '2', '3']:
+            app.aws_s3.get_object(Bucket=app.widget_bucket, Key='widgets/' + widget_id)
+        response:dict = app.aws_sqs_queue.receive_message(
+            QueueUrl=app.request_queue_url,
+            VisibilityTimeout=0
+        )
+        assert 'Messages' not in response.keys()
+        assert app.worker_pool is None
+
+    def test_worker_failure_frees_slot(self, mocker):
+        # setup
+        app = make_app(request_bucket='test', widget_bucket='test-bucket', workers=1)
+        app._create_retry_scheduler()
+        mocker.patch.object(app, 'update_widget', side_effect=RuntimeError('boom'))
+        requests = [WidgetRequest({
+            'type': 'create',
+            'owner': 'tester',
+            'widgetId': '1',
+        }) for _ in range(3)]
+
+        # exercise
+        app._start_worker_pool()
+        futures = [app._submit_request(request) for request in requests]
+        app._stop_worker_pool()
+
+        # verify
+        assert [future.result() for future in futures] == [False, False, False]
+        assert len(app.retries) == 3
+
+@mock_aws
+class TestWidgetConsumerRetry:
+    def setup_app(self, dead_letter_file:str = None) -> WidgetConsumer:
+        # Retries are due straight away
+        return setup_queue_app(['1'], retry_max_attempts=2, retry_base_delay=0,
+                               dead_letter_file=dead_letter_file)
+
+    def queue_is_empty(self, app:WidgetConsumer) -> bool:
+        response:dict = app.aws_sqs_queue.receive_message(QueueUrl=app.request_queue_url,
+                                                          VisibilityTimeout=0)
+        return 'Messages' not in response.keys()
+
+    def test_failed_request_is_retried(self, mocker):
+        # setup
+        app = self.setup_app()
+        mocker.patch.object(app, 'update_widget', side_effect=[False, True])
+        request = app._get_request_queue()
+
+        # exercise
+        first:bool = app._process_and_acknowledge(request)
+        retry = app._next_retry()
+        second:bool = app._process_and_acknowledge(retry)
+        app.ack_batcher.flush()
+
+        # verify
+        assert (first, second) == (False, True)
+        assert retry is request
+        assert app.metrics.counters[(widget_consumer.RETRIES_SCHEDULED, ())] == 1
+        assert self.queue_is_empty(app)
+
+    def test_retry_stays_in_flight(self, mocker):
+        # setup
+        app = self.setup_app()
+        mocker.patch.object(app, 'update_widget', side_effect=RuntimeError('boom'))
+        request = app._get_request_queue()
+
+        # exercise
+        app._process_and_acknowledge(request)
+
+        # verify
+        assert request.receipt_handle in app.in_flight_messages.keys()
+        assert len(app.retries) == 1
+
+    def test_poison_request_is_dead_lettered(self, mocker, tmp_path):
+        # setup
+        app = self.setup_app(dead_letter_file=str(tmp_path / 'dead.ndjson'))
+        mocker.patch.object(app, 'update_widget', side_effect=RuntimeError('boom'))
+        app._process_and_acknowledge(app._get_request_queue())
+
+        # exercise
+        app._process_and_acknowledge(app._next_retry())
+        app.ack_batcher.flush()
+        app.dead_letter.close()
+
+        # verify
+        line:dict = loads((tmp_path / 'dead.ndjson').read_text())
+        assert line['requestId'] == '1'
+        assert line['error'] == 'boom'
+        assert line['attempts'] == 2
+        assert app.metrics.counters[(widget_consumer.DEAD_LETTERED, (('sink', 'file'),))] == 1
+        assert len(app.retries) == 0
+        assert self.queue_is_empty(app)
+
+    def test_consume_loop_survives_errors(self, mocker):
+        # setup
+        app = make_app(request_bucket='test', widget_bucket='test-bucket')
+        mocker.patch.object(app, '_back_off')
+        calls:list[int] = []
+        def get_request():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('boom')
+            app.stop()
+        mocker.patch.object(app, '_get_request', side_effect=get_request)
+
+        # exercise
+        app.consume_requests()
+
+        # verify
+        assert len(calls) == 2
+
+    def test_retried_failures_do_not_back_off(self, mocker):
+        # setup
+        app = self.setup_app()
+        back_off = mocker.patch.object(app, '_back_off')
+        mocker.patch.object(app, 'update_widget', return_value=False)
+        requests = [WidgetRequest({ 'type': 'create', 'requestId': '2', 'widgetId': '2' })]
+        mocker.patch.object(app, '_get_request',
+                            side_effect=lambda: requests.pop() if requests else app.stop())
+
+        # exercise
+        app.consume_requests()
+
+        # verify
+        assert app.update_widget.call_count == 2 # Tried, then retried straight away
+        assert back_off.call_count == 0
+
+    def test_unreadable_bucket_requests_are_dead_lettered(self, mocker, tmp_path):
+        # setup
+        app = setup_bucket_app(['1'], widget_bucket='test-bucket', retry_max_attempts=2,
+                               dead_letter_file=str(tmp_path / 'dead.ndjson'))
+        mocker.patch.object(app.aws_s3, 'get_object', side_effect=ClientError(
+            { 'Error': { 'Code': 'AccessDenied', 'Message': 'denied' } }, 'GetObject'))
+
+        # exercise
+        requests = [app._get_request_s3() for _ in range(3)]
+        app.dead_letter.close()
+
+        # verify
+        assert requests == [None, None, None]
+        assert app.aws_s3.get_object.call_count == 2 # Skipped once it was given up on
+        line:dict = loads((tmp_path / 'dead.ndjson').read_text())
+        assert line['messageId'] == '1'
+        assert line['attempts'] == 2
+        assert line['body'] is None
+        assert app.metrics.counters[(widget_consumer.DEAD_LETTERED, (('sink', 'file'),))] == 1
+
+    def test_bucket_retries_are_put_back_on_stop(self):
+        # setup
+        app = setup_bucket_app(widget_bucket='test-bucket', retry_base_delay=10000)
+        request = WidgetRequest({
+            'type': 'create',
+            'requestId': '1',
+            'owner': 'tester',
+            'widgetId': '1'
+        }, bucket_key='1')
+        app.retries.schedule(request)
+
+        # exercise
+        app._drop_retries()
+
+        # verify
+        response = app.aws_s3.get_object(Bucket=app.request_bucket, Key='1')
+        assert loads(response['Body'].read()) == request.widget
+        assert len(app.retries) == 0
+
+@mock_aws
+class TestWidgetConsumerIdempotency:
+    def test_duplicate_requests_are_skipped(self, mocker):
+        # setup
+        app = setup_queue_app(idempotency_window=60)
+        for _ in range(2): # Sent twice, like SQS sometimes delivers a message twice
+            send_request(app, 'create', '1')
+        process_request = mocker.spy(app, 'process_request')
+
+        # exercise
+        for _ in range(2):
+            request = app._get_request_queue()
+            if not app._skip_duplicate(request):
+                app._process_and_acknowledge(request)
+        app.ack_batcher.flush()
+
+        # verify
+        assert process_request.call_count == 1
+        assert app.metrics.counters[(widget_consumer.DUPLICATES_SKIPPED, ())] == 1
+        response:dict = app.aws_sqs_queue.receive_message(QueueUrl=app.request_queue_url,
+                                                          VisibilityTimeout=0)
+        assert 'Messages' not in response.keys()
+
+@mock_aws
+class TestWidgetConsumerFifoQueue:
+    def send_requests(self, app:WidgetConsumer, requests:list[tuple[str, str]]) -> None:
+        for index, (request_type, widget_id) in enumerate(requests):
+            send_request(app, request_type, widget_id, str(index), MessageGroupId=widget_id,
+                         MessageDeduplicationId=str(index))
+
+    def test_requests_carry_message_group(self):
+        # setup
+        app = setup_queue_app(queue_name='test.fifo')
+        self.send_requests(app, [('create', '1')])
+
+        # exercise
+        request:WidgetRequest = app._get_request_queue()
+
+        # verify
+        assert app.fifo_queue
+        assert request.message_group_id == '1'
+        assert request.partition_key == '1'
+
+    def test_groups_stay_in_order_across_workers(self, mocker):
+        # setup
+        app = setup_queue_app(queue_name='test.fifo', workers=3)
+        requests = [WidgetRequest({ 'type': 'update', 'requestId': str(index),
+                                    'widgetId': str(index % 4) }, message_group_id=str(index % 4))
+                    for index in range(40)]
+        written:list[WidgetRequest] = []
+        mocker.patch.object(app, 'process_request',
+                            side_effect=lambda request: written.append(request) or True)
+
+        # exercise
+        app._start_worker_pool()
+        for request in requests:
+            app._submit_request(request)
+        app._stop_worker_pool()
+
+        # verify
+        for group in ['0', '1', '2', '3']:
+            assert [request for request in written if request.message_group_id == group] == \
+                   [request for request in requests if request.message_group_id == group]
+
+    def test_failed_request_holds_back_its_group(self, mocker):
+        # setup
+        app = setup_queue_app(queue_name='test.fifo')
+        self.send_requests(app, [('create', '1'), ('update', '1'), ('create', '2')])
+        mocker.patch.object(app, 'process_request',
+                            side_effect=lambda request: request.request_id != '0')
+
+        # exercise
+        results = [app._process_and_acknowledge(app._get_request_queue()) for _ in range(3)]
+
+        # verify
+        assert results == [False, False, True]
+        assert app.failed_groups == {'1'}
+        assert app.process_request.call_count == 2 # The update after the failure was skipped
+
+    def make_group_requests(self) -> list[WidgetRequest]:
+        return [WidgetRequest({ 'type': request_type, 'requestId': str(index), 'owner': 'tester',
+                                'widgetId': group }, message_group_id=group)
+                for index, (request_type, group) in enumerate([('delete', '1'), ('create', '1'),
+                                                               ('create', '2')])]
+
+    def test_failed_batch_write_holds_back_its_group(self, mocker):
+        # setup
+        app = setup_queue_app(queue_name='test.fifo')
+        requests = self.make_group_requests()
+        write_widgets = mocker.patch.object(
+            app.widget_store, 'write_widgets',
+            side_effect=lambda batch: [request for request in batch if request.request_id != '0'])
+        ack = mocker.patch.object(app, '_acknowledge_request')
+
+        # exercise
+        assert not app._write_widget_batch(requests)
+
+        # verify
+        ack.assert_called_once_with(requests[2])
+        assert requests[1] not in [request for call in write_widgets.call_args_list
+                                   for request in call.args[0]]
+        assert app.failed_groups == {'1'}
+
+    def test_failed_process_write_holds_back_its_group(self, mocker):
+        # setup
+        worker = setup_queue_app(queue_name='test.fifo') # Stands in for the worker process
+        requests = self.make_group_requests()
+        mocker.patch.object(worker.widget_store, 'write_widgets',
+                            side_effect=lambda batch: [request for request in batch
+                                                       if request.request_id != '0'])
+        results = Queue()
+
+        # exercise
+        worker._write_partition_batch(0, [(sequence, request.encoded_widget(),
+                                           request.message_group_id, 1)
+                                          for sequence, request in enumerate(requests)], results)
+        worker._write_partition_batch(0, [(3, requests[1].encoded_widget(), '1', 1)], results)
+        worker._write_partition_batch(0, [(4, requests[1].encoded_widget(), '1', 2)], results)
+
+        # verify
+        assert [results.get()[2:4] for _ in range(5)] == \
+               [(0, False), (1, False), (2, True), (3, False), (4, True)]
+        assert worker.failed_group_batches == {}
+
+@mock_aws
+class TestWidgetConsumerWorkerProcesses:
+    def setup_app(self) -> WidgetConsumer:
+        app = setup_queue_app(processes=1)
+
+        # Stand in for _start_worker_processes without spawning anything
+        app.process_queues = [Queue()]
+        app.process_pending = [{}]
+        app.worker_slots = widget_consumer.BoundedSemaphore(widget_consumer.PROCESS_QUEUE_DEPTH)
+        return app
+
+    def test_partition_is_stable(self):
+        # exercise and verify
+        partitions = [widget_consumer.widget_partition(str(widget_id), 4)
+                      for widget_id in range(100)]
+        assert partitions == [widget_consumer.widget_partition(str(widget_id), 4)
+                              for widget_id in range(100)]
+        assert set(partitions) == {0, 1, 2, 3}
+
+    def test_verify_arguments_workers_and_processes(self):
+        # setup
+        args = ConsumerArgReplica()
+        args.request_bucket = 'test'
+        args.widget_bucket = 'test'
+        args.workers = 2
+        args.processes = 2
+        app = WidgetConsumer()
+
+        # exercise and verify
+        with raises(ValueError):
+            app.verify_arguments(args)
+
+    def test_supervisor_acks_what_workers_write(self):
+        # setup
+        app = self.setup_app()
+        for widget_id in ['1', '2', '3']:
+            app.aws_sqs_queue.send_message(
+                QueueUrl=app.request_queue_url,
+                MessageBody=dumps({
+                    'type': 'create',
+                    'requestId': widget_id,
+                    'owner': 'tester',
+                    'widgetId': widget_id
+                })
+            )
+        results = Queue()
+        worker = WidgetConsumer() # Stands in for the worker process
+        worker.save_arguments(app.arguments)
+        worker._create_store_clients()
+
+        # exercise
+        for _ in range(3):
+            app._submit_to_process(app._get_request_queue())
+        app.process_queues[0].put(None)
+        worker._serve_partition(0, app.process_queues[0], results)
+        while not results.empty():
+            app._handle_process_message(results.get())
+        app.ack_batcher.flush()
+
+        # verify
+        for widget_id in ['1', '2', '3']:
+            app.aws_s3.get_object(Bucket='test-bucket', Key='widgets/' + widget_id)
+        response:dict = app.aws_sqs_queue.receive_message(
+            QueueUrl=app.request_queue_url,
+            VisibilityTimeout=0
+        )
+        assert 'Messages' not in response.keys()
+        assert app.process_pending == [{}]
+        assert app.metrics.counters[(widget_consumer.REQUESTS_PROCESSED,
+                                     (('backend', 's3'), ('type', 'create'),
+                                      ('result', 'success')))] == 3
+
+    def test_failed_write_is_retried(self):
+        # setup
+        app = self.setup_app()
+        request = WidgetRequest({ 'type': 'create', 'owner': 'tester', 'widgetId': '1' })
+        app._submit_to_process(request)
+
+        # exercise
+        app._handle_process_message((widget_consumer.PROCESS_RESULT, 0, 0, False, 'boom'))
+
+        # verify
+        assert app.widget_store is None
+        assert app.process_pending == [{}]
+        assert len(app.retries) == 1
+        assert request.attempts == 1
+
+    def test_failed_write_is_forgotten_after_last_attempt(self):
+        # setup
+        app = self.setup_app()
+        app.retries.max_attempts = 1
+        app.aws_sqs_queue.send_message(QueueUrl=app.request_queue_url, MessageBody=dumps({
+            'type': 'create',
+            'requestId': '1',
+            'owner': 'tester',
+            'widgetId': '1'
+        }))
+        request = app._get_request_queue()
+        app._submit_to_process(request)
+
+        # exercise
+        app._handle_process_message((widget_consumer.PROCESS_RESULT, 0, 0, False, 'boom'))
+
+        # verify
+        assert request.receipt_handle not in app.in_flight_messages.keys()
+        assert len(app.retries) == 0
+
+    def test_failed_group_is_not_sent_to_process(self):
+        # setup
+        app = self.setup_app()
+        app.failed_groups = {'1'}
+        request = WidgetRequest({ 'type': 'update', 'owner': 'tester', 'widgetId': '1' },
+                                message_group_id='1')
+
+        # exercise
+        app._submit_to_process(request)
+
+        # verify
+        assert app.process_queues[0].empty()
+        assert app.process_pending == [{}]
+
+    def test_crashed_process_is_restarted(self, mocker):
+        # setup
+        app = self.setup_app()
+        app.worker_processes = [mocker.Mock(is_alive=mocker.Mock(return_value=False), exitcode=1)]
+        mocker.patch.object(app, '_start_worker_process',
+                            side_effect=lambda index: app.process_queues.__setitem__(index, Queue()))
+        requests = [WidgetRequest({ 'type': 'create', 'owner': 'tester', 'widgetId': '1' }),
+                    WidgetRequest({ 'type': 'delete', 'owner': 'tester', 'widgetId': '1' })]
+        app.process_pending[0] = { 7: requests[1], 3: requests[0] }
+
+        # exercise
+        app._check_worker_processes()
+
+        # verify
+        app._start_worker_process.assert_called_once_with(0)
+        assert [app.process_queues[0].get_nowait()[0] for _ in range(2)] == [3, 7]
+        assert app.metrics.counters[(widget_consumer.WORKER_RESTARTS, ())] == 1
+
 class TestWidgetConsumerProcessRequest:
     def test_valid_update_widget_request(self, mocker):
         # setup
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
             'type': 'create',
             'owner': 'tester',
             'widgetId': '1',
-        }
+        })
 
         # app (mock the update_widget function so we don't do all the work)
         app = WidgetConsumer()
@@ -235,18 +1392,15 @@ class TestWidgetConsumerProcessRequest:
     def test_invalid_request(self):
         # setup
         ## request
-        request:dict[str, str] = {
+        widget:dict[str, str] = {
             'type': 'unknown',
             'owner': 'tester',
             'widgetId': '1',
         }
 
-        # app (mock the update_widget function so we don't do all the work)
-        app = WidgetConsumer()
-        
-        # Exercise and Verify
+        # Exercise and Verify (unknown types are turned away when the request is decoded)
         with raises(ValueError):
-            app.process_request(request)
+            WidgetRequest(widget)
 
 @mock_aws
 class TestWidgetConsumerUpdateWidgetS3:
@@ -264,10 +1418,11 @@ class TestWidgetConsumerUpdateWidgetS3:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'update',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock s3
         app.aws_s3.create_bucket(Bucket=args.widget_bucket)
@@ -294,10 +1449,11 @@ class TestWidgetConsumerUpdateWidgetS3:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'update',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock s3
         app.aws_s3.create_bucket(Bucket=args.widget_bucket)
@@ -323,10 +1479,11 @@ class TestWidgetConsumerUpdateWidgetS3:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'update',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock s3
         app.aws_s3.create_bucket(Bucket='test')
@@ -350,11 +1507,12 @@ class TestWidgetConsumerUpdateWidgetDynamoDB:
         app.aws_dynamodb = client('dynamodb', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'update',
             'owner': 'tester',
             'requestId': '1',
             'widgetId': '1'
-        }
+        })
 
         ## mock dynamodb
         app.aws_dynamodb.create_table(
@@ -395,10 +1553,11 @@ class TestWidgetConsumerUpdateWidgetDynamoDB:
         app.aws_dynamodb = client('dynamodb', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'update',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock dynamodb
         app.aws_dynamodb.create_table(
@@ -425,6 +1584,132 @@ class TestWidgetConsumerUpdateWidgetDynamoDB:
         # exercise and verify
         assert not app._update_widget_dynamodb(request)
 
+@mock_aws
+class TestWidgetConsumerDynamoDBBatch:
+    def test_writes_are_batched(self, mocker):
+        # setup
+        app = setup_bucket_app(dynamodb_widget_table='test-table', dynamodb_batch_size=25,
+                               dynamodb_batch_interval=60000)
+        spy = mocker.spy(app.aws_dynamodb_table.meta.client, 'batch_write_item')
+        put_spy = mocker.spy(app.aws_dynamodb_table, 'put_item')
+
+        # exercise
+        for widget_id in ['1', '2', '3', '2']:
+            assert app._process_and_acknowledge(WidgetRequest({
+                'type': 'update',
+                'requestId': widget_id,
+                'owner': 'tester',
+                'widgetId': widget_id
+            }))
+        app.store_batcher.flush()
+
+        # verify
+        assert spy.call_count == 1
+        assert put_spy.call_count == 0
+        response:dict = app.aws_dynamodb_table.scan()
+        assert sorted(item['id'] for item in response['Items']) == ['1', '2', '3']
+
+    def test_requests_acked_after_batch_written(self, mocker):
+        # setup
+        app = setup_bucket_app(dynamodb_widget_table='test-table', dynamodb_batch_size=25,
+                               dynamodb_batch_interval=60000)
+        ack = mocker.patch.object(app, '_acknowledge_request')
+        request = WidgetRequest({
+            'type': 'create',
+            'requestId': '1',
+            'owner': 'tester',
+            'widgetId': '1'
+        })
+
+        # exercise and verify
+        app._process_and_acknowledge(request)
+        assert ack.call_count == 0
+        app.store_batcher.flush()
+        ack.assert_called_once_with(request)
+
+    def test_batch_keeps_request_order(self):
+        # setup
+        app = setup_bucket_app(dynamodb_widget_table='test-table', dynamodb_batch_size=25,
+                               dynamodb_batch_interval=60000)
+        app._process_and_acknowledge(WidgetRequest({
+            'type': 'create',
+            'requestId': '1',
+            'owner': 'tester',
+            'widgetId': '1'
+        }))
+
+        # exercise
+        assert app._process_and_acknowledge(WidgetRequest({
+            'type': 'delete',
+            'requestId': '2',
+            'owner': 'tester',
+            'widgetId': '1'
+        }))
+        app.store_batcher.flush()
+
+        # verify
+        assert len(app.store_batcher) == 0
+        assert 'Item' not in app.aws_dynamodb_table.get_item(Key={ 'id': '1' }).keys()
+
+@mock_aws
+class TestWidgetConsumerWidgetStores:
+    def setup_app(self, fan_out:bool) -> WidgetConsumer:
+        return setup_bucket_app(widget_bucket='test-bucket', dynamodb_widget_table='test-table',
+                                fan_out=fan_out)
+
+    def test_first_store_is_used(self):
+        # setup
+        app = self.setup_app(fan_out=False)
+
+        # exercise
+        assert app.update_widget(WidgetRequest({ 'type': 'create', 'requestId': '1', 'widgetId': '1' }))
+
+        # verify
+        assert list(app.widget_stores.keys()) == ['s3', 'dynamodb']
+        app.aws_s3.get_object(Bucket=app.widget_bucket, Key='widgets/1')
+        assert 'Item' not in app.aws_dynamodb_table.get_item(Key={ 'id': '1' }).keys()
+
+    def test_fan_out_writes_every_store(self):
+        # setup
+        app = self.setup_app(fan_out=True)
+
+        # exercise
+        assert app.update_widget(WidgetRequest({ 'type': 'create', 'requestId': '1', 'widgetId': '1' }))
+        app.widget_store.close()
+
+        # verify
+        app.aws_s3.get_object(Bucket=app.widget_bucket, Key='widgets/1')
+        assert 'Item' in app.aws_dynamodb_table.get_item(Key={ 'id': '1' }).keys()
+
+    def test_unchanged_updates_are_suppressed(self, mocker):
+        # setup
+        app = setup_bucket_app(widget_bucket='test-bucket', write_cache_size=10)
+        put_object = mocker.spy(app.aws_s3, 'put_object')
+
+        # exercise
+        for request_id in ['1', '2', '3']:
+            assert app.update_widget(WidgetRequest({ 'type': 'update', 'requestId': request_id,
+                                                     'widgetId': '1', 'size': 3 }))
+
+        # verify
+        assert put_object.call_count == 1
+        assert app.widget_store.name == 's3'
+        assert app.metrics.counters[(widget_consumer.WRITES_SUPPRESSED, (('backend', 's3'),))] == 2
+
+    def test_unwritten_requests_are_not_acked(self, mocker):
+        # setup
+        app = self.setup_app(fan_out=False)
+        ack = mocker.patch.object(app, '_acknowledge_request')
+        requests:list[WidgetRequest] = [WidgetRequest(widget) for widget in [
+            { 'type': 'create', 'requestId': '1', 'widgetId': '1' },
+            { 'type': 'create', 'requestId': '2', 'widgetId': '2' },
+        ]]
+        mocker.patch.object(app.widget_store, 'write_widgets', return_value=requests[1:])
+
+        # exercise and verify
+        assert not app._write_widget_batch(requests)
+        ack.assert_called_once_with(requests[1])
+
 @mock_aws
 class TestWidgetConsumerDeleteWidgetS3:
     def test_delete_widget_s3_no_name_in_prefix(self):
@@ -441,16 +1726,17 @@ class TestWidgetConsumerDeleteWidgetS3:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'delete',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock s3 and prep it
         app.aws_s3.create_bucket(Bucket=args.widget_bucket)
-        app.aws_s3.put_object(Body=dumps(request), 
+        app.aws_s3.put_object(Body=dumps(request.widget), 
                                Bucket=args.widget_bucket, 
-                               Key=request['widgetId'])
+                               Key=request.widget_id)
 
         # exercise and verify
         assert app._delete_widget_s3(request)
@@ -470,16 +1756,17 @@ class TestWidgetConsumerDeleteWidgetS3:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'delete',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock s3 and prep it
         app.aws_s3.create_bucket(Bucket=args.widget_bucket)
-        app.aws_s3.put_object(Body=dumps(request), 
+        app.aws_s3.put_object(Body=dumps(request.widget), 
                                Bucket=args.widget_bucket, 
-                               Key=request['widgetId'])
+                               Key=request.widget_id)
 
         # exercise and verify
         assert app._delete_widget_s3(request)
@@ -502,16 +1789,17 @@ class TestWidgetConsumerDeleteWidgetS3:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'delete',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock s3
         app.aws_s3.create_bucket(Bucket='test')
-        app.aws_s3.put_object(Body=dumps(request), 
+        app.aws_s3.put_object(Body=dumps(request.widget), 
                                Bucket='test', 
-                               Key=request['widgetId'])
+                               Key=request.widget_id)
 
         # exercise and verify
         assert not app._delete_widget_s3(request)
@@ -530,10 +1818,11 @@ class TestWidgetConsumerDeleteWidgetS3:
         app.aws_s3 = client('s3', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'delete',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock s3
         app.aws_s3.create_bucket(Bucket=args.request_bucket)
@@ -557,10 +1846,11 @@ class TestWidgetConsumerDeleteWidgetDynamoDB:
         app.aws_dynamodb = client('dynamodb', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'delete',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock dynamodb
         app.aws_dynamodb.create_table(
@@ -583,14 +1873,14 @@ class TestWidgetConsumerDeleteWidgetDynamoDB:
                 'WriteCapacityUnits': 1
             },
         )
-        add_request = request
-        add_request['id'] = request['widgetId']
+        add_request = dict(request.widget)
+        add_request['id'] = request.widget_id
         app.aws_dynamodb_table.put_item(Item=add_request)
 
         # exercise and verify
         assert app._delete_widget_dynamodb(request)
         response:dict = app.aws_dynamodb_table.get_item(TableName=args.dynamodb_widget_table,
-                                                   Key={ 'id': request['id']})
+                                                   Key={ 'id': add_request['id']})
         assert 'Item' not in response.keys()
 
     def test_invalid_delete_widget_dynamodb(self):
@@ -607,10 +1897,11 @@ class TestWidgetConsumerDeleteWidgetDynamoDB:
         app.aws_dynamodb = client('dynamodb', region_name='us-east-1')
 
         ## request
-        request:dict[str, str] = {
+        request = WidgetRequest({
+            'type': 'delete',
             'owner': 'tester',
             'widgetId': '1'
-        }
+        })
 
         ## mock dynamodb
         app.aws_dynamodb.create_table(
@@ -633,12 +1924,12 @@ class TestWidgetConsumerDeleteWidgetDynamoDB:
                 'WriteCapacityUnits': 1
             },
         )
-        add_request = request
+        add_request = dict(request.widget)
         add_request['id'] = '2'
         app.aws_dynamodb_table.put_item(Item=add_request)
 
         # exercise and verify
         assert not app._delete_widget_dynamodb(request)
         response:dict = app.aws_dynamodb_table.get_item(TableName=args.dynamodb_widget_table,
-                                                   Key={ 'id': request['id']})
+                                                   Key={ 'id': add_request['id']})
         assert 'Item' in response.keys()
\ No newline at end of file
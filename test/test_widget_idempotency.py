@@ -0,0 +1,79 @@
+from boto3 import resource
+from moto import mock_aws
+from time import time
+
+from source import widget_idempotency
+from source.widget_idempotency import DynamoDBIdempotencyStore, IdempotencyStore
+
+class TestIdempotencyStore:
+    def test_recorded_requests_are_seen(self):
+        # setup
+        store = IdempotencyStore(60, 10)
+
+        # exercise
+        store.record('1')
+
+        # verify
+        assert store.seen('1')
+        assert not store.seen('2')
+
+    def test_requests_expire(self, mocker):
+        # setup
+        clock = mocker.patch.object(widget_idempotency, 'monotonic', return_value=100)
+        store = IdempotencyStore(60, 10)
+        store.record('1')
+        clock.return_value = 150
+        store.record('2')
+
+        # exercise
+        clock.return_value = 161
+
+        # verify
+        assert not store.seen('1')
+        assert store.seen('2')
+        assert list(store._expiries.keys()) == ['2']
+
+    def test_capacity_evicts_oldest(self):
+        # setup
+        store = IdempotencyStore(60, 2)
+
+        # exercise
+        for request_id in ['1', '2', '3']:
+            store.record(request_id)
+
+        # verify
+        assert [store.seen(request_id) for request_id in ['1', '2', '3']] == [False, True, True]
+
+@mock_aws
+class TestDynamoDBIdempotencyStore:
+    def setup_table(self):
+        return resource('dynamodb', region_name='us-east-1').create_table(
+            AttributeDefinitions=[{ 'AttributeName': 'requestId', 'AttributeType': 'S' }],
+            TableName='test-requests',
+            KeySchema=[{ 'AttributeName': 'requestId', 'KeyType': 'HASH' }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+    def test_requests_are_shared_between_stores(self):
+        # setup
+        table = self.setup_table()
+        first = DynamoDBIdempotencyStore(table, 60, 10)
+        second = DynamoDBIdempotencyStore(table, 60, 10)
+
+        # exercise
+        first.record('1')
+        first.close()
+
+        # verify
+        assert second.seen('1')
+        assert not second.seen('2')
+        assert table.get_item(Key={ 'requestId': '1' })['Item']['expiresAt'] > time()
+
+    def test_expired_items_are_not_seen(self):
+        # setup
+        table = self.setup_table()
+        table.put_item(Item={ 'requestId': '1', 'expiresAt': int(time()) - 1 })
+        store = DynamoDBIdempotencyStore(table, 60, 10)
+
+        # exercise and verify
+        assert not store.seen('1')
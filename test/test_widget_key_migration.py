@@ -0,0 +1,55 @@
+from boto3 import client
+from moto import mock_aws
+
+from source.widget_key_migration import WidgetKeyMigration
+from source.widget_store import widget_key
+
+@mock_aws
+class TestWidgetKeyMigration:
+    def setup_bucket(self, keys:list[str]):
+        s3 = client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='test-bucket')
+        for key in keys:
+            s3.put_object(Bucket='test-bucket', Key=key, Body=b'{}')
+        return s3
+
+    def list_keys(self, s3) -> set[str]:
+        return { item['Key'] for item in
+                 s3.list_objects_v2(Bucket='test-bucket').get('Contents', []) }
+
+    def test_moves_widgets_to_sharded_keys(self):
+        # setup
+        s3 = self.setup_bucket(['widgets/tester/1', 'widgets/tester/2', 'other/3'])
+        migration = WidgetKeyMigration(s3, 'test-bucket', 'widgets/', True, 0, 2)
+
+        # exercise
+        moved, failed = migration.run()
+
+        # verify
+        assert (moved, failed) == (2, 0)
+        assert self.list_keys(s3) == { widget_key('1', 'tester', 'widgets/', True, 2),
+                                       widget_key('2', 'tester', 'widgets/', True, 2),
+                                       'other/3' }
+
+    def test_moves_widgets_back_from_sharded_keys(self):
+        # setup
+        s3 = self.setup_bucket([widget_key('1', None, 'widgets/', False, 2)])
+        migration = WidgetKeyMigration(s3, 'test-bucket', 'widgets/', False, 2, 0)
+
+        # exercise
+        migration.run()
+
+        # verify
+        assert self.list_keys(s3) == { 'widgets/1' }
+
+    def test_dry_run_moves_nothing(self):
+        # setup
+        s3 = self.setup_bucket(['widgets/1'])
+        migration = WidgetKeyMigration(s3, 'test-bucket', 'widgets/', False, 0, 2, dry_run=True)
+
+        # exercise
+        moved, _ = migration.run()
+
+        # verify
+        assert moved == 1
+        assert self.list_keys(s3) == { 'widgets/1' }
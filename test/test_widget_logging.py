@@ -0,0 +1,79 @@
+from logging import FileHandler, getLogger, INFO, makeLogRecord
+
+from source import widget_logging
+from source.widget_logging import SamplingFilter, start_queue_logging
+
+class TestSamplingFilter:
+    def test_unsampled_records_are_kept(self):
+        # setup
+        sampler = SamplingFilter(sample_every=100, rate_limit=1)
+
+        # exercise and verify
+        assert all(sampler.filter(makeLogRecord({ 'msg': 'Hello' })) for _ in range(10))
+
+    def test_sample_every(self):
+        # setup
+        sampler = SamplingFilter(sample_every=3)
+
+        # exercise
+        kept = [sampler.filter(makeLogRecord({ 'msg': 'Processed', 'sample': 'processed' }))
+                for _ in range(7)]
+
+        # verify
+        assert kept == [True, False, False, True, False, False, True]
+
+    def test_types_are_sampled_separately(self):
+        # setup
+        sampler = SamplingFilter(sample_every=2)
+
+        # exercise and verify
+        assert sampler.filter(makeLogRecord({ 'msg': 'Received', 'sample': 'received' }))
+        assert sampler.filter(makeLogRecord({ 'msg': 'Processed', 'sample': 'processed' }))
+
+    def test_rate_limit(self, mocker):
+        # setup
+        sampler = SamplingFilter(rate_limit=2)
+        mocker.patch('source.widget_logging.monotonic', side_effect=[0, 0.1, 0.2, 0.3, 1.5])
+
+        # exercise
+        records = [makeLogRecord({ 'msg': 'Processed', 'sample': 'processed' })
+                   for _ in range(5)]
+        kept = [sampler.filter(record) for record in records]
+
+        # verify
+        assert kept == [True, True, False, False, True]
+        assert records[4].getMessage() == 'Processed (2 similar messages dropped)'
+
+class TestStartQueueLogging:
+    def start(self, mocker, filename:str, root_handlers:list) -> list:
+        '''Starts logging against a stand-in root logger and returns the listener's handlers.'''
+        root = getLogger()
+        mocker.patch.object(root, 'handlers', root_handlers) # Restored after the test
+        mocker.patch.object(root, 'level', root.level)
+        mocker.patch.object(widget_logging, '_listener', None)
+        start_queue_logging(filename, INFO, getLogger('test_logger'))
+        listener = widget_logging._listener
+        listener.stop()
+        return list(listener.handlers)
+
+    def test_log_directory_is_created(self, mocker, tmp_path):
+        # setup
+        filename = tmp_path / 'log' / 'consumer.log'
+
+        # exercise
+        handlers = self.start(mocker, str(filename), [])
+
+        # verify
+        assert filename.parent.is_dir()
+        assert [type(handler) for handler in handlers] == [FileHandler]
+
+    def test_configured_root_keeps_its_handlers(self, mocker, tmp_path):
+        # setup
+        filename = tmp_path / 'log' / 'consumer.log'
+
+        # exercise
+        handlers = self.start(mocker, str(filename), [mocker.Mock(level=0)])
+
+        # verify
+        assert not filename.parent.exists()
+        assert not any(isinstance(handler, FileHandler) for handler in handlers)
@@ -0,0 +1,95 @@
+from pickle import dumps, loads
+from urllib.request import urlopen
+
+from source.widget_metrics import MetricsRegistry, start_metrics_server
+
+class TestMetricsRegistry:
+    def test_render_counter(self):
+        # setup
+        registry = MetricsRegistry()
+        registry.describe('widgets_total', 'Widgets seen')
+
+        # exercise
+        registry.increment('widgets_total', type='create')
+        registry.increment('widgets_total', 2, type='create')
+
+        # verify
+        assert registry.render() == ('# HELP widgets_total Widgets seen\n' +
+                                     '# TYPE widgets_total counter\n' +
+                                     'widgets_total{type="create"} 3\n')
+
+    def test_render_histogram(self):
+        # setup
+        registry = MetricsRegistry()
+
+        # exercise
+        registry.observe('latency_seconds', 0.003, stage='store')
+        registry.observe('latency_seconds', 20, stage='store')
+
+        # verify
+        lines = registry.render().splitlines()
+        assert '# TYPE latency_seconds histogram' in lines
+        assert 'latency_seconds_bucket{stage="store",le="0.001"} 0' in lines
+        assert 'latency_seconds_bucket{stage="store",le="0.005"} 1' in lines
+        assert 'latency_seconds_bucket{stage="store",le="+Inf"} 2' in lines
+        assert 'latency_seconds_count{stage="store"} 2' in lines
+
+    def test_time_observes_block(self):
+        # setup
+        registry = MetricsRegistry()
+
+        # exercise
+        with registry.time('latency_seconds', stage='ack'):
+            pass
+
+        # verify
+        assert registry.histograms[('latency_seconds', (('stage', 'ack'),))].count == 1
+
+    def test_merge(self):
+        # setup
+        registry = MetricsRegistry()
+        other = MetricsRegistry()
+        registry.increment('widgets_total')
+        other.increment('widgets_total')
+        other.observe('latency_seconds', 0.5)
+
+        # exercise
+        registry.merge(other)
+
+        # verify
+        assert registry.counters[('widgets_total', ())] == 2
+        assert registry.histograms[('latency_seconds', ())].count == 1
+
+    def test_pickle(self):
+        # setup
+        registry = MetricsRegistry()
+        registry.describe('widgets_total', 'Widgets')
+        registry.increment('widgets_total', type='create')
+        registry.observe('latency_seconds', 0.5)
+
+        # exercise
+        copy:MetricsRegistry = loads(dumps(registry))
+        copy.increment('widgets_total', type='create')
+
+        # verify
+        assert copy.counters[('widgets_total', (('type', 'create'),))] == 2
+        assert copy.histograms[('latency_seconds', ())].count == 1
+        assert copy.render().startswith('# HELP widgets_total Widgets')
+
+    def test_metrics_server(self):
+        # setup
+        registry = MetricsRegistry()
+        registry.increment('widgets_total')
+        server = start_metrics_server(registry, 0)
+
+        # exercise
+        try:
+            port:int = server.server_address[1]
+            with urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+                body:str = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # verify
+        assert 'widgets_total 1' in body
@@ -0,0 +1,55 @@
+from pytest import raises
+
+from source.widget_request import WidgetRequest
+
+class TestWidgetRequest:
+    def test_decode_keeps_body(self):
+        # setup
+        body:bytes = b'{"type": "create", "requestId": "1", "widgetId": "a", "owner": "tester"}'
+
+        # exercise
+        request = WidgetRequest.decode(body, receipt_handle='handle')
+
+        # verify
+        assert (request.type, request.request_id, request.widget_id, request.owner) == \
+            ('create', '1', 'a', 'tester')
+        assert request.receipt_handle == 'handle'
+        assert request.bucket_key is None
+        assert request.encoded_widget() is body
+
+    def test_decode_rejects_unknown_type(self):
+        # exercise and verify
+        with raises(ValueError):
+            WidgetRequest.decode(b'{"type": "unknown", "requestId": "1", "widgetId": "a"}')
+
+    def test_decode_rejects_missing_widget_id(self):
+        # exercise and verify
+        with raises(ValueError):
+            WidgetRequest.decode(b'{"type": "update", "requestId": "1"}')
+
+    def test_decode_rejects_non_object(self):
+        # exercise and verify
+        with raises(ValueError):
+            WidgetRequest.decode(b'["create"]')
+
+    def test_widget_is_encoded_once(self, mocker):
+        # setup
+        widget:dict = { 'type': 'create', 'requestId': '1', 'widgetId': 'a' }
+        request = WidgetRequest(widget)
+        dumps = mocker.patch('source.widget_request.dumps', return_value=b'{}')
+
+        # exercise
+        request.encoded_widget()
+        request.encoded_widget()
+
+        # verify
+        dumps.assert_called_once_with(widget)
+        assert request.body == b'{}'
+
+    def test_slots(self):
+        # setup
+        request = WidgetRequest({ 'type': 'delete', 'widgetId': 'a' })
+
+        # exercise and verify
+        with raises(AttributeError):
+            request.extra = 'not allowed'
@@ -1,9 +1,10 @@
 from boto3 import client
-from json import dumps
+from json import dumps, loads
 from moto import mock_aws
 from os import environ
 
-from source.widget_request_handler import handle_request
+from source import widget_request_handler
+from source.widget_request_handler import handle_bulk_request, handle_request, handler
 
 class TestWidgetRequestHandler():
     @mock_aws
@@ -120,4 +121,221 @@ class TestWidgetRequestHandler():
         sqs.create_queue(QueueName='test-queue')['QueueUrl']
 
         # Exercise
-        assert not handle_request(request, sqs)
\ No newline at end of file
+        assert not handle_request(request, sqs)
+
+    @mock_aws
+    def test_fifo_request_is_grouped_by_widget(self):
+        # setup
+        request = {
+            'requestId': '1',
+            'type': 'update',
+            'owner': 'tester',
+            'widgetId': 'widget-1'
+        }
+
+        ## set environment variables
+        environ['REGION'] = 'us-east-1'
+
+        ## setup client
+        sqs = client('sqs', region_name='us-east-1')
+        environ['QUEUE_URL'] = sqs.create_queue(
+            QueueName='test-queue.fifo',
+            Attributes={ 'FifoQueue': 'true' }
+        )['QueueUrl']
+
+        # Exercise
+        assert handle_request(request, sqs)
+        assert handle_request(dict(request), sqs) # Same requestId, dropped by SQS
+
+        # verify
+        response:dict = sqs.receive_message(
+            QueueUrl=environ['QUEUE_URL'],
+            MaxNumberOfMessages=10,
+            MessageSystemAttributeNames=['All']
+        )
+        assert len(response['Messages']) == 1
+        assert response['Messages'][0]['Attributes']['MessageGroupId'] == 'widget-1'
+        assert response['Messages'][0]['Attributes']['MessageDeduplicationId'] == '1'
+
+    @mock_aws
+    def test_fifo_request_is_grouped_by_owner(self, monkeypatch):
+        # setup
+        request = {
+            'requestId': '1',
+            'type': 'create',
+            'owner': 'tester'
+        }
+
+        ## set environment variables
+        environ['REGION'] = 'us-east-1'
+        monkeypatch.setenv('MESSAGE_GROUP_FIELD', 'owner')
+
+        ## setup client
+        sqs = client('sqs', region_name='us-east-1')
+        environ['QUEUE_URL'] = sqs.create_queue(
+            QueueName='test-queue.fifo',
+            Attributes={ 'FifoQueue': 'true' }
+        )['QueueUrl']
+
+        # Exercise
+        assert handle_request(request, sqs)
+
+        # verify
+        response:dict = sqs.receive_message(
+            QueueUrl=environ['QUEUE_URL'],
+            MessageSystemAttributeNames=['All']
+        )
+        assert response['Messages'][0]['Attributes']['MessageGroupId'] == 'tester'
+
+class LambdaContextReplica():
+    def __init__(self) -> None:
+        self.aws_request_id:str = 'upload'
+
+class TestWidgetRequestHandlerBulk():
+    @mock_aws
+    def test_bulk_array_is_batched(self, mocker):
+        # setup
+        requests = [{ 'type': 'create', 'owner': 'tester' } for _ in range(25)]
+
+        ## set environment variables
+        environ['REGION'] = 'us-east-1'
+
+        ## setup client
+        sqs = client('sqs', region_name='us-east-1')
+        environ['QUEUE_URL'] = sqs.create_queue(QueueName='test-queue')['QueueUrl']
+        send_message_batch = mocker.spy(sqs, 'send_message_batch')
+
+        # Exercise
+        results = handle_bulk_request(requests, 'upload', sqs)
+
+        # verify
+        assert [len(call.kwargs['Entries']) for call in send_message_batch.call_args_list] == \
+               [10, 10, 5]
+        assert all(result['status'] == 'queued' for result in results)
+        assert len({ result['widgetId'] for result in results }) == 25
+        assert results[3]['requestId'] == 'upload-3'
+
+    @mock_aws
+    def test_bulk_batches_respect_size_limit(self, mocker):
+        # setup
+        requests = [{ 'type': 'create', 'owner': 'tester', 'description': 'x' * 100_000 }
+                    for _ in range(5)]
+
+        ## set environment variables
+        environ['REGION'] = 'us-east-1'
+
+        ## setup client
+        sqs = client('sqs', region_name='us-east-1')
+        environ['QUEUE_URL'] = sqs.create_queue(QueueName='test-queue')['QueueUrl']
+        send_message_batch = mocker.spy(sqs, 'send_message_batch')
+
+        # Exercise
+        results = handle_bulk_request(requests, 'upload', sqs)
+
+        # verify
+        assert [len(call.kwargs['Entries']) for call in send_message_batch.call_args_list] == \
+               [2, 2, 1]
+        assert all(result['status'] == 'queued' for result in results)
+
+    @mock_aws
+    def test_bulk_ndjson_reports_invalid_requests(self, mocker):
+        # setup
+        body = '\n'.join([
+            dumps({ 'type': 'create', 'owner': 'tester' }),
+            '{not json',
+            dumps({ 'type': 'update', 'owner': 'tester' }),
+            dumps({ 'type': 'delete', 'owner': 'tester', 'widgetId': '1' }),
+            ''
+        ])
+
+        ## set environment variables
+        environ['REGION'] = 'us-east-1'
+
+        ## setup client
+        sqs = client('sqs', region_name='us-east-1')
+        environ['QUEUE_URL'] = sqs.create_queue(QueueName='test-queue')['QueueUrl']
+        mocker.patch.object(widget_request_handler, 'get_sqs_client', return_value=sqs)
+        mocker.patch.object(widget_request_handler, '_config', None)
+
+        # Exercise
+        response = handler({ 'body': body }, LambdaContextReplica())
+
+        # verify
+        results = loads(response['body'])['results']
+        assert response['statusCode'] == 200
+        assert [result['status'] for result in results] == ['queued', 'error', 'error', 'queued']
+        assert 'Not valid JSON' in results[1]['error']
+        assert results[3]['widgetId'] == '1'
+        messages = sqs.receive_message(QueueUrl=environ['QUEUE_URL'], MaxNumberOfMessages=10)
+        assert len(messages['Messages']) == 2
+
+class TestWidgetRequestHandlerWarmPath():
+    @mock_aws
+    def test_client_and_config_are_reused(self, mocker, monkeypatch):
+        # setup
+        ## set environment variables
+        monkeypatch.setenv('REGION', 'us-east-1')
+
+        ## setup client
+        sqs = client('sqs', region_name='us-east-1')
+        monkeypatch.setenv('QUEUE_URL', sqs.create_queue(QueueName='test-queue')['QueueUrl'])
+        mocker.patch.object(widget_request_handler, '_config', None)
+        mocker.patch.object(widget_request_handler, '_sqs', None)
+        create_client = mocker.patch('boto3.client', return_value=sqs)
+
+        # Exercise
+        for _ in range(3):
+            handler({ 'body': dumps({ 'type': 'create', 'owner': 'tester' }) },
+                    LambdaContextReplica())
+        monkeypatch.setenv('QUEUE_URL', 'changed after the cold start')
+        handler({ 'body': dumps({ 'type': 'create', 'owner': 'tester' }) },
+                LambdaContextReplica())
+
+        # verify
+        create_client.assert_called_once_with('sqs', region_name='us-east-1')
+        messages = sqs.receive_message(QueueUrl=widget_request_handler.get_config()['queue_url'],
+                                       MaxNumberOfMessages=10)
+        assert len(messages['Messages']) == 4
+
+class TestWidgetRequestHandlerResponse():
+    @mock_aws
+    def test_single_request_gets_its_result(self, mocker, monkeypatch):
+        # setup
+        ## set environment variables
+        monkeypatch.setenv('REGION', 'us-east-1')
+
+        ## setup client
+        sqs = client('sqs', region_name='us-east-1')
+        monkeypatch.setenv('QUEUE_URL', sqs.create_queue(QueueName='test-queue')['QueueUrl'])
+        mocker.patch.object(widget_request_handler, 'get_sqs_client', return_value=sqs)
+        mocker.patch.object(widget_request_handler, '_config', None)
+
+        # Exercise
+        response = handler({ 'body': dumps({ 'type': 'delete', 'owner': 'tester',
+                                             'widgetId': '1' }) }, LambdaContextReplica())
+
+        # verify
+        assert response['statusCode'] == 200
+        assert loads(response['body']) == { 'requestId': 'upload', 'status': 'queued',
+                                             'widgetId': '1' }
+
+    @mock_aws
+    def test_invalid_single_request_is_rejected(self, mocker, monkeypatch):
+        # setup
+        ## set environment variables
+        monkeypatch.setenv('REGION', 'us-east-1')
+
+        ## setup client
+        sqs = client('sqs', region_name='us-east-1')
+        monkeypatch.setenv('QUEUE_URL', sqs.create_queue(QueueName='test-queue')['QueueUrl'])
+        mocker.patch.object(widget_request_handler, 'get_sqs_client', return_value=sqs)
+        mocker.patch.object(widget_request_handler, '_config', None)
+
+        # Exercise
+        response = handler({ 'body': dumps({ 'type': 'unknown', 'owner': 'tester' }) },
+                           LambdaContextReplica())
+
+        # verify
+        assert response['statusCode'] == 400
+        assert loads(response['body'])['status'] == 'error'
+        assert 'Messages' not in sqs.receive_message(QueueUrl=environ['QUEUE_URL'])
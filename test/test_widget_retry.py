@@ -0,0 +1,172 @@
+from boto3 import client
+from json import loads
+from moto import mock_aws
+
+from source import widget_retry
+from source.widget_request import WidgetRequest
+from source.widget_retry import FileDeadLetterSink, RetryScheduler, SQSDeadLetterSink
+
+def make_request(request_id:str) -> WidgetRequest:
+    return WidgetRequest({
+        'type': 'create',
+        'requestId': request_id,
+        'owner': 'tester',
+        'widgetId': request_id
+    })
+
+class TestRetryScheduler:
+    def test_requests_wait_for_their_delay(self, mocker):
+        # setup
+        clock = mocker.patch.object(widget_retry, 'monotonic', return_value=0)
+        mocker.patch.object(widget_retry, 'uniform', side_effect=lambda low, high: high)
+        scheduler = RetryScheduler(3, 0.1, 10)
+        request = make_request('1')
+        scheduler.schedule(request)
+
+        # exercise and verify
+        assert scheduler.pop_due() is None
+        assert scheduler.next_due() == 0.1
+        clock.return_value = 0.1
+        assert scheduler.pop_due() is request
+        assert len(scheduler) == 0
+
+    def test_delay_doubles_up_to_max(self, mocker):
+        # setup
+        mocker.patch.object(widget_retry, 'uniform', side_effect=lambda low, high: high)
+        scheduler = RetryScheduler(10, 0.1, 0.5)
+
+        # exercise
+        delays:list[float] = [scheduler.delay(attempts) for attempts in range(1, 6)]
+
+        # verify
+        assert delays == [0.1, 0.2, 0.4, 0.5, 0.5]
+
+    def test_soonest_request_is_due_first(self, mocker):
+        # setup
+        clock = mocker.patch.object(widget_retry, 'monotonic', return_value=100)
+        mocker.patch.object(widget_retry, 'uniform', side_effect=lambda low, high: high)
+        scheduler = RetryScheduler(5, 1, 10)
+        slow = make_request('1')
+        slow.attempts = 2 # Waits 4 seconds
+        fast = make_request('2')
+        scheduler.schedule(slow)
+        scheduler.schedule(fast)
+
+        # exercise
+        clock.return_value = 110
+
+        # verify
+        assert [scheduler.pop_due(), scheduler.pop_due(), scheduler.pop_due()] == \
+               [fast, slow, None]
+
+    def test_attempts_are_capped(self):
+        # setup
+        scheduler = RetryScheduler(2, 0.1, 10)
+        request = make_request('1')
+
+        # exercise
+        results:list[bool] = [scheduler.schedule(request), scheduler.schedule(request)]
+
+        # verify
+        assert results == [True, False]
+        assert request.attempts == 2
+        assert len(scheduler) == 1
+
+    def test_drain_empties_the_scheduler(self):
+        # setup
+        scheduler = RetryScheduler(3, 10, 10)
+        requests = [make_request('1'), make_request('2')]
+        for request in requests:
+            scheduler.schedule(request)
+
+        # exercise
+        drained = scheduler.drain()
+
+        # verify
+        assert sorted(drained, key=lambda request: request.request_id) == requests
+        assert len(scheduler) == 0
+        assert scheduler.next_due() is None
+
+class TestFileDeadLetterSink:
+    def test_requests_are_written_with_their_error(self, tmp_path):
+        # setup
+        sink = FileDeadLetterSink(str(tmp_path / 'dead.ndjson'))
+        request = make_request('1')
+        request.attempts = 3
+
+        # exercise
+        assert sink.send(request, 'boom')
+        sink.close()
+
+        # verify
+        line:dict = loads((tmp_path / 'dead.ndjson').read_text())
+        assert line['requestId'] == '1'
+        assert line['error'] == 'boom'
+        assert line['attempts'] == 3
+        assert line['request'] == request.widget
+
+    def test_send_after_close_fails(self, tmp_path):
+        # setup
+        sink = FileDeadLetterSink(str(tmp_path / 'dead.ndjson'))
+        sink.close()
+
+        # exercise and verify
+        assert not sink.send(make_request('1'), 'boom')
+
+@mock_aws
+class TestSQSDeadLetterSink:
+    def test_request_is_sent_with_its_error(self):
+        # setup
+        sqs = client('sqs', region_name='us-east-1')
+        queue_url:str = sqs.create_queue(QueueName='dead')['QueueUrl']
+        sink = SQSDeadLetterSink(sqs, queue_url)
+        request = make_request('1')
+        request.attempts = 3
+
+        # exercise
+        assert sink.send(request, 'boom')
+
+        # verify
+        message:dict = sqs.receive_message(QueueUrl=queue_url,
+                                           MessageAttributeNames=['All'])['Messages'][0]
+        assert loads(message['Body']) == request.widget
+        assert message['MessageAttributes']['error']['StringValue'] == 'boom'
+        assert message['MessageAttributes']['attempts']['StringValue'] == '3'
+
+    def test_invalid_message_is_sent_as_received(self):
+        # setup
+        sqs = client('sqs', region_name='us-east-1')
+        queue_url:str = sqs.create_queue(QueueName='dead')['QueueUrl']
+        sink = SQSDeadLetterSink(sqs, queue_url)
+
+        # exercise
+        assert sink.send_invalid('not json', 'message-1', 'boom')
+
+        # verify
+        message:dict = sqs.receive_message(QueueUrl=queue_url,
+                                           MessageAttributeNames=['All'])['Messages'][0]
+        assert message['Body'] == 'not json'
+        assert message['MessageAttributes']['error']['StringValue'] == 'boom'
+
+    def test_fifo_queue_gets_a_group(self):
+        # setup
+        sqs = client('sqs', region_name='us-east-1')
+        queue_url:str = sqs.create_queue(QueueName='dead.fifo',
+                                         Attributes={ 'FifoQueue': 'true' })['QueueUrl']
+        sink = SQSDeadLetterSink(sqs, queue_url)
+
+        # exercise
+        assert sink.send(make_request('1'), 'boom')
+
+        # verify
+        message:dict = sqs.receive_message(QueueUrl=queue_url,
+                                           MessageSystemAttributeNames=['MessageGroupId'])
+        assert message['Messages'][0]['Attributes']['MessageGroupId'] == '1'
+
+    def test_missing_queue_fails(self):
+        # setup
+        sqs = client('sqs', region_name='us-east-1')
+        sink = SQSDeadLetterSink(sqs, 'https://sqs.us-east-1.amazonaws.com/123456789012/missing')
+
+        # exercise and verify
+        assert not sink.send(make_request('1'), 'boom')
@@ -0,0 +1,335 @@
+from boto3 import client, resource
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_aws
+from os import environ
+from pytest import mark
+from time import monotonic, sleep
+
+from source.widget_request import WidgetRequest
+from source.widget_store import (DynamoDBWidgetStore, FanOutWidgetStore, PostgresWidgetStore,
+                                 S3WidgetStore, widget_key, WIDGET_STORES, WidgetStore,
+                                 WriteSuppressingWidgetStore)
+
+class MemoryWidgetStore(WidgetStore):
+    '''Keeps widgets in a dict. Fails any widget whose id is in fail_ids.'''
+    def __init__(self, fail_ids:frozenset[str] = frozenset()) -> None:
+        super().__init__()
+        self.name = 'memory'
+        self.widgets:dict[str, dict] = {}
+        self.fail_ids:frozenset[str] = fail_ids
+
+    def put_widget(self, request:WidgetRequest) -> bool:
+        if request.widget_id in self.fail_ids:
+            return False
+        self.widgets[request.widget_id] = request
+        return True
+
+    def delete_widget(self, request:WidgetRequest) -> bool:
+        return self.widgets.pop(request.widget_id, None) is not None
+
+class SlowWidgetStore(MemoryWidgetStore):
+    '''Takes 0.1 seconds to write each widget.'''
+    def put_widget(self, request:WidgetRequest) -> bool:
+        sleep(0.1)
+        return super().put_widget(request)
+
+class TestWidgetStoreRegistry:
+    def test_stores_registered_in_preference_order(self):
+        # exercise and verify
+        assert list(WIDGET_STORES.keys())[:3] == ['s3', 'dynamodb', 'postgres']
+        assert WIDGET_STORES['s3'] is S3WidgetStore
+
+class TestWidgetStoreWriteWidgets:
+    def test_write_widgets_keeps_order(self):
+        # setup
+        store = MemoryWidgetStore()
+        requests:list[WidgetRequest] = [
+            WidgetRequest({ 'type': 'create', 'widgetId': '1' }),
+            WidgetRequest({ 'type': 'delete', 'widgetId': '1' }),
+            WidgetRequest({ 'type': 'create', 'widgetId': '2' }),
+        ]
+
+        # exercise
+        written = store.write_widgets(requests)
+
+        # verify
+        assert written == requests
+        assert list(store.widgets.keys()) == ['2']
+
+class TestFanOutWidgetStore:
+    def test_written_only_when_every_store_writes(self):
+        # setup
+        first = MemoryWidgetStore()
+        second = MemoryWidgetStore(fail_ids={ '2' })
+        store = FanOutWidgetStore([first, second])
+        requests:list[WidgetRequest] = [
+            WidgetRequest({ 'type': 'create', 'widgetId': '1' }),
+            WidgetRequest({ 'type': 'create', 'widgetId': '2' }),
+        ]
+
+        # exercise
+        written = store.write_widgets(requests)
+        store.close()
+
+        # verify
+        assert written == requests[:1]
+        assert list(first.widgets.keys()) == ['1', '2']
+        assert store.name == 'memory+memory'
+
+    def test_callers_write_in_parallel(self):
+        # setup
+        stores = [SlowWidgetStore(), SlowWidgetStore()]
+        store = FanOutWidgetStore(stores, callers=8)
+        requests = [WidgetRequest({ 'type': 'create', 'widgetId': str(index) })
+                    for index in range(8)]
+
+        # exercise
+        start:float = monotonic()
+        with ThreadPoolExecutor(max_workers=8) as callers:
+            written = list(callers.map(store.put_widget, requests))
+        elapsed:float = monotonic() - start
+        store.close()
+
+        # verify
+        assert all(written)
+        assert len(stores[1].widgets) == 8
+        assert elapsed < 0.4 # One write per store at a time would take 0.8 seconds
+
+    def test_batch_size_from_batching_stores(self):
+        # setup
+        batching = MemoryWidgetStore()
+        batching.batch_size = 25
+        batching.batch_interval = 100
+
+        # exercise
+        store = FanOutWidgetStore([MemoryWidgetStore(), batching])
+        store.close()
+
+        # verify
+        assert store.batch_size == 25
+        assert store.batch_interval == 100
+
+class TestWriteSuppressingWidgetStore:
+    def test_unchanged_update_is_not_written(self):
+        # setup
+        memory = MemoryWidgetStore()
+        suppressed:list[WidgetRequest] = []
+        store = WriteSuppressingWidgetStore(memory, 10, suppressed.append)
+        create = WidgetRequest({ 'type': 'create', 'requestId': '1', 'widgetId': '1', 'size': 3 })
+        resend = WidgetRequest({ 'type': 'update', 'requestId': '2', 'widgetId': '1', 'size': 3 })
+        change = WidgetRequest({ 'type': 'update', 'requestId': '3', 'widgetId': '1', 'size': 4 })
+
+        # exercise and verify
+        assert store.put_widget(create)
+        assert store.put_widget(resend)
+        assert memory.widgets['1'] is create
+        assert suppressed == [resend]
+        assert store.put_widget(change)
+        assert memory.widgets['1'] is change
+
+    def test_delete_and_failed_write_invalidate(self):
+        # setup
+        memory = MemoryWidgetStore()
+        store = WriteSuppressingWidgetStore(memory, 10)
+        update = WidgetRequest({ 'type': 'update', 'widgetId': '1', 'size': 3 })
+        store.put_widget(update)
+
+        # exercise
+        store.delete_widget(WidgetRequest({ 'type': 'delete', 'widgetId': '1' }))
+        written = store.put_widget(WidgetRequest({ 'type': 'update', 'widgetId': '1', 'size': 3 }))
+        memory.fail_ids = frozenset({ '1' })
+        failed = store.put_widget(WidgetRequest({ 'type': 'update', 'widgetId': '1', 'size': 4 }))
+        memory.fail_ids = frozenset()
+        rewritten = WidgetRequest({ 'type': 'update', 'widgetId': '1', 'size': 3 })
+        store.put_widget(rewritten)
+
+        # verify
+        assert written and not failed
+        assert memory.widgets['1'] is rewritten # Not skipped, the failed write may have landed
+
+    def test_cache_is_bounded(self):
+        # setup
+        store = WriteSuppressingWidgetStore(MemoryWidgetStore(), 2)
+
+        # exercise
+        for widget_id in ['1', '2', '3']:
+            store.put_widget(WidgetRequest({ 'type': 'update', 'widgetId': widget_id }))
+
+        # verify
+        assert list(store._hashes.keys()) == ['2', '3']
+
+    def test_batch_only_skips_first_request_for_widget(self):
+        # setup
+        memory = MemoryWidgetStore()
+        store = WriteSuppressingWidgetStore(memory, 10)
+        store.put_widget(WidgetRequest({ 'type': 'update', 'widgetId': '1', 'size': 3 }))
+        store.put_widget(WidgetRequest({ 'type': 'update', 'widgetId': '2', 'size': 3 }))
+        requests:list[WidgetRequest] = [
+            WidgetRequest({ 'type': 'update', 'widgetId': '1', 'size': 3 }),
+            WidgetRequest({ 'type': 'update', 'widgetId': '2', 'size': 4 }),
+            WidgetRequest({ 'type': 'update', 'widgetId': '2', 'size': 3 }),
+        ]
+
+        # exercise
+        written = store.write_widgets(requests)
+
+        # verify
+        assert written == requests
+        assert memory.widgets['2'] is requests[2]
+        assert memory.widgets['1'] is not requests[0]
+
+@mock_aws
+class TestS3WidgetStore:
+    def test_put_and_delete_widget(self):
+        # setup
+        s3 = client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='test-bucket')
+        store = S3WidgetStore(s3, 'test-bucket', 'widgets/', use_owner_in_prefix=True)
+        request = WidgetRequest({
+            'type': 'create',
+            'owner': 'tester',
+            'widgetId': '1'
+        }, receipt_handle='handle')
+
+        # exercise and verify
+        assert store.put_widget(request)
+        assert s3.get_object(Bucket='test-bucket', Key='widgets/tester/1')
+        assert store.delete_widget(request)
+        assert 'Contents' not in s3.list_objects_v2(Bucket='test-bucket').keys()
+
+    def test_sharded_keys(self):
+        # setup
+        s3 = client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='test-bucket')
+        store = S3WidgetStore(s3, 'test-bucket', 'widgets/', use_owner_in_prefix=True,
+                              shard_length=2)
+        requests = [WidgetRequest({ 'type': 'create', 'owner': 'tester', 'widgetId': str(index) })
+                    for index in range(50)]
+
+        # exercise
+        for request in requests:
+            assert store.put_widget(request)
+
+        # verify
+        keys = [item['Key'] for item in s3.list_objects_v2(Bucket='test-bucket')['Contents']]
+        assert all(key.split('/', 1)[1].startswith('widgets/tester/') for key in keys)
+        assert len({ key.split('/', 1)[0] for key in keys }) > 10 # Spread over many prefixes
+        assert store.widget_key(requests[0]) == widget_key('0', 'tester', 'widgets/', True, 2)
+
+@mock_aws
+class TestDynamoDBWidgetStore:
+    def test_put_widgets_leaves_widget_alone(self):
+        # setup
+        dynamodb = resource('dynamodb', region_name='us-east-1')
+        table = dynamodb.create_table(
+            AttributeDefinitions=[{ 'AttributeName': 'id', 'AttributeType': 'S' }],
+            TableName='test-table',
+            KeySchema=[{ 'AttributeName': 'id', 'KeyType': 'HASH' }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        store = DynamoDBWidgetStore(table, batch_size=25, batch_interval=100)
+        requests:list[WidgetRequest] = [
+            WidgetRequest({ 'type': 'create', 'requestId': '1', 'widgetId': '1' }),
+            WidgetRequest({ 'type': 'create', 'widgetId': '2' }),
+        ]
+
+        # exercise
+        written = store.put_widgets(requests)
+
+        # verify
+        assert written == requests
+        assert table.get_item(Key={ 'id': '1' })['Item'] == { 'type': 'create', 'id': '1' }
+        assert requests[0].widget == { 'type': 'create', 'requestId': '1', 'widgetId': '1' }
+
+    def test_each_thread_gets_its_own_table(self):
+        # setup
+        dynamodb = resource('dynamodb', region_name='us-east-1')
+        table = dynamodb.create_table(
+            AttributeDefinitions=[{ 'AttributeName': 'id', 'AttributeType': 'S' }],
+            TableName='test-table',
+            KeySchema=[{ 'AttributeName': 'id', 'KeyType': 'HASH' }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        store = DynamoDBWidgetStore(table)
+        requests:list[WidgetRequest] = [WidgetRequest({ 'type': 'create', 'widgetId': str(index) })
+                                        for index in range(4)]
+
+        # exercise
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            tables = list(pool.map(lambda request: store.put_widget(request) and store.table,
+                                   requests))
+
+        # verify
+        assert store.table is table
+        assert all(thread_table is not table for thread_table in tables)
+        assert all(thread_table.meta.client is table.meta.client for thread_table in tables)
+        assert table.scan()['Count'] == 4
+
+class TestPostgresWidgetStore:
+    def setup_store(self, mocker) -> PostgresWidgetStore:
+        return PostgresWidgetStore(mocker.MagicMock(), 'widgets', batch_size=100,
+                                   batch_interval=100)
+
+    def get_cursor(self, store:PostgresWidgetStore):
+        connection = store.pool.connection.return_value.__enter__.return_value
+        return connection.cursor.return_value.__enter__.return_value
+
+    def test_batch_upserts_and_deletes(self, mocker):
+        # setup
+        store = self.setup_store(mocker)
+        requests:list[WidgetRequest] = [WidgetRequest(widget) for widget in [
+            { 'type': 'create', 'requestId': '1', 'owner': 'tester', 'widgetId': 'a' },
+            { 'type': 'update', 'requestId': '2', 'owner': 'tester', 'widgetId': 'b' },
+            { 'type': 'delete', 'requestId': '3', 'owner': 'tester', 'widgetId': 'b' },
+            { 'type': 'update', 'requestId': '4', 'owner': 'tester', 'widgetId': 'a' },
+        ]]
+
+        # exercise
+        assert store.write_widgets(requests) == requests
+
+        # verify
+        cursor = self.get_cursor(store)
+        upserts = cursor.executemany.call_args.args[1]
+        assert [(widget_id, owner) for widget_id, owner, _ in upserts] == [('a', 'tester')]
+        assert upserts[0][2].obj.request_id == '4'
+        assert cursor.execute.call_args.args[1] == (['b'],)
+        assert store.pool.connection.call_count == 1
+
+    def test_failed_batch_writes_nothing(self, mocker):
+        # setup
+        store = self.setup_store(mocker)
+        self.get_cursor(store).executemany.side_effect = RuntimeError('connection lost')
+        request = WidgetRequest({
+            'type': 'create',
+            'requestId': '1',
+            'owner': 'tester',
+            'widgetId': 'a'
+        })
+
+        # exercise and verify
+        assert store.write_widgets([request]) == []
+        assert not store.put_widget(request)
+
+@mark.skipif('PDB_CONN' not in environ, reason='needs a local Postgres (set PDB_CONN)')
+class TestPostgresWidgetStoreDatabase:
+    def test_write_and_delete_widgets(self):
+        # setup
+        from psycopg_pool import ConnectionPool
+        store = PostgresWidgetStore(ConnectionPool(environ['PDB_CONN'], open=True),
+                                    'test_widgets', batch_size=100, batch_interval=100)
+        store.create_table()
+
+        # exercise
+        assert store.put_widget(WidgetRequest({ 'type': 'create', 'requestId': '1',
+                                                'owner': 'tester', 'widgetId': 'a' }))
+        assert store.put_widget(WidgetRequest({ 'type': 'create', 'requestId': '2',
+                                                'owner': 'tester', 'widgetId': 'b' }))
+        assert store.delete_widget(WidgetRequest({ 'type': 'delete', 'requestId': '3',
+                                                   'owner': 'tester', 'widgetId': 'b' }))
+
+        # verify
+        with store.pool.connection() as connection:
+            rows = connection.execute('SELECT id FROM test_widgets ORDER BY id').fetchall()
+            connection.execute('DROP TABLE test_widgets')
+        store.close()
+        assert rows == [('a',)]
@@ -0,0 +1,52 @@
+from json import loads
+from pstats import Stats
+
+from source.widget_request import WidgetRequest
+from source.widget_tracing import ConsumerProfiler, RequestTracer
+
+class TestRequestTracer:
+    def test_finish_writes_ndjson(self, tmp_path):
+        # setup
+        path = tmp_path / 'trace.ndjson'
+        tracer = RequestTracer(str(path), 1)
+        request = WidgetRequest({ 'type': 'create', 'requestId': '1', 'widgetId': 'a' })
+
+        # exercise
+        for _ in range(2):
+            trace = tracer.start()
+            trace.mark('receive')
+            trace.mark('store')
+            tracer.finish(trace, request, 'success')
+        tracer.close()
+
+        # verify
+        lines = [loads(line) for line in path.read_text().splitlines()]
+        assert len(lines) == 2
+        assert lines[0]['requestId'] == '1'
+        assert lines[0]['result'] == 'success'
+        assert list(lines[0]['stages']) == ['receive', 'store']
+        assert 0 <= lines[0]['stages']['receive'] <= lines[0]['stages']['store']
+
+    def test_start_samples(self, tmp_path, mocker):
+        # setup
+        tracer = RequestTracer(str(tmp_path / 'trace.ndjson'), 0.25)
+        mocker.patch('source.widget_tracing.random', side_effect=[0.1, 0.5])
+
+        # exercise and verify
+        assert tracer.start() is not None
+        assert tracer.start() is None
+        tracer.close()
+
+class TestConsumerProfiler:
+    def test_stop_dumps_stats(self, tmp_path):
+        # setup
+        path = tmp_path / 'consumer.pstats'
+        profiler = ConsumerProfiler(str(path))
+
+        # exercise
+        profiler.start()
+        sorted(range(1000), reverse=True)
+        profiler.stop()
+
+        # verify
+        assert Stats(str(path)).total_calls > 0